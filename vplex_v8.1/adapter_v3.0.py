@@ -12,31 +12,1116 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import collections
+import functools
+import json
+import os
+import random
+import sqlite3
 import time
 import sys
+import threading
 
+from eventlet import greenpool
+from eventlet import greenthread
+from eventlet import queue as eventlet_queue
+from eventlet import tpool
+from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_service import loopingcall
 
 from cinder import exception
 from cinder.i18n import _
+from cinder.volume.drivers.dell_emc.vplex import rest as vplex_rest
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+
+# Number of workflow steps run at the same time
+DEFAULT_WORKFLOW_MAX_WORKERS = 4
+
+# Number of teardown steps of one volume run at the same time
+DEFAULT_TEARDOWN_MAX_WORKERS = 2
+
+# Window and size of merged single volume creates
+DEFAULT_CREATE_BATCH_WINDOW = 0
+DEFAULT_CREATE_BATCH_SIZE = 50
+
+# Window and size of batched attaches to one storage view
+DEFAULT_ATTACH_BATCH_WINDOW = 0
+DEFAULT_ATTACH_BATCH_SIZE = 32
+
+# Window and size of batched detaches from one storage view
+DEFAULT_DETACH_BATCH_WINDOW = 0
+DEFAULT_DETACH_BATCH_SIZE = 32
+
+# Seconds an unused host storage view is kept before its teardown
+DEFAULT_VIEW_TEARDOWN_DELAY = 300
+
+# Deferred deletes: seconds between reaper runs, volumes reaped per run
+DEFAULT_REAPER_INTERVAL = 30
+DEFAULT_REAPER_BATCH_SIZE = 5
+
+# Capacity stats: seconds between refreshes, the random jitter added to
+# each, and the GB provisioned or deleted that trigger an early refresh
+DEFAULT_STATS_INTERVAL = 60
+DEFAULT_STATS_JITTER = 15
+DEFAULT_STATS_REFRESH_THRESHOLD = 1000
+
+# Seconds each cluster's storage listing may take in a stats fetch
+DEFAULT_CLUSTER_STATS_TIMEOUT = 60
+
+STEP_PENDING = 'pending'
+STEP_RUNNING = 'running'
+STEP_SUCCESS = 'success'
+STEP_RESUMED = 'resumed'
+STEP_FAILED = 'failed'
+STEP_SKIPPED = 'skipped'
+STEP_CANCELLED = 'cancelled'
+STEP_DONE_STATES = (STEP_SUCCESS, STEP_RESUMED)
+
+# Step journal file under the Cinder state path, and its operations
+JOURNAL_FILE = 'vplex_journal.sqlite'
+JOURNAL_CREATE = 'create'
+JOURNAL_DELETE = 'delete'
+JOURNAL_ROLLBACK = 'rollback'
+
+
+class VPLEXStepJournal(object):
+    """Durable record of the workflow steps completed for each volume.
+
+    Steps are kept in SQLite so they survive a restart of the volume
+    service. A retried operation skips the steps already recorded, and
+    a rollback undoes exactly those steps. The journal also holds the
+    queue of deleted volumes whose cluster legs are still to be reaped.
+    Several backends can share the journal file, so each queued reap is
+    kept under the backend that queued it.
+    SQLite calls block on disk writes, so they run in a native thread
+    rather than stalling every green thread of the service.
+    """
+
+    def __init__(self, path, backend=None):
+        self.path = path
+        self.backend = backend or ''
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path,
+                                         check_same_thread=False)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS steps ('
+                'volume_id TEXT NOT NULL, '
+                'operation TEXT NOT NULL, '
+                'step TEXT NOT NULL, '
+                'completed REAL NOT NULL, '
+                'PRIMARY KEY (volume_id, operation, step))')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS reap ('
+                'volume_id TEXT PRIMARY KEY, '
+                'backend TEXT NOT NULL, '
+                'legs TEXT NOT NULL, '
+                'queued REAL NOT NULL)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _execute(self, func, *args):
+        """Run func(connection, *args) in a native thread.
+
+        :param func: the database call
+        :returns: the func result
+        """
+        with self._lock:
+            return tpool.execute(self._call, func, *args)
+
+    def _call(self, func, *args):
+        return func(self._get_connection(), *args)
+
+    def record(self, volume_id, operation, step):
+        """Record a completed step.
+
+        :param volume_id: the volume id
+        :param operation: the journaled operation e.g. create
+        :param step: the step name
+        """
+        self._execute(self._record, volume_id, operation, step,
+                      time.time())
+
+    @staticmethod
+    def _record(connection, volume_id, operation, step, completed):
+        connection.execute(
+            'INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?)',
+            (volume_id, operation, step, completed))
+        connection.commit()
+
+    def get_steps(self, volume_id, operation):
+        """Get the completed steps of an operation.
+
+        :param volume_id: the volume id
+        :param operation: the journaled operation
+        :returns: list -- step names, in completion order
+        """
+        return self._execute(self._get_steps, volume_id, operation)
+
+    @staticmethod
+    def _get_steps(connection, volume_id, operation):
+        return [row[0] for row in connection.execute(
+            'SELECT step FROM steps WHERE volume_id = ? AND '
+            'operation = ? ORDER BY completed', (volume_id, operation))]
+
+    def forget(self, volume_id, operation=None):
+        """Drop the steps of an operation, or of every operation.
+
+        Forgetting every operation also drops a queued reap.
+        :param volume_id: the volume id
+        :param operation: the journaled operation, None for all
+        """
+        self._execute(self._forget, volume_id, operation)
+
+    @staticmethod
+    def _forget(connection, volume_id, operation):
+        if operation is None:
+            connection.execute(
+                'DELETE FROM steps WHERE volume_id = ?', (volume_id,))
+            connection.execute(
+                'DELETE FROM reap WHERE volume_id = ?', (volume_id,))
+        else:
+            connection.execute(
+                'DELETE FROM steps WHERE volume_id = ? AND '
+                'operation = ?', (volume_id, operation))
+        connection.commit()
+
+    def queue_reap(self, volume_id, legs):
+        """Queue the teardown of a deleted volume's cluster legs.
+
+        :param volume_id: the volume id
+        :param legs: list -- the leg dicts to tear down
+        """
+        self._execute(self._queue_reap, volume_id, self.backend,
+                      json.dumps(legs), time.time())
+
+    @staticmethod
+    def _queue_reap(connection, volume_id, backend, legs, queued):
+        connection.execute(
+            'INSERT OR REPLACE INTO reap (volume_id, backend, legs, queued) '
+            'VALUES (?, ?, ?, ?)', (volume_id, backend, legs, queued))
+        connection.commit()
+
+    def requeue_reap(self, volume_id):
+        """Move a queued teardown to the back of the queue.
+
+        :param volume_id: the volume id
+        """
+        self._execute(self._requeue_reap, volume_id, time.time())
+
+    @staticmethod
+    def _requeue_reap(connection, volume_id, queued):
+        connection.execute(
+            'UPDATE reap SET queued = ? WHERE volume_id = ?',
+            (queued, volume_id))
+        connection.commit()
+
+    def get_reap_queue(self, limit=None):
+        """Get the teardowns this backend queued, oldest first.
+
+        :param limit: the maximum number returned, None for all
+        :returns: list -- (volume id, legs) tuples
+        """
+        return self._execute(self._get_reap_queue, self.backend,
+                             -1 if limit is None else limit)
+
+    @staticmethod
+    def _get_reap_queue(connection, backend, limit):
+        rows = connection.execute(
+            'SELECT volume_id, legs FROM reap WHERE backend = ? '
+            'ORDER BY queued LIMIT ?', (backend, limit))
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+
+class VPLEXWorkflow(object):
+    """A dependency graph of VPLEX provisioning steps.
+
+    Each step is a callable with its inputs and the names of the steps
+    it requires. run() starts every step whose requirements succeeded,
+    up to max_workers at a time. After a failure no further steps are
+    started and the running ones are cancelled: they send no further
+    command and stop waiting on their jobs. They are joined and the
+    first failure raised.
+    With a journal, steps recorded by an earlier run are not run again
+    and every step is recorded as it completes. Without fail_fast, the
+    steps not depending on a failed one still run, and all failures are
+    reported together.
+    """
+
+    def __init__(self, name, rest, max_workers=DEFAULT_WORKFLOW_MAX_WORKERS,
+                 journal=None, journal_key=None, fail_fast=True):
+        self.name = name
+        self.rest = rest
+        self.max_workers = max(1, max_workers)
+        self.fail_fast = fail_fast
+        self.journal = journal
+        self.journal_key = journal_key
+        self.steps = collections.OrderedDict()
+        self.results = {}
+
+    def add_step(self, name, func, args=(), requires=()):
+        """Add a step to the graph.
+
+        :param name: the unique step name
+        :param func: the callable run with the step inputs
+        :param args: the inputs, passed to func as positional arguments
+        :param requires: names of the steps that must succeed first
+        :returns: the step name, for use in other steps' requires
+        """
+        if name in self.steps:
+            raise ValueError(_('Duplicate workflow step %s.') % name)
+        self.steps[name] = {'func': func,
+                            'requires': tuple(requires),
+                            'args': tuple(args),
+                            'state': STEP_PENDING,
+                            'duration': None}
+        return name
+
+    def _validate(self):
+        for name, step in self.steps.items():
+            for required in step['requires']:
+                if required not in self.steps:
+                    raise ValueError(
+                        _('Workflow step %(step)s requires unknown step '
+                          '%(required)s.') % {'step': name,
+                                              'required': required})
+
+    def _run_step(self, name, finished):
+        step = self.steps[name]
+        start_time = time.time()
+        error = None
+        try:
+            result = step['func'](*step['args'])
+            if isinstance(result, vplex_rest.VPLEXJob):
+                # later steps may depend on an accepted command
+                result = self.rest.wait_for_job(result)
+            self.results[name] = result
+        except Exception as e:
+            error = e
+        step['duration'] = time.time() - start_time
+        finished.put((name, error))
+
+    def run(self):
+        """Run the workflow to completion.
+
+        :returns: dict -- the step results, by step name
+        :raises: the step failure; VolumeBackendAPIException listing them
+                 when several steps failed without fail_fast
+        """
+        self._validate()
+        pool = greenpool.GreenPool(self.max_workers)
+        finished = eventlet_queue.LightQueue()
+        cancel = threading.Event() if self.fail_fast else None
+        with self.rest.cancellation(cancel):
+            run_step = self.rest.propagate_context(self._run_step)
+        pending = list(self.steps)
+        for name in self.get_journaled():
+            if name in pending:
+                pending.remove(name)
+                self.steps[name]['state'] = STEP_RESUMED
+        running = set()
+        failures = []
+        start_time = time.time()
+        while pending or running:
+            if not (failures and self.fail_fast):
+                for name in list(pending):
+                    step = self.steps[name]
+                    if all(self.steps[required]['state'] in STEP_DONE_STATES
+                           for required in step['requires']):
+                        pending.remove(name)
+                        running.add(name)
+                        step['state'] = STEP_RUNNING
+                        pool.spawn_n(run_step, name, finished)
+            if not running:
+                break
+            name, error = finished.get()
+            running.discard(name)
+            if error is None:
+                self.steps[name]['state'] = STEP_SUCCESS
+                self._journal_step(name)
+            elif failures and self.fail_fast:
+                self.steps[name]['state'] = STEP_CANCELLED
+            else:
+                self.steps[name]['state'] = STEP_FAILED
+                failures.append((name, error))
+                if cancel is not None:
+                    cancel.set()
+        for name in pending:
+            self.steps[name]['state'] = STEP_SKIPPED
+        LOG.debug('Workflow %(name)s took %(delta).3fs: %(steps)s.',
+                  {'name': self.name,
+                   'delta': time.time() - start_time,
+                   'steps': self.get_timings()})
+        if len(failures) == 1 or (failures and self.fail_fast):
+            raise failures[0][1]
+        if failures:
+            exception_message = (
+                _('Workflow %(name)s failed at steps %(errors)s.')
+                % {'name': self.name,
+                   'errors': ', '.join('%s (%s)' % (name, error)
+                                       for name, error in failures)})
+            LOG.error(exception_message)
+            raise exception.VolumeBackendAPIException(
+                data=exception_message)
+        if pending:
+            raise ValueError(
+                _('Workflow %(name)s has a dependency cycle between '
+                  '%(steps)s.') % {'name': self.name, 'steps': pending})
+        return self.results
+
+    def get_journaled(self):
+        """Get the steps an earlier run recorded as completed.
+
+        :returns: list -- step names
+        """
+        if self.journal is None:
+            return []
+        return self.journal.get_steps(*self.journal_key)
+
+    def _journal_step(self, name):
+        if self.journal is None:
+            return
+        try:
+            self.journal.record(self.journal_key[0], self.journal_key[1],
+                                name)
+        except Exception:
+            # the step is done; only resuming it is lost
+            LOG.exception('Could not journal step %(step)s of workflow '
+                          '%(name)s.', {'step': name, 'name': self.name})
+
+    def _get_dependants(self, name):
+        dependants = set()
+        new = [name]
+        while new:
+            current = new.pop()
+            for other, step in self.steps.items():
+                if current in step['requires'] and other not in dependants:
+                    dependants.add(other)
+                    new.append(other)
+        return dependants
+
+    def get_rollback(self, name, undo, completed, journal_key=None):
+        """Build the workflow undoing completed steps.
+
+        A step is undone only after every completed step built on it.
+        :param name: the rollback workflow name
+        :param undo: dict of step name to (func, args) undoing the step;
+                     steps without an entry need no undo
+        :param completed: the names of the steps to undo
+        :param journal_key: (volume id, operation) journaling the
+                            rollback, None to not journal it
+        :returns: VPLEXWorkflow
+        """
+        rollback = VPLEXWorkflow(name, self.rest, self.max_workers,
+                                 self.journal if journal_key else None,
+                                 journal_key, fail_fast=False)
+        undone = [step for step in self.steps
+                  if step in completed and step in undo]
+        for step in undone:
+            func, args = undo[step]
+            rollback.add_step(
+                'undo-%s' % step, func, args,
+                requires=['undo-%s' % dependant for dependant in undone
+                          if dependant in self._get_dependants(step)])
+        return rollback
+
+    def get_timings(self):
+        """Get the state and duration of every step.
+
+        :returns: dict -- step name to (state, seconds)
+        """
+        return collections.OrderedDict(
+            (name, (step['state'], step['duration']))
+            for name, step in self.steps.items())
+
+
+class VPLEXHostViews(object):
+    """Reference counts of the volumes exposed through each host view.
+
+    A view is kept while any volume is attached through it. Once the
+    last volume leaves, the view is torn down after the grace period
+    unless another attach to it cancels the teardown first.
+    """
+
+    def __init__(self, grace_period=DEFAULT_VIEW_TEARDOWN_DELAY):
+        self.grace_period = grace_period
+        # (cluster, view) -> volumes, pending timer and running teardown
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def _get_view(self, key):
+        return self._views.setdefault(
+            key, {'volumes': set(), 'timer': None, 'teardown': None})
+
+    def acquire(self, cluster, view, volume):
+        """Count a volume attaching through a view.
+
+        A pending teardown of the view is cancelled, and one already
+        running is waited for so the attach can recreate the view.
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param volume: the virtual volume name
+        """
+        while True:
+            with self._lock:
+                state = self._get_view((cluster, view))
+                if state['timer'] is not None:
+                    state['timer'].cancel()
+                    state['timer'] = None
+                    LOG.debug('Cancelled the teardown of storage view '
+                              '%(view)s on %(cluster)s.',
+                              {'view': view, 'cluster': cluster})
+                teardown = state['teardown']
+                if teardown is None:
+                    state['volumes'].add(volume)
+                    return
+            teardown.wait()
+
+    def release(self, cluster, view, volume):
+        """Stop counting a volume attached through a view.
+
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param volume: the virtual volume name
+        :returns: int -- the volumes still counted on the view
+        """
+        with self._lock:
+            state = self._get_view((cluster, view))
+            state['volumes'].discard(volume)
+            return len(state['volumes'])
+
+    def schedule_teardown(self, cluster, view, teardown):
+        """Tear an unused view down once the grace period has passed.
+
+        With no grace period the teardown runs at once in the caller.
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param teardown: the callable tearing the view down
+        """
+        key = (cluster, view)
+        if self.grace_period <= 0:
+            self._run_teardown(key, teardown)
+            return
+        with self._lock:
+            state = self._get_view(key)
+            if state['volumes'] or state['timer'] or state['teardown']:
+                return
+            state['timer'] = greenthread.spawn_after(
+                self.grace_period, self._run_scheduled_teardown, key,
+                teardown)
+
+    def _run_scheduled_teardown(self, key, teardown):
+        try:
+            self._run_teardown(key, teardown)
+        except Exception:
+            LOG.exception('Tearing down storage view %(view)s on '
+                          '%(cluster)s failed.',
+                          {'view': key[1], 'cluster': key[0]})
+
+    def _run_teardown(self, key, teardown):
+        with self._lock:
+            state = self._get_view(key)
+            state['timer'] = None
+            if state['volumes'] or state['teardown'] is not None:
+                # attached again in the meantime
+                return
+            done = state['teardown'] = threading.Event()
+        try:
+            teardown()
+        finally:
+            with self._lock:
+                state['teardown'] = None
+                if not state['volumes'] and state['timer'] is None:
+                    self._views.pop(key, None)
+            done.set()
+
+    def get_stats(self):
+        """Get the view reference counts.
+
+        :returns: dict -- (cluster, view) to volume count, and the
+                  number of pending teardowns
+        """
+        with self._lock:
+            return {'volumes': dict((key, len(state['volumes']))
+                                    for key, state in self._views.items()),
+                    'pending_teardowns': len(
+                        [state for state in self._views.values()
+                         if state['timer'] is not None])}
+
+
+class VPLEXDeleteReaper(object):
+    """Background teardown of the volumes deferred deletes queued.
+
+    The queue lives in the step journal, so pending teardowns survive a
+    restart and resume after their journaled steps. Each run reaps at
+    most batch_size volumes one after another, leaving the array to
+    foreground operations in between. A volume whose teardown fails
+    goes to the back of the queue.
+    """
+
+    def __init__(self, rest, journal, reap,
+                 interval=DEFAULT_REAPER_INTERVAL,
+                 batch_size=DEFAULT_REAPER_BATCH_SIZE):
+        self.rest = rest
+        self.journal = journal
+        self.reap = reap
+        self.interval = interval
+        self.batch_size = batch_size
+        self._reaper = None
+        self._reaped = 0
+        self._failed = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start reaping the queued volumes."""
+        with self._lock:
+            if self._reaper is not None or self.interval <= 0:
+                return
+            self._reaper = loopingcall.FixedIntervalLoopingCall(
+                self._reap_batch)
+            self._reaper.start(interval=self.interval,
+                               initial_delay=self.interval)
+
+    def _reap_batch(self):
+        if self.rest.base_uri is None:
+            # nothing can be reached before the array record is loaded
+            return
+        try:
+            queued = self.journal.get_reap_queue(self.batch_size)
+        except Exception:
+            LOG.exception('Reading the VPLEX reap queue failed.')
+            return
+        for volume_id, legs in queued:
+            try:
+                self.reap(volume_id, legs)
+            except Exception:
+                LOG.exception('Reaping the devices of deleted volume '
+                              '%(volume)s failed; it is retried later.',
+                              {'volume': volume_id})
+                self._failed += 1
+                try:
+                    self.journal.requeue_reap(volume_id)
+                except Exception:
+                    # the volume stays queued in its old place
+                    LOG.exception('Requeueing the reap of deleted volume '
+                                  '%(volume)s failed.',
+                                  {'volume': volume_id})
+            else:
+                self._reaped += 1
+
+    def get_stats(self):
+        """Get the reaper counters.
+
+        :returns: dict -- queued, reaped and failed counts
+        """
+        return {'queued': len(self.journal.get_reap_queue()),
+                'reaped': self._reaped,
+                'failed': self._failed}
+
+
+class VPLEXStatsCollector(object):
+    """Background refresh of the backend capacity stats.
+
+    Stats polls are answered from the latest snapshot instead of
+    listing the storage volumes of every cluster. The snapshot is
+    refreshed every interval plus a random jitter, so backends sharing
+    the array do not list it in step, and early once the capacity
+    provisioned or deleted since the last refresh reaches
+    refresh_threshold GB.
+    """
+
+    def __init__(self, collect, interval=DEFAULT_STATS_INTERVAL,
+                 jitter=DEFAULT_STATS_JITTER,
+                 refresh_threshold=DEFAULT_STATS_REFRESH_THRESHOLD):
+        self.collect = collect
+        self.interval = interval
+        self.jitter = jitter
+        self.refresh_threshold = refresh_threshold
+        self.clusters = []
+        self._stats = None
+        self._collected = None
+        self._changed = 0
+        self._refreshing = False
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def _get_delay(self):
+        return self.interval + random.uniform(0, max(0, self.jitter))
+
+    def start(self, clusters):
+        """Start refreshing the stats of the given clusters.
+
+        :param clusters: the cluster names
+        """
+        with self._lock:
+            self.clusters = list(clusters)
+            if self._refresher is not None or self.interval <= 0:
+                return
+            self._refresher = loopingcall.DynamicLoopingCall(
+                self._refresh_periodic)
+            self._refresher.start(
+                initial_delay=self._get_delay(),
+                periodic_interval_max=self.interval + max(0, self.jitter))
+
+    def refresh(self, clusters=None):
+        """Collect a new snapshot.
+
+        :param clusters: the cluster names, None for the started ones
+        :returns: dict -- the stats
+        """
+        if clusters is not None:
+            self.clusters = list(clusters)
+        stats = self.collect(list(self.clusters))
+        with self._lock:
+            self._stats = stats
+            self._collected = time.time()
+            self._changed = 0
+        return stats
+
+    def _refresh_periodic(self):
+        """Refresh the snapshot, keeping the old one on failure.
+
+        :returns: float -- seconds until the next refresh
+        """
+        try:
+            self.refresh()
+        except Exception:
+            LOG.exception('Refreshing the VPLEX capacity stats failed.')
+        return self._get_delay()
+
+    def _refresh_early(self):
+        try:
+            self._refresh_periodic()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get_snapshot(self):
+        """Get the latest stats.
+
+        :returns: tuple -- the stats dict and its age in seconds, or
+                  None and None before the first refresh
+        """
+        with self._lock:
+            if self._stats is None:
+                return None, None
+            return dict(self._stats), time.time() - self._collected
+
+    def record_change(self, size_gb):
+        """Account for capacity provisioned or deleted.
+
+        :param size_gb: the capacity in GB
+        """
+        with self._lock:
+            self._changed += size_gb or 0
+            if (self._refresher is None or self._refreshing or
+                    self.refresh_threshold <= 0 or
+                    self._changed < self.refresh_threshold):
+                return
+            self._refreshing = True
+        LOG.debug('%(changed)sGB changed since the last VPLEX capacity '
+                  'stats; refreshing them early.',
+                  {'changed': self._changed})
+        greenthread.spawn_n(self._refresh_early)
+
 
 class VPLEXAdapter(object):
 
     def __init__(self, configuration, rest):
         self.config = configuration
         self.rest = rest
-        self.mirror_device_date = None
+        self.workflow_max_workers = self._get_config_value(
+            'vplex_workflow_max_workers', DEFAULT_WORKFLOW_MAX_WORKERS)
+        self.teardown_max_workers = self._get_config_value(
+            'vplex_teardown_max_workers', DEFAULT_TEARDOWN_MAX_WORKERS)
+        self.create_batcher = None
+        create_batch_window = self._get_config_value(
+            'vplex_create_batch_window', DEFAULT_CREATE_BATCH_WINDOW)
+        if create_batch_window > 0:
+            self.create_batcher = vplex_rest.VPLEXRequestBatcher(
+                self._create_volume_batch, create_batch_window,
+                self._get_config_value('vplex_create_batch_size',
+                                       DEFAULT_CREATE_BATCH_SIZE))
+        self.attach_batch_window = self._get_config_value(
+            'vplex_attach_batch_window', DEFAULT_ATTACH_BATCH_WINDOW)
+        self.attach_batch_size = self._get_config_value(
+            'vplex_attach_batch_size', DEFAULT_ATTACH_BATCH_SIZE)
+        self.detach_batch_window = self._get_config_value(
+            'vplex_detach_batch_window', DEFAULT_DETACH_BATCH_WINDOW)
+        self.detach_batch_size = self._get_config_value(
+            'vplex_detach_batch_size', DEFAULT_DETACH_BATCH_SIZE)
+        # one request batcher per storage view
+        self._attach_batchers = {}
+        self._detach_batchers = {}
+        self._view_batchers_lock = threading.Lock()
+        self.host_views = VPLEXHostViews(self._get_config_value(
+            'vplex_view_teardown_delay', DEFAULT_VIEW_TEARDOWN_DELAY))
+        self.cluster_stats_timeout = self._get_config_value(
+            'vplex_cluster_stats_timeout', DEFAULT_CLUSTER_STATS_TIMEOUT)
+        # the reap queue of each backend is kept apart in a shared file
+        self.journal = VPLEXStepJournal(
+            self._get_config_value('vplex_journal_path', None) or
+            os.path.join(CONF.state_path, JOURNAL_FILE),
+            getattr(self.config, 'config_group', None))
+        self.reaper = None
+        if self._get_config_value('vplex_deferred_delete', False):
+            self.reaper = VPLEXDeleteReaper(
+                self.rest, self.journal, self._reap_volume,
+                self._get_config_value('vplex_reaper_interval',
+                                       DEFAULT_REAPER_INTERVAL),
+                self._get_config_value('vplex_reaper_batch_size',
+                                       DEFAULT_REAPER_BATCH_SIZE))
+            # resume the teardowns queued before a restart
+            self.reaper.start()
+
+    def _get_config_value(self, name, default):
+        """Get a driver option, falling back to a default.
+
+        :param name: the option name
+        :param default: the value used when the option is not set
+        :returns: the option value
+        """
+        return vplex_rest.get_config_value(self.config, name, default)
+
+    def _new_workflow(self, name, journal_key=None, max_workers=None,
+                      fail_fast=True):
+        """Create an empty workflow bounded by the configured cap.
+
+        :param name: the workflow name, used in logs
+        :param journal_key: (volume id, operation) to journal the steps
+                            under, None to not journal them
+        :param max_workers: the step concurrency, None for the default
+        :param fail_fast: False to keep running independent steps after
+                          a failure
+        :returns: VPLEXWorkflow
+        """
+        return VPLEXWorkflow(name, self.rest,
+                             max_workers or self.workflow_max_workers,
+                             self.journal if journal_key else None,
+                             journal_key, fail_fast)
 
     def create_volume(self, volume, extra_specs):
         """ create a EMC(VPLEX) volume
 
+        When a create batch window is set, creates arriving within it are
+        merged into one bulk provisioning call.
         :param volume:
         :param extra_specs:
         :return:
         """
+        if self.create_batcher is not None:
+            # the batch runs in another caller's thread; carry our deadline
+            self.create_batcher.submit(
+                (volume, extra_specs, self.rest.get_deadline()))
+            return
+        self._create_volume(volume, extra_specs)
+
+    def _create_volume_batch(self, requests):
+        """Create the volumes of a batch of merged create requests.
+
+        Each volume is created within the deadline of its own caller. The
+        steps shared by several volumes run until the last of their
+        deadlines expires.
+        :param requests: list of (volume, extra_specs, VPLEXDeadline or
+                         None) tuples
+        :returns: list -- None or the exception, for each request
+        """
+        results = {}
+        live = []
+        for volume, extra_specs, deadline in requests:
+            try:
+                if deadline is not None:
+                    deadline.check()
+            except Exception as e:
+                results[volume['id']] = e
+            else:
+                live.append((volume, extra_specs, deadline))
+        deadlines = [deadline for __, __, deadline in live]
+        batch_deadline = None
+        if deadlines and None not in deadlines:
+            batch_deadline = max(deadlines, key=lambda d: d.expires)
+        with self.rest.deadline(batch_deadline, replace=True):
+            if len(live) == 1:
+                volume, extra_specs, deadline = live[0]
+                try:
+                    self._create_volume(volume, extra_specs)
+                    results[volume['id']] = None
+                except Exception as e:
+                    results[volume['id']] = e
+            elif live:
+                results.update(self.create_volumes(
+                    [(volume, extra_specs)
+                     for volume, extra_specs, __ in live],
+                    dict((volume['id'], deadline)
+                         for volume, __, deadline in live)))
+        return [results[volume['id']] for volume, __, __ in requests]
+
+    def _with_deadline(self, deadline, func):
+        """Run a callable within a deadline.
+
+        :param deadline: the VPLEXDeadline, None to keep the one in force
+        :param func: the callable
+        :returns: the wrapped callable
+        """
+        if deadline is None:
+            return func
+
+        def _run_with_deadline(*args):
+            with self.rest.deadline(deadline):
+                return func(*args)
+        return _run_with_deadline
+
+    @staticmethod
+    def _collect(failures, journaled, func):
+        """Merge the outcome of a create step into the volumes' state.
+
+        :param failures: dict of volume id to exception
+        :param journaled: dict of volume id to the set of journaled steps
+        :param func: the step, returning the failures and journaled steps
+                     it adds
+        :returns: the wrapped callable
+        """
+        def _run_and_collect(*args):
+            failed, done = func(*args)
+            for volume_id, error in failed.items():
+                failures.setdefault(volume_id, error)
+            for volume_id, step in done:
+                journaled[volume_id].add(step)
+        return _run_and_collect
+
+    def _run_for_volumes(self, volume_steps, failures, journaled, func,
+                         *args):
+        """Run one command on behalf of several volumes.
+
+        The command is skipped when every volume has already failed or
+        journaled the step, and its failure is charged to all of them.
+        :param volume_steps: list of (volume id, journal step name)
+        :param failures: dict of volume id to exception
+        :param journaled: dict of volume id to the set of journaled steps
+        :param func: the rest command
+        :param args: the command arguments
+        :returns: tuple -- dict of volume id to the exception that failed
+                  it, and the list of (volume id, step) journaled
+        """
+        volume_steps = [(volume_id, step) for volume_id, step in volume_steps
+                        if volume_id not in failures and
+                        step not in journaled[volume_id]]
+        if not volume_steps:
+            return {}, []
+        try:
+            self.rest.wait_for_job(func(*args))
+        except Exception as e:
+            return dict((volume_id, e) for volume_id, __ in volume_steps), []
+        return {}, self._journal_volume_steps(volume_steps)
+
+    def _journal_volume_steps(self, volume_steps):
+        for volume_id, step in volume_steps:
+            try:
+                self.journal.record(volume_id, JOURNAL_CREATE, step)
+            except Exception:
+                LOG.exception('Could not journal step %(step)s of volume '
+                              '%(volume)s.',
+                              {'step': step, 'volume': volume_id})
+        return volume_steps
+
+    def _run_grouped(self, entries, failures, journaled, grouped, single,
+                     applied, deadlines):
+        """Run one multi-target command for several volumes.
+
+        When the grouped command fails every volume falls back to its
+        own single-target command, so only the volume at fault fails.
+        The grouped command may have taken effect on some targets before
+        it failed, so a target is only sent again when applied() does not
+        find it done.
+        :param entries: list of (volume id, journal step name, single
+                        command args)
+        :param failures: dict of volume id to exception
+        :param journaled: dict of volume id to the set of journaled steps
+        :param grouped: the multi-target command, called with a list of
+                        values for each argument of the single command
+        :param single: the single-target command
+        :param applied: called with the first single command argument,
+                        returns True if that target is already done
+        :param deadlines: dict of volume id to the VPLEXDeadline of its
+                          fallback
+        :returns: tuple -- dict of volume id to the exception that failed
+                  it, and the list of (volume id, step) journaled
+        """
+        entries = [(volume_id, step, args)
+                   for volume_id, step, args in entries
+                   if volume_id not in failures and
+                   step not in journaled[volume_id]]
+        if not entries:
+            return {}, []
+        try:
+            self.rest.wait_for_job(grouped(
+                *[list(values) for values in
+                  zip(*[args for __, __, args in entries])]))
+        except Exception as e:
+            LOG.warning('Grouped %(command)s for %(count)s volumes failed, '
+                        'retrying them one by one: %(error)s',
+                        {'command': grouped.__name__,
+                         'count': len(entries),
+                         'error': e})
+        else:
+            return {}, self._journal_volume_steps(
+                [(volume_id, step) for volume_id, step, __ in entries])
+        failed = {}
+        done = []
+        for volume_id, step, args in entries:
+            with self.rest.deadline(deadlines.get(volume_id)):
+                try:
+                    applied_already = applied(args[0])
+                except Exception:
+                    applied_already = None
+                if applied_already:
+                    LOG.info('%(command)s of %(target)s already took '
+                             'effect, not sending it again.',
+                             {'command': single.__name__,
+                              'target': args[0]})
+                    done.extend(self._journal_volume_steps(
+                        [(volume_id, step)]))
+                    continue
+                step_failed, step_done = self._run_for_volumes(
+                    [(volume_id, step)], failures, journaled, single, *args)
+                failed.update(step_failed)
+                done.extend(step_done)
+        return failed, done
+
+    def create_volumes(self, volumes, deadlines=None):
+        """Create many EMC(VPLEX) volumes together.
+
+        Each array is rediscovered once, and the storage volumes of each
+        cluster are claimed and their extents created with one
+        multi-target command. The devices, virtual volume and mirror of
+        each volume then form their own graph branch, so a failure stops
+        only the volume it belongs to. Steps are journaled under the
+        same names as a single create, so either path can resume the
+        other.
+        :param volumes: list of (volume, extra_specs) tuples
+        :param deadlines: dict of volume id to the VPLEXDeadline its own
+                          steps run within, None to share the one in
+                          force
+        :returns: dict -- volume id to None, or the exception that
+                  failed the volume
+        """
+        start_time = time.time()
+        deadlines = deadlines or {}
+        failures = {}
+        journaled = {}
+        arrays = collections.OrderedDict()
+        storage_volumes = collections.defaultdict(list)
+        claims = collections.OrderedDict()
+        for volume, extra_specs in volumes:
+            journaled[volume['id']] = set(
+                self.journal.get_steps(volume['id'], JOURNAL_CREATE))
+            array_info = extra_specs['array-info']
+            volume_info = extra_specs['volume_info']
+            for index in range(volume_info['count']):
+                cluster = array_info['cluster_name'][index]
+                hard = array_info['hards'][index]
+                arrays.setdefault((cluster, hard), []).append(
+                    (volume['id'], 'rediscover-%d' % index))
+                storage_volumes[(cluster, hard)].append(
+                    array_info['storage_volumes'][index])
+                claims.setdefault(cluster, []).append(
+                    (volume['id'], index,
+                     (volume_info['lun'][index],
+                      array_info['storage_volumes'][index])))
+
+        workflow = self._new_workflow('create-%d-volumes' % len(volumes))
+        # each step returns what it adds, merged here as it completes
+        run_for_volumes = self._collect(failures, journaled,
+                                        self._run_for_volumes)
+        run_grouped = self._collect(failures, journaled, self._run_grouped)
+        rediscovered = collections.defaultdict(list)
+        for (cluster, hard), volume_steps in arrays.items():
+            rediscovered[cluster].append(workflow.add_step(
+                'rediscover-%s-%s' % (cluster, hard), run_for_volumes,
+                (volume_steps, failures, journaled,
+                 self.rest.rediscover_array, cluster, hard,
+                 storage_volumes[(cluster, hard)])))
+        extents = {}
+        for cluster, entries in claims.items():
+            claim = workflow.add_step(
+                'claim-%s' % cluster, run_grouped,
+                ([(volume_id, 'claim-%d' % index, args)
+                  for volume_id, index, args in entries],
+                 failures, journaled, self.rest.claim_storage_volumes,
+                 self.rest.claim_storage_volume,
+                 self.rest.is_storage_volume_claimed, deadlines),
+                requires=rediscovered[cluster])
+            extents[cluster] = workflow.add_step(
+                'extent-%s' % cluster, run_grouped,
+                ([(volume_id, 'extent-%d' % index, args[:1])
+                  for volume_id, index, args in entries],
+                 failures, journaled, self.rest.create_extents,
+                 self.rest.create_extent, self.rest.is_extent_created,
+                 deadlines),
+                requires=[claim])
+
+        for volume, extra_specs in volumes:
+            cluster_1ist = extra_specs['array-info']['cluster_name']
+            device_list = extra_specs['volume_info']['device']
+            extent_list = extra_specs['volume_info']['extent']
+            geometry = extra_specs['volume_info']['geometry']
+            size = extra_specs['volume_info']['count']
+            attach_device = ''
+            mirror_device = ''
+            devices = []
+            run_for_volume = self._with_deadline(
+                deadlines.get(volume['id']), run_for_volumes)
+            for index in range(size):
+                if index == 0:
+                    attach_device = device_list[index]
+                if index == 1:
+                    mirror_device = device_list[index]
+                devices.append(workflow.add_step(
+                    'device-%s-%d' % (volume['id'], index),
+                    run_for_volume,
+                    ([(volume['id'], 'device-%d' % index)], failures,
+                     journaled, self.rest.create_local_device,
+                     device_list[index], extent_list[index], geometry),
+                    requires=[extents[cluster_1ist[index]]]))
+            virtual_volume = workflow.add_step(
+                'virtual-volume-%s' % volume['id'], run_for_volume,
+                ([(volume['id'], 'virtual-volume')], failures, journaled,
+                 self.rest.create_virtual_volume, attach_device),
+                requires=devices[:1])
+            workflow.add_step(
+                'attach-mirror-%s' % volume['id'], run_for_volume,
+                ([(volume['id'], 'attach-mirror')], failures, journaled,
+                 self.rest.attach_mirror_device, attach_device,
+                 mirror_device),
+                requires=[virtual_volume] + devices[1:])
+        workflow.run()
+
+        for volume, __ in volumes:
+            if volume['id'] not in failures:
+                self.journal.forget(volume['id'], JOURNAL_CREATE)
+        LOG.debug("Created %(created)s of %(total)s volumes in "
+                  "%(delta).3fs.",
+                  {'created': len(volumes) - len(failures),
+                   'total': len(volumes),
+                   'delta': time.time() - start_time})
+        return dict((volume['id'], failures.get(volume['id']))
+                    for volume, __ in volumes)
+
+    def _build_create_workflow(self, volume, extra_specs):
+        """Define the provisioning workflow of one volume.
+
+        :param volume: the volume object
+        :param extra_specs: the volume extra specs
+        :returns: VPLEXWorkflow, journaled under the volume id
+        """
         cluster_1ist = extra_specs['array-info']['cluster_name']
         hard_list = extra_specs['array-info']['hards']
         storage_volume_list = extra_specs['array-info']['storage_volumes']
@@ -45,6 +1130,82 @@ class VPLEXAdapter(object):
         extent_list = extra_specs['volume_info']['extent']
         volume_name = extra_specs['volume_info']['volume_name']
         geometry = extra_specs['volume_info']['geometry']
+        # create volume for cluster-1/2
+        size = extra_specs['volume_info']['count']
+        attach_device = ''
+        mirror_device = ''
+        workflow = self._new_workflow('create-%s' % volume_name,
+                                      (volume['id'], JOURNAL_CREATE))
+        devices = []
+        for index in range(size):
+            if index == 0:
+                attach_device = device_list[index]
+            if index == 1:
+                mirror_device = device_list[index]
+            # the legs are independent until the mirror is attached
+            rediscover = workflow.add_step(
+                'rediscover-%d' % index, self.rest.rediscover_array,
+                (cluster_1ist[index], hard_list[index],
+                 [storage_volume_list[index]]))
+            claim = workflow.add_step(
+                'claim-%d' % index, self.rest.claim_storage_volume,
+                (lun_list[index], storage_volume_list[index]),
+                requires=[rediscover])
+            extent = workflow.add_step(
+                'extent-%d' % index, self.rest.create_extent,
+                (lun_list[index],), requires=[claim])
+            devices.append(workflow.add_step(
+                'device-%d' % index, self.rest.create_local_device,
+                (device_list[index], extent_list[index], geometry),
+                requires=[extent]))
+        virtual_volume = workflow.add_step(
+            'virtual-volume', self.rest.create_virtual_volume,
+            (attach_device,), requires=devices[:1])
+        workflow.add_step(
+            'attach-mirror', self.rest.attach_mirror_device,
+            (attach_device, mirror_device),
+            requires=[virtual_volume] + devices[1:])
+        return workflow
+
+    def _get_create_undo(self, extra_specs):
+        """Get the commands undoing each step of a volume create.
+
+        :param extra_specs: the volume extra specs
+        :returns: dict -- step name to (func, args)
+        """
+        lun_list = extra_specs['volume_info']['lun']
+        device_list = extra_specs['volume_info']['device']
+        extent_list = extra_specs['volume_info']['extent']
+        size = extra_specs['volume_info']['count']
+        undo = {'virtual-volume': (
+            self.rest.destroy_virtual_volume,
+            (extra_specs['volume_info']['volume_name'],))}
+        if size > 1:
+            undo['attach-mirror'] = (self.rest.detach_mirror_device,
+                                     (device_list[0], device_list[1]))
+        for index in range(size):
+            undo['claim-%d' % index] = (self.rest.unclaim_storage_volume,
+                                        (lun_list[index],))
+            undo['extent-%d' % index] = (self.rest.destroy_extent,
+                                         (extent_list[index],))
+            undo['device-%d' % index] = (self.rest.destroy_local_device,
+                                         (device_list[index],))
+        return undo
+
+    def _create_volume(self, volume, extra_specs):
+        """Create one volume with its own provisioning workflow.
+
+        Steps journaled by an earlier attempt are not run again.
+        :param volume: the volume object
+        :param extra_specs: the volume extra specs
+        """
+        hard_list = extra_specs['array-info']['hards']
+        storage_volume_list = extra_specs['array-info']['storage_volumes']
+        lun_list = extra_specs['volume_info']['lun']
+        device_list = extra_specs['volume_info']['device']
+        extent_list = extra_specs['volume_info']['extent']
+        volume_name = extra_specs['volume_info']['volume_name']
+        geometry = extra_specs['volume_info']['geometry']
         start_time = time.time()
         LOG.debug("Delete volume info: [volume :%(volume_name)s,"
                   "hards:%(hards)s, storage_volumes:%(storage_volumes)s"
@@ -58,44 +1219,115 @@ class VPLEXAdapter(object):
                    'extents': extent_list,
                    'geometry': geometry})
         try:
-            # create volume for cluster-1/2
-            size = extra_specs['volume_info']['count']
-            attach_device = ''
-            mirror_device = ''
-            for index in range(size):
-                if index == 0:
-                    attach_device = device_list[index]
-                if index == 1:
-                    mirror_device = device_list[index]
-                self.rest.re_discovery_arrays(cluster_1ist[index],
-                                              hard_list[index])
-                self.rest.claim_storage_volume(lun_list[index],
-                                               storage_volume_list[index])
-                self.rest.create_extent(lun_list[index])
-                self.rest.create_local_device(device_list[index],
-                                              extent_list[index],
-                                              geometry)
-
-            self.rest.create_virtual_volume(attach_device)
-            self.rest.attach_mirror_device(attach_device, mirror_device)
-            # update the attach mirror device date
-            self.mirror_device_date = time.time()
-            LOG.debug("Create volume took: %(delta)s H:MM:SS.",
-                      {'delta': self.utils.get_time_delta(start_time,
-                                                      time.time())})
+            workflow = self._build_create_workflow(volume, extra_specs)
+            resumed = workflow.get_journaled()
+            if resumed:
+                LOG.info("Resuming create of volume %(volume)s after "
+                         "steps %(steps)s.",
+                         {'volume': volume['id'], 'steps': resumed})
+            workflow.run()
+            self.journal.forget(volume['id'], JOURNAL_CREATE)
+            LOG.debug("Create volume took: %(delta).3fs.",
+                      {'delta': time.time() - start_time})
         except exception.VolumeBackendAPIException:
             raise
 
+    def _rollback_create(self, volume, extra_specs, completed):
+        """Undo the journaled steps of an unfinished volume create.
+
+        :param volume: the volume object
+        :param extra_specs: the volume extra specs
+        :param completed: the journaled create steps
+        """
+        LOG.info("Rolling back steps %(steps)s of the unfinished create "
+                 "of volume %(volume)s.",
+                 {'steps': completed, 'volume': volume['id']})
+        create = self._build_create_workflow(volume, extra_specs)
+        create.get_rollback(
+            'rollback-%s' % extra_specs['volume_info']['volume_name'],
+            self._get_create_undo(extra_specs), completed,
+            (volume['id'], JOURNAL_ROLLBACK)).run()
+        self.journal.forget(volume['id'])
+
+    def _destroy_leg_device(self, device, cluster, extent):
+        """Destroy the distributed and local device of one leg.
+
+        :param device: the device name
+        :param cluster: the cluster of the leg
+        :param extent: the extent of the leg
+        :returns: VPLEXJob of the local device destroy, or None
+        """
+        # the local device is only free once the distributed one is gone
+        self.rest.wait_for_job(self.rest.destroy_distributed_devices(device))
+        # the array names the local device left behind, so it is found
+        # through the extent it is built on
+        local_devices = self.rest.get_extent_devices(cluster, extent)
+        return self.rest.destroy_local_device(
+            local_devices[0] if local_devices else device)
+
+    def _get_delete_legs(self, extra_specs):
+        """Get the devices, extents and claims of each cluster leg.
+
+        :param extra_specs: the extra specifications
+        :returns: list -- one dict per leg
+        """
+        cluster_1ist = extra_specs['array-info']['cluster_name']
+        hard_list = extra_specs['array-info']['hards']
+        lun_list = extra_specs['volume_info']['lun']
+        device_list = extra_specs['volume_info']['device']
+        extent_list = extra_specs['volume_info']['extent']
+        size = extra_specs['volume_info']['count']
+        legs = []
+        # return device  cluster-1/2
+        for index in range(size):
+            legs.append({'device': device_list[index],
+                         'distributed': size > 1,
+                         'cluster': cluster_1ist[index],
+                         'extent': extent_list[index],
+                         'lun': lun_list[index],
+                         'hard': hard_list[index]})
+        return legs
+
+    def _add_leg_steps(self, workflow, legs, requires=()):
+        """Add the teardown chain of each cluster leg to a workflow.
+
+        :param workflow: the VPLEXWorkflow
+        :param legs: list -- the leg dicts
+        :param requires: the steps every chain waits for
+        """
+        for index, leg in enumerate(legs):
+            if leg['distributed']:
+                device = workflow.add_step(
+                    'destroy-device-%d' % index, self._destroy_leg_device,
+                    (leg['device'], leg['cluster'], leg['extent']),
+                    requires=requires)
+            else:
+                device = workflow.add_step(
+                    'destroy-device-%d' % index,
+                    self.rest.destroy_local_device,
+                    (leg['device'],), requires=requires)
+            extent = workflow.add_step(
+                'destroy-extent-%d' % index, self.rest.destroy_extent,
+                (leg['extent'],), requires=[device])
+            unclaim = workflow.add_step(
+                'unclaim-%d' % index, self.rest.unclaim_storage_volume,
+                (leg['lun'],), requires=[extent])
+            workflow.add_step(
+                'forget-%d' % index, self.rest.forget_storage_volume,
+                (leg['hard'],), requires=[unclaim])
+
     def delete_volume(self, volume, extra_specs):
         """delete volume
 
+        A volume whose create did not finish is rolled back from the
+        step journal instead, and an interrupted delete resumes after
+        its journaled steps. With deferred deletes the cluster legs are
+        queued for the reaper once the virtual volume is gone.
         :param volume:
         :param extra_specs:
         """
         volume_name = extra_specs['volume_info']['volume_name']
         cgName = extra_specs['volume_info']['cg_name']
-        hard_list = extra_specs['array-info']['hards']
-        lun_list = extra_specs['volume_info']['lun']
         device_list = extra_specs['volume_info']['device']
         extent_list = extra_specs['volume_info']['extent']
 
@@ -108,6 +1340,10 @@ class VPLEXAdapter(object):
                    'extents': extent_list})
 
         try:
+            created = self.journal.get_steps(volume['id'], JOURNAL_CREATE)
+            if created:
+                self._rollback_create(volume, extra_specs, created)
+                return
             attach_device = ''
             mirror_device = ''
             size = extra_specs['volume_info']['count']
@@ -116,27 +1352,59 @@ class VPLEXAdapter(object):
                     attach_device = device_list[index]
                 if index == 1:
                     mirror_device = device_list[index]
-            self.rest.consistency_group_remove_virtual_volumes(cgName,
-                                                               volume_name)
-            self.rest.destroy_virtual_volume(volume_name)
-            self.rest.detach_mirror_device(attach_device, mirror_device)
+            legs = self._get_delete_legs(extra_specs)
+            # the cluster legs are torn down independently once the
+            # mirror is detached, and one failing does not stop the other
+            workflow = self._new_workflow('delete-%s' % volume_name,
+                                          (volume['id'], JOURNAL_DELETE),
+                                          self.teardown_max_workers,
+                                          fail_fast=False)
+            remove = workflow.add_step(
+                'remove-from-cg',
+                self.rest.consistency_group_remove_virtual_volumes,
+                (cgName, volume_name))
+            destroy = workflow.add_step(
+                'destroy-virtual-volume', self.rest.destroy_virtual_volume,
+                (volume_name,), requires=[remove])
+            detach = workflow.add_step(
+                'detach-mirror', self.rest.detach_mirror_device,
+                (attach_device, mirror_device), requires=[destroy])
+            if self.reaper is not None:
+                workflow.run()
+                self.journal.queue_reap(volume['id'], legs)
+                LOG.debug("Queued the devices of volume %(volume)s for "
+                          "the reaper.", {'volume': volume_name})
+                return
+            self._add_leg_steps(workflow, legs, [detach])
+            workflow.run()
+            self.journal.forget(volume['id'])
 
-            # return device  cluster-1/2
-            for index in range(size):
-                if index == index:
-                    device_name_date = device_list[index] + \
-                                       self.mirror_device_date
+        except exception.VolumeBackendAPIException:
+            # keeps the failed steps the workflow reported
+            raise
+        except Exception as e:
+            exception_message = (_('Error deleting volume %(volume)s: '
+                                   '%(error)s')
+                                 % {'volume': volume_name, 'error': e})
+            LOG.exception(exception_message)
+            raise exception.VolumeBackendAPIException(
+                data=exception_message)
 
-                    self.rest.destroy_distributed_devices(device_list[index])
-                    self.rest.destroy_local_device(device_name_date)
-                else:
-                    self.rest.destroy_local_device(device_list[index])
-                self.rest.destroy_extent(extent_list[index])
-                self.rest.unclaim_storage_volume(lun_list[index])
-                self.rest.forget_storage_volume(hard_list[index])
+    def _reap_volume(self, volume_id, legs):
+        """Tear down the cluster legs of a deferred delete.
 
-        except Exception:
-            raise exception.VolumeBackendAPIException
+        The steps are journaled under the volume's delete, so a reap
+        interrupted by a restart resumes after its completed steps.
+        :param volume_id: the volume id
+        :param legs: list -- the leg dicts queued by delete_volume
+        """
+        workflow = self._new_workflow('reap-%s' % volume_id,
+                                      (volume_id, JOURNAL_DELETE),
+                                      self.teardown_max_workers,
+                                      fail_fast=False)
+        self._add_leg_steps(workflow, legs)
+        workflow.run()
+        self.journal.forget(volume_id)
 
     def create_consistencygroup(self, group, extra_specs):
         """Creates a consistency group.
@@ -168,13 +1436,22 @@ class VPLEXAdapter(object):
                    'delay': delay,
                    'volume_name': volume_name})
         try:
-            self.rest.create_consistency_group(cg_name, cluster_name)
-            self.rest.set_consistency_group_visibility(attributes, visibility)
-            self.rest.set_detachrule_to_consistency_group(cluster_name,
-                                                          delay,
-                                                          cg_name)
-            self.rest.add_virtualvolumes_to_consistency_group(volume_name,
-                                                              cg_name)
+            workflow = self._new_workflow('create-cg-%s' % cg_name)
+            create = workflow.add_step(
+                'create', self.rest.create_consistency_group,
+                (cg_name, cluster_name))
+            workflow.add_step(
+                'set-visibility', self.rest.set_consistency_group_visibility,
+                (attributes, visibility), requires=[create])
+            workflow.add_step(
+                'set-detach-rule',
+                self.rest.set_detachrule_to_consistency_group,
+                (cluster_name, delay, cg_name), requires=[create])
+            workflow.add_step(
+                'add-volumes',
+                self.rest.add_virtualvolumes_to_consistency_group,
+                (volume_name, cg_name), requires=[create])
+            workflow.run()
         except Exception:
             raise
 
@@ -193,6 +1470,9 @@ class VPLEXAdapter(object):
     def check_and_create_storage_view(self, volume, extraSpecs):
         """check_and_create_storage_view
 
+        Only the view, initiator, port and volume operations missing from
+        the current state of each view are issued. The volume is counted
+        on each host view, cancelling a pending teardown of the view.
         :param volume:
         :param maskingViewDict:
         """
@@ -217,27 +1497,217 @@ class VPLEXAdapter(object):
                        'virtual_volumes': virtual_volume})
             size = extraSpecs['volume_info']['count']
             for index in range(size):
-                self.rest.create_export_storage_view(cluster_1ist[index],
-                                                     sv_name[index],
-                                                     ports[index])
-                self.rest.register_export_initiator_port(
-                        cluster_1ist[index],
-                        initiator_port[index],
-                        port[index])
-                self.rest.addinitiatorport_to_export_storage_view\
-                    (sv_name[index], initiator_port[index])
-                self.rest.addport_to_export_storage_view(sv_name[index],
-                                                         ports[index])
-                self.rest.addvirtualvolume_to_export_storage_view(
-                        sv_name[index], virtual_volume)
+                self.host_views.acquire(cluster_1ist[index], sv_name[index],
+                                        virtual_volume)
+            workflow = self._new_workflow('create-views-%s' % virtual_volume)
+            for index in range(size):
+                diff = self._diff_storage_view(
+                    cluster_1ist[index], sv_name[index], ports[index],
+                    initiator_port[index], virtual_volume)
+                LOG.debug('Storage view %(view)s on %(cluster)s needs '
+                          '%(diff)s.',
+                          {'view': sv_name[index],
+                           'cluster': cluster_1ist[index],
+                           'diff': diff})
+                # the view and the initiator are independent until the
+                # initiator is added to the view
+                view = []
+                if diff['create_view']:
+                    view.append(workflow.add_step(
+                        'create-view-%d' % index,
+                        self.rest.create_export_storage_view,
+                        (cluster_1ist[index], sv_name[index],
+                         ports[index])))
+                initiator = []
+                if diff['register_initiator']:
+                    initiator.append(workflow.add_step(
+                        'register-initiator-%d' % index,
+                        self.rest.register_export_initiator_port,
+                        (cluster_1ist[index], initiator_port[index],
+                         port[index])))
+                if diff['add_initiator']:
+                    workflow.add_step(
+                        'add-initiator-%d' % index,
+                        self.rest.addinitiatorport_to_export_storage_view,
+                        (sv_name[index], initiator_port[index]),
+                        requires=view + initiator)
+                if diff['add_ports']:
+                    workflow.add_step(
+                        'add-port-%d' % index,
+                        self.rest.addport_to_export_storage_view,
+                        (sv_name[index], ','.join(diff['add_ports'])),
+                        requires=view)
+                if diff['add_volume']:
+                    workflow.add_step(
+                        'add-volume-%d' % index, self._add_volume_to_view,
+                        (cluster_1ist[index], sv_name[index],
+                         virtual_volume), requires=view)
+            workflow.run()
         except Exception:
+            for index in range(extraSpecs['volume_info']['count']):
+                self.host_views.release(cluster_1ist[index], sv_name[index],
+                                        virtual_volume)
             raise
 
+    def _add_volume_to_view(self, cluster, view, virtual_volume):
+        """Add a volume to a view, batched with concurrent attaches.
+
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param virtual_volume: the virtual volume name
+        """
+        self._submit_view_batch(
+            self._attach_batchers,
+            self.rest.addvirtualvolume_to_export_storage_view, cluster,
+            view, virtual_volume, self.attach_batch_window,
+            self.attach_batch_size)
+
+    def _remove_volume_from_view(self, cluster, view, virtual_volume):
+        """Remove a volume from a view, batched with concurrent detaches.
+
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param virtual_volume: the virtual volume name
+        """
+        self._submit_view_batch(
+            self._detach_batchers, self._remove_volumes_from_view, cluster,
+            view, virtual_volume, self.detach_batch_window,
+            self.detach_batch_size)
+
+    def _remove_volumes_from_view(self, view, virtual_volumes):
+        """Remove comma separated volumes from a view in one command.
+
+        :param view: the storage view name
+        :param virtual_volumes: the comma separated volume names
+        :returns: VPLEXJob or None
+        """
+        return self.rest.removevirtualvolume_export_storage_view(
+            virtual_volumes, view)
+
+    def _submit_view_batch(self, batchers, command, cluster, view,
+                           virtual_volume, window, max_size):
+        """Queue a volume for a multi-volume storage view command.
+
+        Volumes queued for the same view within the window are sent as
+        one comma separated --virtual-volumes list. A view's batcher is
+        dropped once no volume is queued for it.
+        :param batchers: dict of (cluster, view) to its batcher and the
+                         number of volumes queued
+        :param command: the rest command, called with the view and the
+                        comma separated volumes
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param virtual_volume: the virtual volume name
+        :param window: the batch window in seconds, 0 to not batch
+        :param max_size: the maximum volumes in one command
+        :raises: the failure of this volume's command
+        """
+        if window <= 0:
+            self.rest.wait_for_job(command(view, virtual_volume))
+            return
+        key = (cluster, view)
+        with self._view_batchers_lock:
+            entry = batchers.get(key)
+            if entry is None:
+                entry = batchers[key] = {
+                    'batcher': vplex_rest.VPLEXRequestBatcher(
+                        functools.partial(self._run_view_batch, command,
+                                          view),
+                        window, max_size),
+                    'queued': 0}
+            entry['queued'] += 1
+        try:
+            entry['batcher'].submit(virtual_volume)
+        finally:
+            with self._view_batchers_lock:
+                entry['queued'] -= 1
+                if not entry['queued']:
+                    del batchers[key]
+
+    def _run_view_batch(self, command, view, virtual_volumes):
+        """Run one multi-volume storage view command.
+
+        When the grouped command fails every volume falls back to its
+        own command, so only the volume at fault fails.
+        :param command: the rest command, called with the view and the
+                        comma separated volumes
+        :param view: the storage view name
+        :param virtual_volumes: the queued volume names
+        :returns: list -- None or the exception, for each queued volume
+        """
+        volumes = []
+        for virtual_volume in virtual_volumes:
+            if virtual_volume not in volumes:
+                volumes.append(virtual_volume)
+        try:
+            self.rest.wait_for_job(command(view, ','.join(volumes)))
+            return [None] * len(virtual_volumes)
+        except Exception as e:
+            if len(volumes) == 1:
+                return [e] * len(virtual_volumes)
+            LOG.warning('Grouped %(command)s of %(count)s volumes on '
+                        '%(view)s failed, retrying them one by one: '
+                        '%(error)s',
+                        {'command': command.__name__,
+                         'count': len(volumes),
+                         'view': view,
+                         'error': e})
+        results = {}
+        for virtual_volume in volumes:
+            try:
+                self.rest.wait_for_job(command(view, virtual_volume))
+                results[virtual_volume] = None
+            except Exception as e:
+                results[virtual_volume] = e
+        return [results[virtual_volume]
+                for virtual_volume in virtual_volumes]
+
+    def _diff_storage_view(self, cluster, view, ports, initiator_port,
+                           virtual_volume):
+        """Compare a storage view with the state an attach needs.
+
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param ports: the front-end ports of the view, comma separated
+        :param initiator_port: the host initiator port
+        :param virtual_volume: the virtual volume to expose
+        :returns: dict -- the missing view, initiator registration,
+                  initiator membership, ports and volume
+        """
+        actual = self.rest.get_object('storage-views', cluster, view)
+        # an initiator in the view is registered, so it needs no lookup
+        registered = (
+            (actual is not None and
+             initiator_port in actual.get('initiators', [])) or
+            self.rest.get_object('initiator-ports', cluster,
+                                 initiator_port) is not None)
+        if actual is None:
+            # a new view is created with its ports
+            return {'create_view': True,
+                    'register_initiator': not registered,
+                    'add_initiator': True,
+                    'add_ports': [],
+                    'add_volume': True}
+        return {'create_view': False,
+                'register_initiator': not registered,
+                'add_initiator': (
+                    initiator_port not in actual.get('initiators', [])),
+                'add_ports': [
+                    view_port.strip() for view_port in ports.split(',')
+                    if view_port.strip() and
+                    view_port.strip() not in actual.get('ports', [])],
+                'add_volume': (
+                    virtual_volume not in actual.get('virtual-volumes', []))}
+
     def check_and_delete_storage_view(self, volume, extraSpecs):
         """check_and_delete_storage_view
 
+        The volume leaves each host view, in one command with concurrent
+        detaches from the same view. A view is torn down only when
+        no volume is left in it, after the teardown grace period.
         :param volume:
         """
+        cluster_1ist = extraSpecs['array-info']['cluster_name']
         sv_name = extraSpecs['volume_info']['sv_name']
         ports = extraSpecs['array_info']['port_group']
         initiator_port = extraSpecs['volume_info']['initiator_port']
@@ -252,70 +1722,186 @@ class VPLEXAdapter(object):
                        'initiator_port': initiator_port,
                        'virtual_volumes': virtual_volume})
             size = extraSpecs['volume_info']['count']
+            workflow = self._new_workflow('delete-views-%s' % virtual_volume)
+            for index in range(size):
+                workflow.add_step(
+                    'remove-volume-%d' % index,
+                    self._remove_volume_from_view,
+                    (cluster_1ist[index], sv_name[index], virtual_volume))
+            workflow.run()
             for index in range(size):
-                self.rest.removeinitiatorport_export_storage_view(
-                        sv_name[index], initiator_port[index])
-                self.rest.removeport_export_storage_view(
-                        sv_name[index], ports[index])
-                self.rest.removevirtualvolume_export_storage_view(
-                        virtual_volume, sv_name[index])
-                self.rest.destroy_export_storage_view(sv_name[index])
-                self.rest.unregister_export_initiator_port(
-                        initiator_port[index])
+                self._release_host_view(
+                    cluster_1ist[index], sv_name[index], ports[index],
+                    initiator_port[index], virtual_volume)
         except Exception:
             raise
 
+    def _release_host_view(self, cluster, view, ports, initiator_port,
+                           virtual_volume):
+        """Schedule the teardown of a host view the volume left empty.
+
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param ports: the front-end ports of the view
+        :param initiator_port: the host initiator port
+        :param virtual_volume: the virtual volume that left the view
+        """
+        if self.host_views.release(cluster, view, virtual_volume):
+            return
+        actual = self.rest.get_object('storage-views', cluster, view)
+        if actual is None or actual.get('virtual-volumes'):
+            return
+        self.host_views.schedule_teardown(
+            cluster, view,
+            functools.partial(self._teardown_host_view, cluster, view,
+                              ports, initiator_port))
+
+    def _teardown_host_view(self, cluster, view, ports, initiator_port):
+        """Remove an unused host view with its ports and initiator.
+
+        :param cluster: the cluster name
+        :param view: the storage view name
+        :param ports: the front-end ports of the view
+        :param initiator_port: the host initiator port
+        """
+        actual = self.rest.get_object('storage-views', cluster, view)
+        if actual is None or actual.get('virtual-volumes'):
+            # already gone, or in use again
+            return
+        LOG.info('Tearing down unused storage view %(view)s on '
+                 '%(cluster)s.', {'view': view, 'cluster': cluster})
+        workflow = self._new_workflow('teardown-%s' % view)
+        remove_initiator = workflow.add_step(
+            'remove-initiator',
+            self.rest.removeinitiatorport_export_storage_view,
+            (view, initiator_port))
+        remove_port = workflow.add_step(
+            'remove-port', self.rest.removeport_export_storage_view,
+            (view, ports))
+        workflow.add_step(
+            'destroy-view', self.rest.destroy_export_storage_view, (view,),
+            requires=[remove_initiator, remove_port])
+        if self._is_initiator_unused(cluster, view, initiator_port):
+            # the initiator can go once it has left the view
+            workflow.add_step(
+                'unregister-initiator',
+                self.rest.unregister_export_initiator_port,
+                (initiator_port,), requires=[remove_initiator])
+        workflow.run()
+
+    def _is_initiator_unused(self, cluster, view, initiator_port):
+        """Check that no other view on the cluster uses an initiator.
+
+        :param cluster: the cluster name
+        :param view: the storage view being torn down
+        :param initiator_port: the host initiator port
+        :returns: bool -- True also when the views are not known yet
+        """
+        if not self.rest.inventory.is_loaded('storage-views', cluster):
+            return True
+        return not [entry for entry in self.rest.inventory.find_by_member(
+                    'storage-views', 'initiators', initiator_port, cluster)
+                    if entry['name'] != view]
+
+    def _get_cluster_capacity(self, cluster):
+        """Sum the storage-volume capacity of one cluster.
+
+        :param cluster: the cluster name
+        :returns: dict -- total, provisioned and free capacity in GB
+        """
+        with self.rest.deadline(vplex_rest.VPLEXDeadline(
+                self.cluster_stats_timeout,
+                'Listing the storage of %s' % cluster)):
+            storages_json = self.rest.get_details_from_storage(cluster)
+        storage_list = storages_json['attributes']
+        total_capacity_gb = 0
+        provisioned_capacity_gb = 0
+        free_capacity_gb = 0
+        for storage in storage_list:
+            if storage['Use'] == 'use' or storage['Use'] == 'claim':
+                total_capacity_gb += storage['Capacity']
+            elif storage['Use'] == 'use':
+                provisioned_capacity_gb += storage['Capacity']
+            else:
+                free_capacity_gb += storage['Capacity']
+        return {'total_capacity_gb': total_capacity_gb,
+                'provisioned_capacity_gb': provisioned_capacity_gb,
+                'free_capacity_gb': free_capacity_gb}
+
+    def _fetch_cluster_capacity(self, cluster, finished):
+        try:
+            finished.put((cluster, self._get_cluster_capacity(cluster),
+                          None))
+        except Exception as error:
+            finished.put((cluster, None, error))
+
     def get_details_from_storage(self, cluster_list):
         """get detils from storage
 
+        The clusters are listed concurrently, each within
+        cluster_stats_timeout, and the smallest is reported. Clusters
+        that fail or time out are left out; the result then has partial
+        set and names them in missing_clusters. Listings still running
+        when the wait ends are killed.
         :param cluster_list:
         :return:
         """
         storages_info = {}
-        size = len(cluster_list)
         min_storage = sys.maxsize
         detail_dict = {}
-        try:
-            for index in range(size):
-                storages_json = self.rest.get_details_from_storage(
-                        cluster_list[index])
-                storage_list = storages_json['attributes']
-                total_capacity_gb = 0
-                provisioned_capacity_gb = 0
-                free_capacity_gb = 0
-                reserved_percentage = 0
-                for storage in storage_list:
-                    if storage['Use'] == 'use' or storage['Use'] == 'claim':
-                        total_capacity_gb += storage['Capacity']
-                    elif storage['Use'] == 'use':
-                        provisioned_capacity_gb += storage['Capacity']
-                    else:
-                        free_capacity_gb += storage['Capacity']
-                if min_storage > total_capacity_gb:
-                    min_storage = total_capacity_gb
-                    reserved_percentage = round(free_capacity_gb /
-                                                total_capacity_gb * 100, 2)
-                    detail_dict.update({'total_capacity_gb':
-                                            total_capacity_gb})
-                    detail_dict.update({'provisioned_capacity_gb':
-                                            provisioned_capacity_gb})
-                    detail_dict.update({'free_capacity_gb': free_capacity_gb})
-                    detail_dict.update({'reserved_percentage':
-                                            reserved_percentage})
-            LOG.debug('details of storages:{ total_capacity_gb: '
-                      '%(total_capacity_gb)s,'
-                      'provisioned_capacity_gb: %(provisioned_capacity_gb)s,'
-                      'free_capacity_gb: %(free_capacity_gb)s，'
-                      'reserved_percentage: %(reserved_percentage)s',
-                      {'total_capacity_gb': total_capacity_gb,
-                       'provisioned_capacity_gb': provisioned_capacity_gb,
-                       'free_capacity_gb': free_capacity_gb,
-                       'reserved_percentage': reserved_percentage})
-            storages_info.update(detail_dict)
-        except Exception:
-            raise
+        missing_clusters = list(cluster_list)
+        if cluster_list:
+            pool = greenpool.GreenPool(len(cluster_list))
+            finished = eventlet_queue.LightQueue()
+            fetch = self.rest.propagate_context(self._fetch_cluster_capacity)
+            fetches = [pool.spawn(fetch, cluster, finished)
+                       for cluster in cluster_list]
+            expires = time.time() + self.cluster_stats_timeout
+            try:
+                for __ in cluster_list:
+                    try:
+                        cluster, capacity, error = finished.get(
+                            timeout=max(0, expires - time.time()))
+                    except eventlet_queue.Empty:
+                        break
+                    if error is not None:
+                        LOG.warning('Listing the storage of %(cluster)s '
+                                    'failed: %(error)s.',
+                                    {'cluster': cluster, 'error': error})
+                        continue
+                    missing_clusters.remove(cluster)
+                    total_capacity_gb = capacity['total_capacity_gb']
+                    if min_storage > total_capacity_gb:
+                        min_storage = total_capacity_gb
+                        reserved_percentage = round(
+                            capacity['free_capacity_gb'] /
+                            total_capacity_gb * 100, 2)
+                        detail_dict.update(capacity)
+                        detail_dict.update({'reserved_percentage':
+                                                reserved_percentage})
+            finally:
+                # listings still running past the wait are not needed
+                for thread in fetches:
+                    thread.kill()
+        if not detail_dict:
+            exception_message = (
+                _('No VPLEX cluster of %(clusters)s returned its storage.')
+                % {'clusters': cluster_list})
+            LOG.error(exception_message)
+            raise exception.VolumeBackendAPIException(
+                data=exception_message)
+        if missing_clusters:
+            LOG.warning('VPLEX capacity stats are partial; clusters '
+                        '%(clusters)s failed or timed out.',
+                        {'clusters': missing_clusters})
+        LOG.debug('details of storages:{ total_capacity_gb: '
+                  '%(total_capacity_gb)s,'
+                  'provisioned_capacity_gb: %(provisioned_capacity_gb)s,'
+                  'free_capacity_gb: %(free_capacity_gb)s，'
+                  'reserved_percentage: %(reserved_percentage)s',
+                  detail_dict)
+        storages_info.update(detail_dict)
+        storages_info.update({'partial': bool(missing_clusters),
+                              'missing_clusters': missing_clusters})
 
         return storages_info
-
-
-
@@ -35,7 +35,182 @@ vplex_opts = [
                default=CINDER_EMC_CONFIG_FILE,
                deprecated_for_removal=True,
                help='Use this file for cinder emc plugin '
-                    'config data.')]
+                    'config data.'),
+    cfg.IntOpt('vplex_rest_pool_size',
+               default=10,
+               help='Maximum number of pooled HTTPS connections kept '
+                    'open to each VPLEX management server.'),
+    cfg.BoolOpt('vplex_rest_keep_alive',
+                default=True,
+                help='Keep HTTPS connections to the VPLEX management '
+                     'server open and reuse them across requests.'),
+    cfg.IntOpt('vplex_rest_cache_ttl',
+               default=10,
+               help='Seconds a VPLEX GET response is served from the '
+                    'read cache. 0 disables the cache.'),
+    cfg.IntOpt('vplex_rest_cache_size',
+               default=256,
+               help='Maximum number of VPLEX GET responses held in the '
+                    'read cache.'),
+    cfg.DictOpt('vplex_rest_cache_ttls',
+                default={},
+                help='Per resource type read cache TTLs in seconds, '
+                     'e.g. ll:5. Overrides vplex_rest_cache_ttl.'),
+    cfg.IntOpt('vplex_job_poll_min_interval',
+               default=1,
+               help='Shortest interval in seconds between polls of '
+                    'asynchronous VPLEX jobs.'),
+    cfg.IntOpt('vplex_job_poll_max_interval',
+               default=30,
+               help='Longest interval in seconds between polls of '
+                    'asynchronous VPLEX jobs.'),
+    cfg.IntOpt('vplex_job_timeout',
+               default=3600,
+               help='Seconds after which an asynchronous VPLEX job that '
+                    'has not finished is marked failed.'),
+    cfg.IntOpt('vplex_rest_retries',
+               default=3,
+               help='Number of times a VPLEX REST request is retried '
+                    'after a transient failure.'),
+    cfg.FloatOpt('vplex_rest_retry_interval',
+                 default=1.0,
+                 help='Base backoff in seconds between VPLEX REST '
+                      'retries. It doubles on each attempt and is '
+                      'jittered.'),
+    cfg.FloatOpt('vplex_rest_retry_max_interval',
+                 default=30.0,
+                 help='Upper bound in seconds on the backoff between '
+                      'VPLEX REST retries.'),
+    cfg.IntOpt('vplex_rest_max_concurrent',
+               default=8,
+               help='Maximum number of concurrent REST requests sent to '
+                    'each VPLEX management server.'),
+    cfg.FloatOpt('vplex_rest_rate_limit',
+                 default=0,
+                 help='Maximum REST requests per second sent to each '
+                      'VPLEX management server. 0 disables rate '
+                      'limiting.'),
+    cfg.IntOpt('vplex_rest_rate_burst',
+               help='Number of REST requests that may be sent to a VPLEX '
+                    'management server in a burst above '
+                    'vplex_rest_rate_limit. Defaults to the rate.'),
+    cfg.IntOpt('vplex_rest_breaker_threshold',
+               default=5,
+               help='Consecutive failed requests after which a VPLEX '
+                    'management server is taken out of rotation.'),
+    cfg.IntOpt('vplex_rest_breaker_cooldown',
+               default=30,
+               help='Seconds a VPLEX management server stays out of '
+                    'rotation before a trial request is let through.'),
+    cfg.IntOpt('vplex_rest_timeout',
+               default=60,
+               help='HTTP timeout in seconds of a single VPLEX REST '
+                    'request.'),
+    cfg.IntOpt('vplex_operation_timeout',
+               default=1800,
+               help='Time budget in seconds for all VPLEX REST calls of '
+                    'a volume or consistency group create or delete.'),
+    cfg.IntOpt('vplex_connection_timeout',
+               default=300,
+               help='Time budget in seconds for all VPLEX REST calls of '
+                    'an attach or detach.'),
+    cfg.StrOpt('vplex_rest_metrics_exporter',
+               help='Class path of an exporter that is handed a snapshot '
+                    'of the VPLEX REST request metrics periodically, e.g. '
+                    'cinder.volume.drivers.dell_emc.vplex.rest.'
+                    'VPLEXLogMetricsExporter.'),
+    cfg.IntOpt('vplex_rest_metrics_interval',
+               default=300,
+               help='Seconds between VPLEX REST metrics exports. 0 '
+                    'disables exporting.'),
+    cfg.IntOpt('vplex_workflow_max_workers',
+               default=4,
+               deprecated_name='vplex_max_parallel_legs',
+               help='Maximum number of independent VPLEX workflow steps, '
+                    'such as the cluster legs of a volume, run '
+                    'concurrently.'),
+    cfg.FloatOpt('vplex_create_batch_window',
+                 default=0,
+                 help='Seconds single volume creates wait to be merged '
+                      'into one bulk VPLEX provisioning call. Each create '
+                      'keeps its own deadline. 0, the default, disables '
+                      'merging.'),
+    cfg.IntOpt('vplex_create_batch_size',
+               default=50,
+               help='Maximum number of volume creates merged into one '
+                    'bulk VPLEX provisioning call.'),
+    cfg.IntOpt('vplex_rediscovery_ttl',
+               default=300,
+               help='Seconds a completed VPLEX array rediscovery is reused '
+                    'before the array is rediscovered again. A storage '
+                    'volume the cluster does not see is always '
+                    'rediscovered.'),
+    cfg.StrOpt('vplex_journal_path',
+               help='Path of the SQLite journal recording the completed '
+                    'VPLEX provisioning steps of each volume. Defaults to '
+                    'vplex_journal.sqlite under state_path.'),
+    cfg.IntOpt('vplex_inventory_interval',
+               default=300,
+               help='Seconds over which the in-memory VPLEX inventory '
+                    'refreshes every object listing of every cluster once. '
+                    '0 disables the background refresh.'),
+    cfg.IntOpt('vplex_view_teardown_delay',
+               default=300,
+               help='Seconds a host storage view left without volumes is '
+                    'kept before it is torn down. An attach within that '
+                    'time reuses the view. 0 tears it down at once.'),
+    cfg.FloatOpt('vplex_attach_batch_window',
+                 default=0,
+                 help='Seconds attaches to the same VPLEX storage view wait '
+                      'to be merged into one addvirtualvolume call. 0, the '
+                      'default, disables merging.'),
+    cfg.IntOpt('vplex_attach_batch_size',
+               default=32,
+               help='Maximum number of volumes added to a VPLEX storage '
+                    'view in one addvirtualvolume call.'),
+    cfg.FloatOpt('vplex_detach_batch_window',
+                 default=0,
+                 help='Seconds detaches from the same VPLEX storage view '
+                      'wait to be merged into one removevirtualvolume call. '
+                      '0, the default, disables merging.'),
+    cfg.IntOpt('vplex_detach_batch_size',
+               default=32,
+               help='Maximum number of volumes removed from a VPLEX storage '
+                    'view in one removevirtualvolume call.'),
+    cfg.IntOpt('vplex_teardown_max_workers',
+               default=2,
+               help='Maximum number of VPLEX teardown steps, such as the '
+                    'cluster legs of a deleted volume, run concurrently.'),
+    cfg.BoolOpt('vplex_deferred_delete',
+                default=False,
+                help='Return from a volume delete once the virtual volume '
+                     'is destroyed, and tear down its devices, extents and '
+                     'claims in the background.'),
+    cfg.IntOpt('vplex_reaper_interval',
+               default=30,
+               help='Seconds between runs of the deferred-delete reaper.'),
+    cfg.IntOpt('vplex_reaper_batch_size',
+               default=5,
+               help='Maximum number of deleted volumes torn down in one run '
+                    'of the deferred-delete reaper.'),
+    cfg.IntOpt('vplex_stats_interval',
+               default=60,
+               help='Seconds between background refreshes of the VPLEX '
+                    'capacity stats. 0 fetches them on every stats poll.'),
+    cfg.IntOpt('vplex_stats_jitter',
+               default=15,
+               help='Maximum random seconds added to each capacity stats '
+                    'refresh interval.'),
+    cfg.IntOpt('vplex_stats_refresh_threshold',
+               default=1000,
+               help='GB provisioned or deleted since the last capacity '
+                    'stats refresh that trigger an early refresh. 0 '
+                    'disables early refreshes.'),
+    cfg.IntOpt('vplex_cluster_stats_timeout',
+               default=60,
+               help='Seconds each VPLEX cluster has to return its storage '
+                    'listing for the capacity stats. A cluster that takes '
+                    'longer is left out and the stats are flagged partial.')]
 
 CONF.register_opts(vplex_opts, group=configuration.SHARED_CONF_GROUP)
 
@@ -56,9 +231,18 @@ class VMAXCommon(object):
         self.protocol = protocol
         self.configuration = configuration
         self.configuration.append_config_values(vplex_opts)
-        self.rest = rest.VPLEXRest()
+        self.rest = rest.VPLEXRest(self.configuration)
         self.utils = utils.VPLEXUtils()
-        self.adapter = adapter.VPLEXAdapter(protocol, self.rest)
+        self.adapter = adapter.VPLEXAdapter(self.configuration, self.rest)
+        self.stats_collector = adapter.VPLEXStatsCollector(
+            self._collect_stats,
+            rest.get_config_value(self.configuration, 'vplex_stats_interval',
+                                  adapter.DEFAULT_STATS_INTERVAL),
+            rest.get_config_value(self.configuration, 'vplex_stats_jitter',
+                                  adapter.DEFAULT_STATS_JITTER),
+            rest.get_config_value(self.configuration,
+                                  'vplex_stats_refresh_threshold',
+                                  adapter.DEFAULT_STATS_REFRESH_THRESHOLD))
         self.version = version
         self._gather_info()
 
@@ -99,8 +283,23 @@ class VMAXCommon(object):
         arrayinfo = self.get_attributes_from_vplex_config()
         self.vplex_info['arrayinfo'] = arrayinfo
 
+    def _collect_stats(self, cluster_list):
+        """Fetch the capacity stats of the clusters from the array.
+
+        :param cluster_list: the cluster names
+        :returns: dict -- the capacity stats
+        """
+        with self._operation_deadline('Update volume stats',
+                                      'vplex_connection_timeout'):
+            return self.adapter.get_details_from_storage(cluster_list)
+
     def update_volume_stats(self):
-        """Retrieve stats info."""
+        """Retrieve stats info.
+
+        The stats come from the background collector's latest snapshot,
+        and stats_age_seconds gives its age. Only the first poll waits
+        for the array.
+        """
         # Dictionary to hold the arrays for which the vplex details
         # have already been queried.
         backend_name = self.vplex_info['backend_name']
@@ -112,8 +311,11 @@ class VMAXCommon(object):
             cluster_list.append(cluster)
         self.rest.set_rest_credentials(array_info)
 
-        volume_dict = self.adapter.get_details_from_storage(
-                cluster_list)
+        volume_dict, stats_age = self.stats_collector.get_snapshot()
+        if volume_dict is None or self.stats_collector.interval <= 0:
+            volume_dict = self.stats_collector.refresh(cluster_list)
+            stats_age = 0
+        self.stats_collector.start(cluster_list)
         total_capacity_gb = volume_dict['total_capacity_gb']
         free_capacity_gb = volume_dict['free_capacity_gb']
         provisioned_capacity_gb = volume_dict['provisioned_capacity_gb']
@@ -128,10 +330,29 @@ class VMAXCommon(object):
                 'total_capacity_gb': total_capacity_gb,
                 'free_capacity_gb': free_capacity_gb,
                 'provisioned_capacity_gb': provisioned_capacity_gb,
-                'reserved_percentage': array_reserve_percent}
+                'reserved_percentage': array_reserve_percent,
+                'stats_age_seconds': round(stats_age, 1),
+                'stats_partial': volume_dict.get('partial', False)}
 
         return data_dict
 
+    def _operation_deadline(self, operation,
+                            timeout_option='vplex_operation_timeout'):
+        """Start the time budget for one Cinder operation.
+
+        Every VPLEX REST call made within the returned context takes its
+        HTTP timeout from the remaining budget and is refused once the
+        budget is spent.
+        :param operation: the operation name, for error messages
+        :param timeout_option: the option holding the budget in seconds
+        :returns: context manager
+        """
+        budget = self.configuration.safe_get(timeout_option)
+        if budget is None:
+            # the option is not registered, so there is no budget
+            return self.rest.deadline(None)
+        return self.rest.deadline(rest.VPLEXDeadline(budget, operation))
+
     def _get_volume_extra_specs(self, volume, group, connector,
                                 workload, slo, count):
         """ get volume extra specs
@@ -293,12 +514,47 @@ class VMAXCommon(object):
         extra_specs = self._initial_setup(volume)
         try:
             LOG.info("Beginning create volume process")
-            self.adapter.create_volume(
-                volume, extra_specs)
+            with self._operation_deadline('Create volume'):
+                self.adapter.create_volume(
+                    volume, extra_specs)
+            self.stats_collector.record_change(volume['size'])
         except Exception:
             LOG.error("Create volume failed..")
             raise
 
+    def create_volumes(self, volumes):
+        """Creates many EMC(VPLEX) volumes together
+
+        :param volumes: list of volume objects
+        :returns: list -- a model update with the id and status of each
+                  volume
+        """
+        volume_requests = []
+        model_updates = []
+        for volume in volumes:
+            try:
+                volume_requests.append((volume, self._initial_setup(volume)))
+            except Exception:
+                LOG.exception("Create volume %(volume)s failed.",
+                              {'volume': volume['id']})
+                model_updates.append({'id': volume['id'],
+                                      'status': 'error'})
+        LOG.info("Beginning create volumes process")
+        with self._operation_deadline('Create volumes'):
+            results = self.adapter.create_volumes(volume_requests)
+        self.stats_collector.record_change(sum(
+            volume['size'] for volume, __ in volume_requests
+            if results[volume['id']] is None))
+        for volume, __ in volume_requests:
+            error = results[volume['id']]
+            if error is not None:
+                LOG.error("Create volume %(volume)s failed: %(error)s.",
+                          {'volume': volume['id'], 'error': error})
+            model_updates.append({'id': volume['id'],
+                                  'status': 'error' if error is not None
+                                  else 'available'})
+        return model_updates
+
     def delete_volume(self, volume):
         """Deletes a EMC(VPLEX) volume
 
@@ -306,7 +562,9 @@ class VMAXCommon(object):
         """
         extra_specs = self._initial_setup(volume)
         LOG.info("Beginning create volume process")
-        self.adapter.delete_volume(volume, extra_specs)
+        with self._operation_deadline('Delete volume'):
+            self.adapter.delete_volume(volume, extra_specs)
+        self.stats_collector.record_change(volume['size'])
         LOG.info("The @(volume)s has been deleted .",
                  {'volume': volume})
 
@@ -320,8 +578,9 @@ class VMAXCommon(object):
         extraSpecs = self._initial_setup(None, group)
         try:
             LOG.info("Beginning create consistency group process")
-            self.provision.create_consistency_group(
-                group, extraSpecs)
+            with self._operation_deadline('Create consistency group'):
+                self.provision.create_consistency_group(
+                    group, extraSpecs)
             LOG.info("created the @(cgName)s consistency group.",
                      {'cgName': group})
         except Exception:
@@ -340,8 +599,9 @@ class VMAXCommon(object):
 
         try:
             LOG.info("Beginning delete consistency group process")
-            self.adapter.delete_consistency_group(group,
-                                                    extraSpecs)
+            with self._operation_deadline('Delete consistency group'):
+                self.adapter.delete_consistency_group(group,
+                                                      extraSpecs)
         except Exception:
             exceptionMessage = (_(
                 "Failed to delete consistency group: %(cgName)s.")
@@ -368,7 +628,10 @@ class VMAXCommon(object):
                  {'volume': volume})
         extraSpecs = self._initial_setup(volume, None, connector)
         try:
-            self.adapter.check_and_create_storage_view(volume, extraSpecs)
+            with self._operation_deadline('Initialize connection',
+                                          'vplex_connection_timeout'):
+                self.adapter.check_and_create_storage_view(volume,
+                                                           extraSpecs)
         except Exception:
             exception_message = (_(
                         "Unable to attach because of the "
@@ -386,4 +649,6 @@ class VMAXCommon(object):
         LOG.info("Terminate connection: %(volume)s.",
                  {'volume': volume['name']})
         extraSpecs = self._initial_setup(volume, None, connector)
-        self.adapter.check_and_delete_storage_view(volume, extraSpecs)
\ No newline at end of file
+        with self._operation_deadline('Terminate connection',
+                                      'vplex_connection_timeout'):
+            self.adapter.check_and_delete_storage_view(volume, extraSpecs)
\ No newline at end of file
@@ -13,11 +13,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import bisect
+import collections
+import contextlib
+import copy
+import json
+import random
+import re
+import threading
+import time
+
 from oslo_log import log as logging
+from oslo_service import loopingcall
+from oslo_utils import importutils
 
 from cinder import exception
 from cinder.i18n import _
 import requests
+from requests import adapters as requests_adapters
 from requests.auth import HTTPBasicAuth
 import six
 
@@ -32,27 +45,1785 @@ STATUS_200 = 200
 STATUS_201 = 201
 STATUS_202 = 202
 STATUS_204 = 204
+STATUS_404 = 404
+
+# Connection pool defaults
+DEFAULT_POOL_SIZE = 10
+
+# Read cache defaults, in seconds and entries
+DEFAULT_CACHE_TTL = 10
+DEFAULT_CACHE_SIZE = 256
+
+# VPLEX context namespaces changed by each mutating CLI command. A cached
+# read whose context path contains one of these is invalidated when the
+# command runs. Commands not listed here invalidate the whole cache.
+CACHE_NAMESPACES = {
+    're-disvovery+arrays': ('storage-volumes',),
+    'storage-volume': ('storage-volumes',),
+    'extent': ('extents', 'storage-volumes'),
+    'local-device': ('devices', 'extents'),
+    'virtual-volume': ('virtual-volumes', 'devices'),
+    'device': ('devices', 'distributed-devices'),
+    'ds+dd': ('distributed-devices', 'devices'),
+    'consistency-group': ('consistency-groups', 'virtual-volumes'),
+    'set': ('consistency-groups',),
+    'export+storage-view': ('storage-views',),
+    'export+initiator-port': ('initiator-ports', 'storage-views'),
+}
+
+# Asynchronous job polling defaults, in seconds
+JOB_POLL_MIN_INTERVAL = 1
+JOB_POLL_MAX_INTERVAL = 30
+JOB_TIMEOUT = 3600
+
+# Seconds a completed array rediscovery is reused
+DEFAULT_REDISCOVERY_TTL = 300
+
+# Inventory object types, by their context under /clusters/<cluster>
+INVENTORY_CONTEXTS = collections.OrderedDict([
+    ('storage-volumes', 'storage-elements/storage-volumes'),
+    ('extents', 'storage-elements/extents'),
+    ('devices', 'devices'),
+    ('virtual-volumes', 'virtual-volumes'),
+    ('consistency-groups', 'consistency-groups'),
+    ('storage-views', 'exports/storage-views'),
+    ('initiator-ports', 'exports/initiator-ports'),
+])
+
+# Seconds over which every inventory listing is refreshed once
+DEFAULT_INVENTORY_INTERVAL = 300
+
+# Inventory updates made in place by a successful CLI command: action,
+# object type, name options, name template, attribute, value options
+INVENTORY_MUTATIONS = {
+    'storage-volume+claim': (
+        'add', 'storage-volumes', ('-n',), '%s', 'vpd-id', ('-d',)),
+    'storage-volume+unclaim': (
+        'remove', 'storage-volumes', ('-d',), '%s', None, None),
+    'extent+create': ('add', 'extents', ('-d',), 'extent_%s_1', None, None),
+    'local-device+create': ('add', 'devices', ('-n',), '%s', None, None),
+    'virtual-volume+create': (
+        'add', 'virtual-volumes', ('--device',), '%s_vol',
+        'supporting-device', ('--device',)),
+    'consistency-group+create': (
+        'add', 'consistency-groups', ('--name',), '%s', None, None),
+    'export+storage-view+create': (
+        'add', 'storage-views', ('--name',), '%s', 'ports', ('--ports',)),
+    'export+initiator-port+register': (
+        'add', 'initiator-ports', ('--initiator-port',), '%s', None, None),
+    'export+storage-view+addinitiatorport': (
+        'add-member', 'storage-views', ('--view',), '%s', 'initiators',
+        ('--initiator-ports',)),
+    'export+storage-view+addport': (
+        'add-member', 'storage-views', ('--view',), '%s', 'ports',
+        ('--ports',)),
+    'export+storage-view+addvirtualvolume': (
+        'add-member', 'storage-views', ('--view',), '%s', 'virtual-volumes',
+        ('--virtual-volumes',)),
+    'export+storage-view+removeinitiatorport': (
+        'remove-member', 'storage-views', ('--view',), '%s', 'initiators',
+        ('--initiator-ports',)),
+    'export+storage-view+removeport': (
+        'remove-member', 'storage-views', ('--view',), '%s', 'ports',
+        ('--ports',)),
+    'export+storage-view+removevirtualvolume': (
+        'remove-member', 'storage-views', ('--view',), '%s',
+        'virtual-volumes', ('--virtual-volumes',)),
+    'virtual-volume+destroy': (
+        'remove', 'virtual-volumes', ('--virtual-volumes',), '%s', None,
+        None),
+    'local-device+destroy': ('remove', 'devices', ('-d',), '%s', None, None),
+    'extent+destroy': ('remove', 'extents', ('-s',), '%s', None, None),
+    'consistency-group+destroy': (
+        'remove', 'consistency-groups', ('--consistency-groups',), '%s',
+        None, None),
+    'export+storage-view+destroy': (
+        'remove', 'storage-views', ('--view',), '%s', None, None),
+    'export+initiator-port+unregister': (
+        'remove', 'initiator-ports', ('--initiator-port',), '%s', None,
+        None),
+}
+
+# Object attributes holding a list of member names
+INVENTORY_MEMBER_ATTRIBUTES = ('initiators', 'ports', 'virtual-volumes')
+
+# Asynchronous job states
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+# Retry defaults, in seconds
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_INTERVAL = 1
+DEFAULT_RETRY_MAX_INTERVAL = 30
+
+# Retry classification of a failed request
+RETRY_SAFE = 'safe'
+RETRY_AMBIGUOUS = 'ambiguous'
+# the server did not process the request
+RETRY_SAFE_STATUS_CODES = (503,)
+# a gateway failed, the server may or may not have processed it
+RETRY_AMBIGUOUS_STATUS_CODES = (502, 504)
+
+# Mutating CLI commands that can be resent without side effects
+IDEMPOTENT_COMMANDS = frozenset([
+    're-disvovery+arrays',
+    'set',
+    'consistency-group+set-detach-rule+winner',
+])
+
+# How to tell whether a non-idempotent command already took effect:
+# (ll context path, args option naming the object, object should exist)
+COMMAND_PROBES = {
+    'storage-volume+claim': (
+        '/clusters/*/storage-elements/storage-volumes/%s', ('-n',), True),
+    'extent+create': (
+        '/clusters/*/storage-elements/extents/extent_%s_1', ('-d',), True),
+    'local-device+create': ('/clusters/*/devices/%s', ('-n',), True),
+    'virtual-volume+create': (
+        '/clusters/*/virtual-volumes/%s_vol', ('--device',), True),
+    'consistency-group+create': (
+        '/clusters/*/consistency-groups/%s', ('--name',), True),
+    'export+storage-view+create': (
+        '/clusters/*/exports/storage-views/%s', ('--name',), True),
+    'export+initiator-port+register': (
+        '/clusters/*/exports/initiator-ports/%s', ('--initiator-port',),
+        True),
+    'virtual-volume+destroy': (
+        '/clusters/*/virtual-volumes/%s', ('--virtual-volumes',), False),
+    'ds+dd+destroy': (
+        '/distributed-storage/distributed-devices/%s',
+        ('--distributed-devices',), False),
+    'local-device+destroy': ('/clusters/*/devices/%s', ('-d',), False),
+    'extent+destroy': (
+        '/clusters/*/storage-elements/extents/%s', ('-s',), False),
+    'consistency-group+destroy': (
+        '/clusters/*/consistency-groups/%s', ('--consistency-groups',),
+        False),
+    'export+storage-view+destroy': (
+        '/clusters/*/exports/storage-views/%s', ('--view',), False),
+    'export+initiator-port+unregister': (
+        '/clusters/*/exports/initiator-ports/%s', ('--initiator-port',),
+        False),
+}
+
+# How the management server reports a lookup of a missing object
+NOT_FOUND_STATUS_CODES = (STATUS_404,)
+NOT_FOUND_MESSAGES = ('not found', 'does not exist', 'no such')
+
+# Per management server limiter defaults
+DEFAULT_MAX_CONCURRENT = 8
+DEFAULT_RATE_LIMIT = 0
+
+# Limiter lanes
+READ_LANE = 'read'
+WRITE_LANE = 'write'
+
+# Management server health tracking
+ENDPOINT_EWMA_WEIGHT = 0.3
+# how far a recent error rate inflates an endpoint's latency score
+ENDPOINT_ERROR_PENALTY = 10
+
+# Circuit breaker defaults
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_COOLDOWN = 30
+
+# Circuit breaker states
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+# Per request HTTP timeout default, in seconds
+DEFAULT_REQUEST_TIMEOUT = 60
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def get_config_value(configuration, name, default):
+    """Get a driver option, falling back to a default.
+
+    :param configuration: the driver configuration, or None
+    :param name: the option name
+    :param default: the value used when the option is not set
+    :returns: the option value
+    """
+    if not hasattr(configuration, 'safe_get'):
+        return default
+    value = configuration.safe_get(name)
+    if value is None:
+        return default
+    return value
+
+
+class VPLEXResponseCache(object):
+    """Read-through LRU cache for VPLEX GET responses.
+
+    Entries expire after a per resource type TTL and the least recently
+    used entry is evicted once max_size is reached. Each entry remembers
+    the context path segments it was read from so that mutating commands
+    can invalidate only the namespaces they touch.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE,
+                 default_ttl=DEFAULT_CACHE_TTL, ttls=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # bumped on every invalidation so reads that raced a write are
+        # not stored
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_ttl(self, resource_type):
+        """Get the TTL in seconds for a resource type.
+
+        :param resource_type: the resource type e.g. ll
+        :returns: int -- ttl, 0 disables caching
+        """
+        return int(self.ttls.get(resource_type, self.default_ttl))
 
+    def get(self, key):
+        """Look up an entry.
 
-class VPLEXRest(object):
+        :param key: the cache key
+        :returns: tuple -- (found, message)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            # refresh the LRU position
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return True, copy.deepcopy(entry['message'])
+
+    def put(self, key, resource_type, message, segments, generation=None):
+        """Store a response.
+
+        :param key: the cache key
+        :param resource_type: the resource type
+        :param message: the server response
+        :param segments: the context path segments of the read
+        :param generation: the cache generation when the read started
+        """
+        ttl = self.get_ttl(resource_type)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = {'message': copy.deepcopy(message),
+                                  'segments': segments,
+                                  'expires': time.time() + ttl}
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, namespaces=None):
+        """Drop entries read from the given namespaces.
+
+        :param namespaces: namespaces to drop, None drops everything
+        """
+        with self._lock:
+            self.generation += 1
+            if namespaces is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                return
+            stale = [key for key, entry in self._entries.items()
+                     if entry['segments'].intersection(namespaces)]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def get_stats(self):
+        """Get the cache counters.
+
+        :returns: dict -- hits, misses, evictions, invalidations, size
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'size': len(self._entries)}
+
+
+class VPLEXDeadline(object):
+    """A time budget shared by every REST call of one Cinder operation.
+
+    Each request takes its HTTP timeout from the remaining budget, and
+    no request is started once the budget is spent.
+    """
+
+    def __init__(self, budget, operation=None):
+        self.budget = budget
+        self.operation = operation
+        self.expires = time.time() + budget
+
+    def remaining(self):
+        """Get the seconds left in the budget.
+
+        :returns: float
+        """
+        return max(0.0, self.expires - time.time())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        """Abort once the budget is spent.
+
+        :raises: VolumeBackendAPIException
+        """
+        if self.expired:
+            exception_message = (
+                _('%(operation)s exceeded its deadline of %(budget)s '
+                  'seconds.')
+                % {'operation': self.operation or 'The operation',
+                   'budget': self.budget})
+            LOG.error(exception_message)
+            raise exception.VolumeBackendAPIException(
+                data=exception_message)
+
+    def get_timeout(self, timeout=None):
+        """Bound a timeout by the remaining budget.
+
+        :param timeout: the timeout in seconds, None for no own limit
+        :returns: float -- seconds
+        :raises: VolumeBackendAPIException if the budget is spent
+        """
+        self.check()
+        if timeout is None:
+            return self.remaining()
+        return min(timeout, self.remaining())
+
+
+class VPLEXRetryPolicy(object):
+    """Exponential backoff with full jitter for transient failures."""
+
+    def __init__(self, retries=DEFAULT_RETRIES,
+                 interval=DEFAULT_RETRY_INTERVAL,
+                 max_interval=DEFAULT_RETRY_MAX_INTERVAL):
+        self.retries = retries
+        self.interval = interval
+        self.max_interval = max_interval
+
+    def get_delay(self, attempt):
+        """Get the delay before the next attempt.
+
+        :param attempt: the number of the attempt that just failed
+        :returns: float -- seconds
+        """
+        ceiling = min(self.max_interval,
+                      self.interval * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+
+class VPLEXEndpointLimiter(object):
+    """Concurrency and rate limiter for one management server.
+
+    At most max_concurrent requests are in flight. Callers that find no
+    free slot queue in FIFO order in a read or a write lane, and freed
+    slots are handed to the lanes in turn so neither starves the other.
+    A token bucket of rate requests per second, holding up to burst
+    tokens, additionally paces requests; a rate of 0 disables it.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT,
+                 rate=DEFAULT_RATE_LIMIT, burst=None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._refilled = time.time()
+        self._in_flight = 0
+        self._queues = {READ_LANE: collections.deque(),
+                        WRITE_LANE: collections.deque()}
+        self._next_lane = READ_LANE
+        self._stats = {lane: {'requests': 0, 'queued': 0,
+                              'wait_time': 0.0, 'max_wait_time': 0.0}
+                       for lane in self._queues}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def limit(self, lane, timeout=None):
+        """Hold a request slot for the duration of the block.
+
+        :param lane: READ_LANE or WRITE_LANE
+        :param timeout: seconds to wait for the slot, None waits forever
+        """
+        self.acquire(lane, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self, lane, timeout=None):
+        """Wait for a request slot and a rate token.
+
+        :param lane: READ_LANE or WRITE_LANE
+        :param timeout: seconds to wait, None waits forever
+        :raises: VolumeBackendAPIException on timeout
+        """
+        start = time.time()
+        waiter = None
+        with self._lock:
+            if (self._in_flight < self.max_concurrent and
+                    not any(self._queues.values())):
+                self._in_flight += 1
+            else:
+                waiter = threading.Event()
+                self._queues[lane].append(waiter)
+                self._stats[lane]['queued'] += 1
+        if waiter is not None and not waiter.wait(timeout):
+            with self._lock:
+                # release() may have handed the slot over meanwhile
+                timed_out = waiter in self._queues[lane]
+                if timed_out:
+                    self._queues[lane].remove(waiter)
+            if timed_out:
+                self._raise_timeout(lane, timeout)
+        try:
+            self._take_token(
+                None if timeout is None
+                else max(0.0, timeout - (time.time() - start)))
+        except exception.VolumeBackendAPIException:
+            self.release()
+            raise
+        waited = time.time() - start
+        with self._lock:
+            stats = self._stats[lane]
+            stats['requests'] += 1
+            stats['wait_time'] += waited
+            stats['max_wait_time'] = max(stats['max_wait_time'], waited)
+
+    def release(self):
+        """Free a request slot, handing it to the next queued caller."""
+        with self._lock:
+            waiter = self._pop_waiter()
+            if waiter is None:
+                self._in_flight -= 1
+        if waiter is not None:
+            waiter.set()
+
+    def _pop_waiter(self):
+        """Pop the next waiter, alternating between the lanes.
+
+        Called with the lock held.
+        :returns: threading.Event or None
+        """
+        lanes = [self._next_lane,
+                 WRITE_LANE if self._next_lane == READ_LANE else READ_LANE]
+        for lane in lanes:
+            if self._queues[lane]:
+                self._next_lane = lanes[1] if lane == lanes[0] else lanes[0]
+                return self._queues[lane].popleft()
+        return None
+
+    @staticmethod
+    def _raise_timeout(lane, timeout):
+        exception_message = (
+            _('Timed out after %(timeout).1f seconds waiting for a '
+              '%(lane)s request slot.')
+            % {'timeout': timeout, 'lane': lane})
+        LOG.error(exception_message)
+        raise exception.VolumeBackendAPIException(data=exception_message)
+
+    def _take_token(self, timeout=None):
+        """Take one token from the bucket, sleeping until one is free.
+
+        :param timeout: seconds to wait, None waits forever
+        :raises: VolumeBackendAPIException on timeout
+        """
+        if not self.rate:
+            return
+        start = time.time()
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    float(self.burst),
+                    self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            if timeout is not None and time.time() - start + delay > timeout:
+                self._raise_timeout('rate', timeout)
+            time.sleep(delay)
+
+    def get_stats(self):
+        """Get queue depth and wait time metrics.
+
+        :returns: dict -- in-flight count and per lane metrics
+        """
+        with self._lock:
+            stats = {'in_flight': self._in_flight,
+                     'max_concurrent': self.max_concurrent}
+            for lane, lane_stats in self._stats.items():
+                lane_stats = dict(lane_stats)
+                lane_stats['queue_depth'] = len(self._queues[lane])
+                lane_stats['average_wait_time'] = (
+                    lane_stats['wait_time'] / lane_stats['requests']
+                    if lane_stats['requests'] else 0.0)
+                stats[lane] = lane_stats
+            return stats
+
+
+class VPLEXCircuitBreaker(object):
+    """Circuit breaker guarding one management server.
+
+    After failure_threshold consecutive failures the breaker opens and
+    requests are refused for cooldown seconds. It then goes half-open and
+    lets a single trial request through: success closes it, failure opens
+    it again.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_BREAKER_THRESHOLD,
+                 cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """Move an open breaker to half-open once cooled down.
+
+        Called with the lock held.
+        """
+        if (self.state == BREAKER_OPEN and
+                time.time() - self.opened >= self.cooldown):
+            self.state = BREAKER_HALF_OPEN
+            self._trial_in_flight = False
+
+    def available(self):
+        """Check, without claiming it, whether a request may be sent.
+
+        :returns: boolean
+        """
+        with self._lock:
+            self._refresh()
+            if self.state == BREAKER_OPEN:
+                return False
+            return not (self.state == BREAKER_HALF_OPEN and
+                        self._trial_in_flight)
+
+    def allow_request(self):
+        """Claim permission to send a request.
+
+        In the half-open state only the first caller gets the trial.
+        :returns: boolean
+        """
+        with self._lock:
+            self._refresh()
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != BREAKER_CLOSED:
+                LOG.info("Circuit breaker closed after a successful "
+                         "trial request.")
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == BREAKER_HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self.state != BREAKER_OPEN:
+                    LOG.warning("Circuit breaker opened after %(count)s "
+                                "failures.", {'count': self.failures})
+                self.state = BREAKER_OPEN
+                self.opened = time.time()
+                self._trial_in_flight = False
+
+    def release_trial(self):
+        """Give back a half-open trial that was claimed but not sent."""
+        with self._lock:
+            if self.state == BREAKER_HALF_OPEN:
+                self._trial_in_flight = False
+
+
+class VPLEXEndpoint(object):
+    """A VPLEX management server and its observed health.
+
+    Latency and error rate are exponentially weighted moving averages
+    over the requests sent to the server; a lower score is healthier.
+    Consecutive failures trip the endpoint's circuit breaker.
+    """
+
+    def __init__(self, base_uri, user, passwd, breaker=None):
+        self.base_uri = base_uri
+        self.user = user
+        self.passwd = passwd
+        self.breaker = breaker or VPLEXCircuitBreaker()
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, failed):
+        """Record the outcome of a request.
+
+        :param latency: seconds the request took
+        :param failed: whether it failed at the transport or server level
+        """
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.failures += 1
+            sample = 1.0 if failed else 0.0
+            self.error_rate += ENDPOINT_EWMA_WEIGHT * (
+                sample - self.error_rate)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += ENDPOINT_EWMA_WEIGHT * (
+                    latency - self.latency)
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    @property
+    def score(self):
+        return ((self.latency or 0.0) *
+                (1 + ENDPOINT_ERROR_PENALTY * self.error_rate) +
+                self.error_rate)
+
+    def get_stats(self):
+        """Get the health metrics.
+
+        :returns: dict -- latency, error rate and counters
+        """
+        with self._lock:
+            return {'latency': self.latency,
+                    'error_rate': self.error_rate,
+                    'requests': self.requests,
+                    'failures': self.failures,
+                    'breaker': self.breaker.state}
+
+
+class VPLEXSingleFlight(object):
+    """Coalesce concurrent identical calls into one in-flight call.
+
+    The first caller for a key runs the call; callers arriving with the
+    same key while it is in flight wait for it and receive a copy of its
+    result, or its exception.
+    """
 
     def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Run func for key unless an identical call is in flight.
+
+        :param key: the call key
+        :param func: the callable
+        :returns: the result of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(),
+                        'result': None,
+                        'error': None}
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return copy.deepcopy(call['result'])
+        try:
+            result = func(*args, **kwargs)
+            call['result'] = copy.deepcopy(result)
+            return result
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+
+    def get_stats(self):
+        """Get the coalescing counters.
+
+        :returns: dict -- coalesced and in-flight counts
+        """
+        with self._lock:
+            return {'coalesced': self.coalesced,
+                    'in_flight': len(self._calls)}
+
+
+class VPLEXRequestBatcher(object):
+    """Merge requests submitted within a short window into one call.
+
+    The first submit() opens a window of window seconds. Every item
+    submitted before it closes, up to max_size, is passed to
+    handler(items) in one list. The handler returns one result per
+    item; an exception instance fails only its own item. Each caller
+    blocks until its own result is ready.
+    """
+
+    def __init__(self, handler, window, max_size):
+        self.handler = handler
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.batches = 0
+        self.items = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """Submit one item and wait for its result.
+
+        :param item: the request item
+        :returns: the handler result for the item
+        :raises: the exception the handler returned for the item
+        """
+        entry = {'item': item, 'event': threading.Event(), 'result': None}
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = []
+            batch.append(entry)
+            full = len(batch) >= self.max_size
+            if full:
+                self._pending = None
+        if full:
+            self._run(batch)
+        elif leader:
+            time.sleep(self.window)
+            with self._lock:
+                # a full batch was already run by the caller filling it
+                owner = self._pending is batch
+                if owner:
+                    self._pending = None
+            if owner:
+                self._run(batch)
+        entry['event'].wait()
+        if isinstance(entry['result'], Exception):
+            raise entry['result']
+        return entry['result']
+
+    def _run(self, batch):
+        try:
+            results = self.handler([entry['item'] for entry in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        with self._lock:
+            self.batches += 1
+            self.items += len(batch)
+        for entry, result in zip(batch, results):
+            entry['result'] = result
+            entry['event'].set()
+
+    def get_stats(self):
+        """Get the batching counters.
+
+        :returns: dict -- batches run, items and items pending
+        """
+        with self._lock:
+            return {'batches': self.batches,
+                    'items': self.items,
+                    'pending': len(self._pending or ())}
+
+
+class VPLEXJob(object):
+    """A long-running command the management server accepted with a 202.
+
+    Callers can block on wait() or register a callback with
+    add_done_callback(); VPLEXJobTracker completes the job.
+    """
+
+    def __init__(self, operation, job_uri, message=None):
+        self.operation = operation
+        self.job_uri = job_uri
+        self.message = message
+        self.status = JOB_RUNNING
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self._callbacks = []
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status != JOB_RUNNING
+
+    def add_done_callback(self, callback):
+        """Call callback(job) once the job has finished.
+
+        :param callback: the callable, run at once if already finished
+        """
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None, cancelled=None):
+        """Block until the job has finished.
+
+        :param timeout: seconds to wait, None waits for the tracker
+        :param cancelled: callable checked between polls, raising when
+                          the wait is cancelled
+        :returns: the final server response
+        :raises: VolumeBackendAPIException
+        """
+        if cancelled is None:
+            self._event.wait(timeout)
+        else:
+            end_time = None if timeout is None else time.time() + timeout
+            while not self.done:
+                cancelled()
+                interval = JOB_POLL_MIN_INTERVAL
+                if end_time is not None:
+                    interval = min(interval, end_time - time.time())
+                    if interval <= 0:
+                        break
+                self._event.wait(interval)
+        if not self.done:
+            exception_message = (
+                _('Timed out waiting for %(operation)s job %(job)s.')
+                % {'operation': self.operation, 'job': self.job_uri})
+            raise exception.VolumeBackendAPIException(
+                data=exception_message)
+        if self.status == JOB_FAILED:
+            raise exception.VolumeBackendAPIException(data=self.error)
+        return self.message
+
+    def complete(self, status, message=None, error=None):
+        """Record the outcome and release waiters and callbacks.
+
+        :param status: JOB_SUCCEEDED or JOB_FAILED
+        :param message: the final server response
+        :param error: the error text for a failed job
+        """
+        with self._lock:
+            self.status = status
+            self.message = message
+            self.error = error
+            self.finished = time.time()
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                LOG.exception("Callback for %(operation)s job %(job)s "
+                              "failed.", {'operation': self.operation,
+                                          'job': self.job_uri})
+
+
+class VPLEXJobTracker(object):
+    """Track accepted jobs and poll them from a single periodic loop.
+
+    All outstanding jobs are checked on each tick of one
+    DynamicLoopingCall. The interval starts at min_interval, doubles up
+    to max_interval while no job changes state, and drops back when one
+    does or a new job is tracked. The loop stops when nothing is left.
+    """
+
+    def __init__(self, rest, min_interval=JOB_POLL_MIN_INTERVAL,
+                 max_interval=JOB_POLL_MAX_INTERVAL, timeout=JOB_TIMEOUT):
+        self.rest = rest
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self._interval = min_interval
+        self._jobs = []
+        self._poller = None
+        self._lock = threading.Lock()
+
+    def track(self, operation, job_uri, message=None):
+        """Start tracking an accepted job.
+
+        :param operation: the operation description
+        :param job_uri: the job status uri from the Location header
+        :param message: the 202 response body
+        :returns: VPLEXJob
+        """
+        job = VPLEXJob(operation, job_uri, message)
+        if not job_uri:
+            LOG.warning("%(operation)s was accepted without a job "
+                        "location, it cannot be tracked.",
+                        {'operation': operation})
+            job.complete(JOB_SUCCEEDED, message)
+            return job
+        with self._lock:
+            self._jobs.append(job)
+            self._interval = self.min_interval
+            if self._poller is None:
+                self._poller = loopingcall.DynamicLoopingCall(self._poll)
+                self._poller.start(initial_delay=self.min_interval,
+                                   periodic_interval_max=self.max_interval)
+        LOG.debug("Tracking %(operation)s job %(job)s.",
+                  {'operation': operation, 'job': job_uri})
+        return job
+
+    def get_outstanding(self):
+        """Get the jobs that have not finished yet.
+
+        :returns: list -- VPLEXJob
+        """
+        with self._lock:
+            return list(self._jobs)
+
+    def _poll(self):
+        """Check every outstanding job once.
+
+        :returns: float -- seconds until the next check
+        """
+        progressed = False
+        for job in self.get_outstanding():
+            try:
+                status_code, message = self.rest.request(GET, job.job_uri)
+            except exception.VolumeBackendAPIException:
+                status_code, message = None, None
+            # a timed-out or failed poll says nothing about the job, it is
+            # polled again on the next tick
+            if (status_code is None or status_code == STATUS_202 or
+                    status_code >= 500):
+                if time.time() - job.submitted > self.timeout:
+                    job.complete(JOB_FAILED, message,
+                                 _('Job %(job)s did not finish within '
+                                   '%(timeout)s seconds.')
+                                 % {'job': job.job_uri,
+                                    'timeout': self.timeout})
+            else:
+                try:
+                    self.rest.check_status_code_and_message_success(
+                        job.operation, status_code, message)
+                    job.complete(JOB_SUCCEEDED, message)
+                except exception.VolumeBackendAPIException as e:
+                    job.complete(JOB_FAILED, message, six.text_type(e))
+            if job.done:
+                progressed = True
+                LOG.debug("%(operation)s job %(job)s %(status)s.",
+                          {'operation': job.operation, 'job': job.job_uri,
+                           'status': job.status})
+        with self._lock:
+            self._jobs = [job for job in self._jobs if not job.done]
+            if not self._jobs:
+                self._poller = None
+                raise loopingcall.LoopingCallDone()
+            if progressed:
+                self._interval = self.min_interval
+            else:
+                self._interval = min(self._interval * 2, self.max_interval)
+            return self._interval
+
+
+class VPLEXRestMetrics(object):
+    """In-process instrumentation of VPLEX REST requests.
+
+    Keeps a latency histogram per resource type and method, counters of
+    status codes and bytes transferred, and an in-flight gauge. Each
+    request costs one lock and a bisect, so it can stay on in production.
+    export() hands a snapshot to every registered exporter, any object
+    with an export(snapshot) method.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._status_codes = collections.defaultdict(int)
+        self._bytes_sent = 0
+        self._bytes_received = 0
+        self._in_flight = 0
+        self._max_in_flight = 0
+        self._exporters = []
+        self._lock = threading.Lock()
+
+    def register_exporter(self, exporter):
+        """Add an exporter.
+
+        :param exporter: object with an export(snapshot) method
+        """
+        self._exporters.append(exporter)
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+
+    def request_finished(self, resource_type, method, latency, status,
+                         bytes_sent=0, bytes_received=0):
+        """Record a finished request.
+
+        :param resource_type: the CLI command or request kind
+        :param method: the http method
+        :param latency: seconds the request took
+        :param status: the status code, or the error kind
+        :param bytes_sent: request body size
+        :param bytes_received: response body size
+        """
+        index = bisect.bisect_left(self.buckets, latency)
+        key = (resource_type, method)
+        with self._lock:
+            self._in_flight -= 1
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {'counts': [0] * (len(self.buckets) + 1),
+                             'count': 0, 'sum': 0.0, 'max': 0.0}
+                self._histograms[key] = histogram
+            histogram['counts'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += latency
+            histogram['max'] = max(histogram['max'], latency)
+            self._status_codes[status] += 1
+            self._bytes_sent += bytes_sent
+            self._bytes_received += bytes_received
+
+    def snapshot(self):
+        """Get a copy of the collected metrics.
+
+        :returns: dict
+        """
+        with self._lock:
+            latency = {}
+            for (resource_type, method), histogram in (
+                    self._histograms.items()):
+                latency['%(res)s %(method)s' % {
+                    'res': resource_type, 'method': method}] = {
+                    'buckets': dict(zip(
+                        [six.text_type(bound) for bound in self.buckets] +
+                        ['+Inf'], histogram['counts'])),
+                    'count': histogram['count'],
+                    'sum': histogram['sum'],
+                    'max': histogram['max']}
+            return {'latency': latency,
+                    'status_codes': dict(self._status_codes),
+                    'bytes_sent': self._bytes_sent,
+                    'bytes_received': self._bytes_received,
+                    'in_flight': self._in_flight,
+                    'max_in_flight': self._max_in_flight}
+
+    def export(self):
+        """Hand a snapshot to every registered exporter."""
+        snapshot = self.snapshot()
+        for exporter in self._exporters:
+            try:
+                exporter.export(snapshot)
+            except Exception:
+                LOG.exception("VPLEX REST metrics exporter %(exporter)s "
+                              "failed.", {'exporter': exporter})
+
+
+class VPLEXLogMetricsExporter(object):
+    """Metrics exporter writing each snapshot to the log."""
+
+    def export(self, snapshot):
+        LOG.info("VPLEX REST metrics: %(metrics)s",
+                 {'metrics': snapshot})
+
+
+class VPLEXInventory(object):
+    """In-memory index of the objects on each VPLEX cluster.
+
+    Objects are indexed by type and name and by VPD83 id. A background
+    loop refreshes one (cluster, type) listing per tick, stale listings
+    first, so every listing is refreshed once per interval. Between
+    refreshes the driver's own commands update the index in place, and
+    the commands run while a listing is read are applied again on top
+    of it.
+    """
+
+    def __init__(self, rest, interval=DEFAULT_INVENTORY_INTERVAL):
+        self.rest = rest
+        self.interval = interval
+        self.clusters = []
+        # object type -> name -> cluster -> object
+        self._objects = dict((object_type, {})
+                             for object_type in INVENTORY_CONTEXTS)
+        self._by_vpd = {}
+        # (cluster, object type) -> time of the last refresh
+        self._refreshed = {}
+        self._stale = set()
+        # object type -> the commands applied while it is being listed
+        self._mutations = collections.defaultdict(list)
+        self._listing = collections.defaultdict(int)
+        self._refresher = None
+        self._lock = threading.Lock()
+
+    def start(self, clusters):
+        """Start refreshing the inventory of the given clusters.
+
+        :param clusters: the cluster names
+        """
+        with self._lock:
+            self.clusters = list(clusters)
+            if self._refresher is not None or self.interval <= 0:
+                return
+            self._refresher = loopingcall.DynamicLoopingCall(
+                self._refresh_next)
+            self._refresher.start(initial_delay=0,
+                                  periodic_interval_max=self.interval)
+
+    @staticmethod
+    def _normalize_vpd(vpd_id):
+        vpd_id = six.text_type(vpd_id).lower()
+        if vpd_id.startswith('vpd83t3:'):
+            vpd_id = vpd_id[len('vpd83t3:'):]
+        return vpd_id
+
+    @staticmethod
+    def _normalize_members(values):
+        if not values:
+            return []
+        if isinstance(values, six.string_types):
+            # storage view volumes are listed as (lun,name,vpd-id,size),
+            # so the tuples are found before the list is split
+            values = (re.findall(r'\([^)]*\)', values) or
+                      values.split(','))
+        members = []
+        for value in values:
+            value = value.strip()
+            if value.startswith('('):
+                fields = value.strip('()').split(',')
+                value = fields[1].strip() if len(fields) > 1 else ''
+            if value:
+                members.append(value)
+        return members
+
+    def _add(self, object_type, name, cluster, attributes):
+        for attribute in INVENTORY_MEMBER_ATTRIBUTES:
+            if attribute in attributes:
+                attributes[attribute] = self._normalize_members(
+                    attributes[attribute])
+        entry = {'type': object_type, 'name': name, 'cluster': cluster,
+                 'attributes': attributes}
+        clusters = self._objects[object_type].setdefault(name, {})
+        if cluster is not None:
+            # an object first seen without its cluster has now been found
+            clusters.pop(None, None)
+        clusters[cluster] = entry
+        if attributes.get('vpd-id'):
+            # each cluster sees a storage volume under the same VPD id
+            vpd_clusters = self._by_vpd.setdefault(
+                self._normalize_vpd(attributes['vpd-id']), {})
+            if cluster is not None:
+                vpd_clusters.pop(None, None)
+            vpd_clusters[cluster] = entry
+        return entry
+
+    def _remove(self, object_type, name, cluster=None):
+        clusters = self._objects[object_type].get(name, {})
+        for entry_cluster in list(clusters):
+            if cluster is not None and entry_cluster != cluster:
+                continue
+            entry = clusters.pop(entry_cluster)
+            vpd_id = entry['attributes'].get('vpd-id')
+            if vpd_id:
+                vpd_clusters = self._by_vpd.get(self._normalize_vpd(vpd_id),
+                                                {})
+                vpd_clusters.pop(entry_cluster, None)
+                if not vpd_clusters:
+                    self._by_vpd.pop(self._normalize_vpd(vpd_id), None)
+        if not clusters:
+            self._objects[object_type].pop(name, None)
+
+    @staticmethod
+    def _parse_objects(message):
+        """Get the attributes of each object in an ll response.
+
+        :param message: the server response
+        :returns: list -- dict of attribute name to value, per object
+        """
+        try:
+            contexts = message['response']['context']
+        except (KeyError, TypeError):
+            return []
+        objects = []
+        for context in contexts or []:
+            attributes = dict(
+                (attribute.get('name'), attribute.get('value'))
+                for attribute in context.get('attributes') or [])
+            if attributes.get('name'):
+                objects.append(attributes)
+        return objects
+
+    def refresh(self, cluster, object_type):
+        """List one object type on one cluster and replace its entries.
+
+        The commands applied while the listing was read may or may not
+        show in it, so they are applied again on top of it.
+        :param cluster: the cluster name
+        :param object_type: the inventory object type
+        """
+        path = ('/clusters/%(cluster)s/%(context)s/*'
+                % {'cluster': cluster,
+                   'context': INVENTORY_CONTEXTS[object_type]})
+        with self._lock:
+            self._listing[object_type] += 1
+            start = len(self._mutations[object_type])
+        try:
+            message = self.rest.get_resource('ll', {'args': path},
+                                             use_cache=False)
+            objects = self._parse_objects(message)
+            with self._lock:
+                self._stale.discard((cluster, object_type))
+                for name, clusters in list(
+                        self._objects[object_type].items()):
+                    if cluster in clusters:
+                        self._remove(object_type, name, cluster)
+                for attributes in objects:
+                    self._add(object_type, attributes['name'], cluster,
+                              attributes)
+                for mutation in self._mutations[object_type][start:]:
+                    self._apply(*mutation)
+                self._refreshed[(cluster, object_type)] = time.time()
+        finally:
+            with self._lock:
+                self._listing[object_type] -= 1
+                if not self._listing[object_type]:
+                    del self._mutations[object_type]
+
+    def _refresh_next(self):
+        """Refresh the stalest listing.
+
+        :returns: float -- seconds until the next refresh
+        """
+        with self._lock:
+            listings = [(cluster, object_type) for cluster in self.clusters
+                        for object_type in INVENTORY_CONTEXTS]
+            if not listings:
+                return self.interval
+            listing = min(listings, key=lambda key: (
+                key not in self._stale, self._refreshed.get(key, 0)))
+        try:
+            self.refresh(*listing)
+        except Exception:
+            LOG.exception("Refreshing the VPLEX inventory of %(type)s on "
+                          "%(cluster)s failed.",
+                          {'type': listing[1], 'cluster': listing[0]})
+            with self._lock:
+                self._stale.add(listing)
+        return float(self.interval) / len(listings)
+
+    def apply(self, resource_type, args, succeeded=True):
+        """Apply a command the driver ran to the index.
+
+        :param resource_type: the CLI command
+        :param args: the args for body
+        :param succeeded: False if the command failed or its outcome is
+                          unknown; its objects are then refreshed
+        """
+        resource_type = (resource_type or '').strip()
+        mutation = (resource_type, args, succeeded)
+        with self._lock:
+            for object_type in self._get_object_types(resource_type,
+                                                      succeeded):
+                if self._listing[object_type]:
+                    self._mutations[object_type].append(mutation)
+            self._apply(*mutation)
+
+    @staticmethod
+    def _get_object_types(resource_type, succeeded):
+        """Get the object types a command changes.
+
+        :param resource_type: the CLI command
+        :param succeeded: False if the command failed or its outcome is
+                          unknown
+        :returns: list -- inventory object types
+        """
+        mutation = INVENTORY_MUTATIONS.get(resource_type)
+        if mutation is not None and succeeded:
+            return [mutation[1]]
+        namespaces = VPLEXRest._get_cache_namespaces(resource_type)
+        return [object_type for object_type in INVENTORY_CONTEXTS
+                if namespaces is None or object_type in namespaces]
+
+    def _apply(self, resource_type, args, succeeded):
+        mutation = INVENTORY_MUTATIONS.get(resource_type)
+        cluster = VPLEXRest._get_cli_option(args, ('--cluster', '-c'))
+        if mutation is None or not succeeded:
+            for object_type in self._get_object_types(resource_type,
+                                                      succeeded):
+                self._stale.update((stale_cluster, object_type)
+                                   for stale_cluster in self.clusters)
+            return
+        action, object_type, name_flags, template, attribute, \
+            value_flags = mutation
+        value = VPLEXRest._get_cli_option(args, name_flags)
+        if value is None:
+            return
+        names = [template % name for name in value.split(',') if name]
+        values = []
+        if attribute is not None:
+            values = (VPLEXRest._get_cli_option(args, value_flags) or
+                      '').split(',')
+        for index, name in enumerate(names):
+            if action == 'add':
+                attributes = {'name': name}
+                if attribute in INVENTORY_MEMBER_ATTRIBUTES:
+                    attributes[attribute] = values
+                elif attribute is not None and index < len(values):
+                    attributes[attribute] = values[index]
+                self._add(object_type, name, cluster, attributes)
+            elif action == 'remove':
+                self._remove(object_type, name, cluster)
+            else:
+                for entry in self._objects[object_type].get(
+                        name, {}).values():
+                    members = entry['attributes'].setdefault(attribute, [])
+                    for member in self._normalize_members(values):
+                        if action == 'add-member' and (
+                                member not in members):
+                            members.append(member)
+                        elif action == 'remove-member' and (
+                                member in members):
+                            members.remove(member)
+
+    def is_loaded(self, object_type, cluster):
+        """Check whether a listing has been refreshed at least once.
+
+        :param object_type: the inventory object type
+        :param cluster: the cluster name
+        :returns: bool
+        """
+        with self._lock:
+            return (cluster, object_type) in self._refreshed
+
+    def get(self, object_type, name, cluster=None):
+        """Look up an object by name.
+
+        :param object_type: the inventory object type
+        :param name: the object name
+        :param cluster: the cluster name, None for any cluster
+        :returns: dict -- a copy of the object, or None
+        """
+        with self._lock:
+            clusters = self._objects[object_type].get(name, {})
+            entry = clusters.get(cluster, clusters.get(None))
+            if entry is None and cluster is None and clusters:
+                entry = list(clusters.values())[0]
+            return copy.deepcopy(entry)
+
+    def find_by_vpd(self, vpd_id, cluster=None):
+        """Look up a storage volume by its VPD83 id.
+
+        :param vpd_id: the VPD83 id, with or without the VPD83T3: prefix
+        :param cluster: the cluster that must see it, None for any
+        :returns: dict -- a copy of the object, or None
+        """
+        with self._lock:
+            clusters = self._by_vpd.get(self._normalize_vpd(vpd_id), {})
+            if cluster is None:
+                entry = (clusters[sorted(clusters, key=six.text_type)[0]]
+                         if clusters else None)
+            else:
+                entry = clusters.get(cluster)
+            return copy.deepcopy(entry)
+
+    def find_by_member(self, object_type, attribute, member, cluster=None):
+        """Look up the objects listing a member, e.g. a view's initiators.
+
+        :param object_type: the inventory object type
+        :param attribute: the member list attribute
+        :param member: the member name
+        :param cluster: the cluster name, None for any cluster
+        :returns: list -- copies of the objects
+        """
+        with self._lock:
+            return copy.deepcopy(
+                [entry for clusters in self._objects[object_type].values()
+                 for entry in clusters.values()
+                 if (cluster is None or entry['cluster'] in (cluster, None))
+                 and member in entry['attributes'].get(attribute, ())])
+
+
+class VPLEXRest(object):
+
+    def __init__(self, configuration=None):
+        self.configuration = configuration
         self.user = None
         self.passwd = None
         self.base_uri = None
+        # every configured management server, healthiest chosen per call
+        self.endpoints = []
+        self._endpoints = {}
+        self.pool_size = self._get_config_value('vplex_rest_pool_size',
+                                                DEFAULT_POOL_SIZE)
+        self.keep_alive = self._get_config_value('vplex_rest_keep_alive',
+                                                 True)
+        self.request_timeout = self._get_config_value(
+            'vplex_rest_timeout', DEFAULT_REQUEST_TIMEOUT)
+        # one pooled session per management server, keyed by base uri
+        self._sessions = {}
+        self._session_lock = threading.Lock()
+        # one request limiter per management server, keyed by base uri
+        self._limiters = {}
+        # per green thread state, e.g. the deadline in force
+        self._local = threading.local()
+        self.cache = VPLEXResponseCache(
+            max_size=self._get_config_value('vplex_rest_cache_size',
+                                            DEFAULT_CACHE_SIZE),
+            default_ttl=self._get_config_value('vplex_rest_cache_ttl',
+                                               DEFAULT_CACHE_TTL),
+            ttls=self._get_config_value('vplex_rest_cache_ttls', {}))
+        self.retry_policy = VPLEXRetryPolicy(
+            retries=self._get_config_value('vplex_rest_retries',
+                                           DEFAULT_RETRIES),
+            interval=self._get_config_value('vplex_rest_retry_interval',
+                                            DEFAULT_RETRY_INTERVAL),
+            max_interval=self._get_config_value(
+                'vplex_rest_retry_max_interval', DEFAULT_RETRY_MAX_INTERVAL))
+        # identical concurrent GETs share one in-flight request
+        self.inflight = VPLEXSingleFlight()
+        # start time of the last rediscovery, keyed by (cluster, array)
+        self._rediscoveries = {}
+        self.rediscovery_ttl = self._get_config_value(
+            'vplex_rediscovery_ttl', DEFAULT_REDISCOVERY_TTL)
+        self.inventory = VPLEXInventory(
+            self, interval=self._get_config_value(
+                'vplex_inventory_interval', DEFAULT_INVENTORY_INTERVAL))
+        self.metrics = VPLEXRestMetrics()
+        self._metrics_exporter = None
+        self._start_metrics_export()
+        self.jobs = VPLEXJobTracker(
+            self,
+            min_interval=self._get_config_value(
+                'vplex_job_poll_min_interval', JOB_POLL_MIN_INTERVAL),
+            max_interval=self._get_config_value(
+                'vplex_job_poll_max_interval', JOB_POLL_MAX_INTERVAL),
+            timeout=self._get_config_value('vplex_job_timeout',
+                                           JOB_TIMEOUT))
+
+    def _start_metrics_export(self):
+        """Export the request metrics periodically if configured."""
+        exporter = self._get_config_value('vplex_rest_metrics_exporter',
+                                          None)
+        interval = self._get_config_value('vplex_rest_metrics_interval', 0)
+        if not exporter or interval <= 0:
+            return
+        self.metrics.register_exporter(importutils.import_object(exporter))
+        self._metrics_exporter = loopingcall.FixedIntervalLoopingCall(
+            self.metrics.export)
+        self._metrics_exporter.start(interval=interval,
+                                     initial_delay=interval)
+
+    def get_metrics(self):
+        """Get the request instrumentation collected so far.
+
+        :returns: dict
+        """
+        return self.metrics.snapshot()
+
+    def _get_config_value(self, name, default):
+        """Get a driver option, falling back to a default.
+
+        :param name: the option name
+        :param default: the value used when the option is not set
+        :returns: the option value
+        """
+        return get_config_value(self.configuration, name, default)
 
     def set_rest_credentials(self, array_info):
         """Given the array record set the rest server credentials.
 
+        Every management server listed in the record becomes an
+        endpoint; the first one stays the default base uri.
         :param array_info: record
         """
-        ip = array_info['emc'][0]['vplex']['MgmtServerIp']
-        port = array_info['emc'][0]['vplex']['MgmtServerPort']
-        self.user = array_info['emc'][0]['vplex']['Username']
-        self.passwd = array_info['emc'][0]['vplex']['Password']
-        ip_port = "%(ip)s:%(port)s" % {'ip': ip, 'port': port}
-        self.base_uri = ("https://%(ip_port)s/vplex" % {'ip_port': ip_port})
+        endpoints = []
+        for emc in array_info['emc']:
+            ip = emc['vplex']['MgmtServerIp']
+            port = emc['vplex']['MgmtServerPort']
+            ip_port = "%(ip)s:%(port)s" % {'ip': ip, 'port': port}
+            base_uri = ("https://%(ip_port)s/vplex" % {'ip_port': ip_port})
+            if any(endpoint.base_uri == base_uri for endpoint in endpoints):
+                continue
+            # keep the health history across calls
+            endpoint = self._endpoints.get(base_uri)
+            if endpoint is None:
+                endpoint = self._new_endpoint(base_uri, None, None)
+                self._endpoints[base_uri] = endpoint
+            endpoint.user = emc['vplex']['Username']
+            endpoint.passwd = emc['vplex']['Password']
+            endpoints.append(endpoint)
+        # a management server dropped from the record keeps no connections
+        self.close_sessions(
+            [base_uri for base_uri in self._sessions
+             if all(endpoint.base_uri != base_uri
+                    for endpoint in endpoints)])
+        self.endpoints = endpoints
+        self.user = endpoints[0].user
+        self.passwd = endpoints[0].passwd
+        self.base_uri = endpoints[0].base_uri
+        clusters = []
+        for emc in array_info['emc']:
+            if emc['vplex']['Cluster'] not in clusters:
+                clusters.append(emc['vplex']['Cluster'])
+        self.inventory.start(clusters)
+
+    @contextlib.contextmanager
+    def deadline(self, deadline, replace=False):
+        """Apply a deadline to every REST call made in the block.
+
+        The deadline is local to the calling green thread. A deadline
+        already in force is kept if it expires sooner, unless replace is
+        set, e.g. for work done on behalf of other callers.
+        :param deadline: the VPLEXDeadline, None for no deadline
+        :param replace: True to ignore the deadline already in force
+        """
+        previous = getattr(self._local, 'deadline', None)
+        if (not replace and previous is not None and
+                (deadline is None or previous.expires < deadline.expires)):
+            deadline = previous
+        self._local.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            self._local.deadline = previous
+
+    @contextlib.contextmanager
+    def cancellation(self, event):
+        """Cancel the REST calls made in the block once event is set.
+
+        The check is cooperative: a command is not sent and a job is no
+        longer waited on after the event is set, but a command the array
+        already accepted still completes there. Cancellations nest, the
+        block is cancelled when any enclosing event is set.
+        :param event: the threading.Event, None to add nothing
+        """
+        previous = getattr(self._local, 'cancel', ())
+        if event is not None:
+            self._local.cancel = previous + (event,)
+        try:
+            yield event
+        finally:
+            self._local.cancel = previous
+
+    def check_cancelled(self):
+        """Raise if the calling green thread's work was cancelled.
+
+        :raises: VolumeBackendAPIException
+        """
+        if any(event.is_set()
+               for event in getattr(self._local, 'cancel', ())):
+            exception_message = _('The operation was cancelled.')
+            raise exception.VolumeBackendAPIException(
+                data=exception_message)
+
+    def propagate_context(self, func):
+        """Carry the caller's deadline and cancellation into another
+        green thread.
 
+        :param func: the callable to run in the other green thread
+        :returns: the wrapped callable
+        """
+        deadline = self.get_deadline()
+        cancel = getattr(self._local, 'cancel', ())
+
+        def _run_with_context(*args, **kwargs):
+            previous = getattr(self._local, 'cancel', ())
+            self._local.cancel = cancel
+            try:
+                if deadline is None:
+                    return func(*args, **kwargs)
+                with self.deadline(deadline):
+                    return func(*args, **kwargs)
+            finally:
+                self._local.cancel = previous
+        return _run_with_context
+
+    def get_deadline(self):
+        """Get the deadline in force for the calling green thread.
+
+        :returns: VPLEXDeadline or None
+        """
+        return getattr(self._local, 'deadline', None)
+
+    def _get_endpoint(self, base_uri):
+        """Get the endpoint for a base uri.
+
+        :param base_uri: the management server base uri
+        :returns: VPLEXEndpoint
+        """
+        endpoint = self._endpoints.get(base_uri)
+        if endpoint is None:
+            endpoint = self._new_endpoint(base_uri, self.user, self.passwd)
+            self._endpoints[base_uri] = endpoint
+        return endpoint
+
+    def _new_endpoint(self, base_uri, user, passwd):
+        """Create an endpoint with a breaker built from the options.
+
+        :param base_uri: the management server base uri
+        :param user: the user name
+        :param passwd: the password
+        :returns: VPLEXEndpoint
+        """
+        breaker = VPLEXCircuitBreaker(
+            failure_threshold=self._get_config_value(
+                'vplex_rest_breaker_threshold', DEFAULT_BREAKER_THRESHOLD),
+            cooldown=self._get_config_value('vplex_rest_breaker_cooldown',
+                                            DEFAULT_BREAKER_COOLDOWN))
+        return VPLEXEndpoint(base_uri, user, passwd, breaker=breaker)
+
+    def _select_endpoint(self, method, exclude=()):
+        """Choose the management server for the next request.
+
+        Endpoints whose circuit breaker is open are skipped. Writes go to
+        the healthiest remaining endpoint. Reads are spread over them by
+        picking the healthier of two at random.
+        :param method: the http method
+        :param exclude: base uris already tried for this request
+        :returns: VPLEXEndpoint
+        :raises: VolumeBackendAPIException if every breaker is open
+        """
+        endpoints = self.endpoints or [self._get_endpoint(self.base_uri)]
+        available = [endpoint for endpoint in endpoints
+                     if endpoint.breaker.available()]
+        candidates = [endpoint for endpoint in available
+                      if endpoint.base_uri not in exclude] or available
+        while candidates:
+            if method == GET and len(candidates) > 1:
+                first, second = random.sample(candidates, 2)
+                endpoint = first if first.score <= second.score else second
+            else:
+                endpoint = min(candidates, key=lambda item: item.score)
+            if endpoint.breaker.allow_request():
+                return endpoint
+            # another caller took the half-open trial
+            candidates.remove(endpoint)
+        exception_message = (_("No VPLEX management server is available, "
+                               "the circuit breaker is open for "
+                               "%(uris)s.")
+                             % {'uris': ', '.join(
+                                 endpoint.base_uri for endpoint in endpoints)})
+        LOG.error(exception_message)
+        raise exception.VolumeBackendAPIException(data=exception_message)
+
+    def get_endpoint_stats(self):
+        """Get the health metrics of every management server.
+
+        :returns: dict -- metrics keyed by base uri
+        """
+        return {endpoint.base_uri: endpoint.get_stats()
+                for endpoint in self.endpoints}
+
+    def _establish_rest_session(self, endpoint):
+        """Establish a pooled keep-alive session to a management server.
+
+        The session keeps up to pool_size HTTPS connections open, so the
+        TCP and TLS handshakes are paid once per connection rather than
+        once per CLI command. pool_block makes green threads wait for a
+        free connection instead of opening throwaway ones.
+        :param endpoint: the VPLEXEndpoint
+        :returns: requests.Session
+        """
+        session = requests.Session()
+        session.headers = {'content-type': 'application/json',
+                           'accept': 'application/json',
+                           'Connection': ('keep-alive' if self.keep_alive
+                                          else 'close')}
+        session.auth = HTTPBasicAuth(endpoint.user, endpoint.passwd)
+        http_adapter = requests_adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size,
+            pool_block=True)
+        session.mount('https://', http_adapter)
+        return session
+
+    def _get_session(self, endpoint):
+        """Get the pooled session for a management server.
+
+        Sessions are shared by all green threads talking to the same
+        management server and are rebuilt only if the credentials change.
+        :param endpoint: the VPLEXEndpoint
+        :returns: requests.Session
+        """
+        base_uri = endpoint.base_uri
+        credentials = (endpoint.user, endpoint.passwd)
+        with self._session_lock:
+            entry = self._sessions.get(base_uri)
+            if entry and entry[1] == credentials:
+                return entry[0]
+            if entry:
+                entry[0].close()
+            session = self._establish_rest_session(endpoint)
+            self._sessions[base_uri] = (session, credentials)
+            LOG.debug("Established REST session pool of size %(size)s "
+                      "to %(uri)s.", {'size': self.pool_size,
+                                      'uri': base_uri})
+            return session
+
+    def _get_limiter(self, base_uri):
+        """Get the request limiter for a management server.
+
+        :param base_uri: the management server base uri
+        :returns: VPLEXEndpointLimiter
+        """
+        with self._session_lock:
+            limiter = self._limiters.get(base_uri)
+            if limiter is None:
+                limiter = VPLEXEndpointLimiter(
+                    max_concurrent=self._get_config_value(
+                        'vplex_rest_max_concurrent', DEFAULT_MAX_CONCURRENT),
+                    rate=self._get_config_value('vplex_rest_rate_limit',
+                                                DEFAULT_RATE_LIMIT),
+                    burst=self._get_config_value('vplex_rest_rate_burst',
+                                                 None))
+                self._limiters[base_uri] = limiter
+            return limiter
+
+    def get_limiter_stats(self):
+        """Get the request limiter metrics of every management server.
+
+        :returns: dict -- metrics keyed by base uri
+        """
+        with self._session_lock:
+            limiters = dict(self._limiters)
+        return {base_uri: limiter.get_stats()
+                for base_uri, limiter in limiters.items()}
+
+    def close_sessions(self, base_uris=None):
+        """Close pooled management server sessions.
+
+        :param base_uris: the management servers, None for all of them
+        """
+        with self._session_lock:
+            for base_uri in list(self._sessions):
+                if base_uris is None or base_uri in base_uris:
+                    self._sessions.pop(base_uri)[0].close()
+
+    @staticmethod
     def _build_uri(resource_type):
         """Build the target url.
 
@@ -63,7 +1834,7 @@ class VPLEXRest(object):
                       % {'resource_type': resource_type})
         return target_uri
 
-    def request(self, method, target_uri, params=None):
+    def request(self, method, target_uri, params=None, request_object=None):
         """Sends a request (GET, POST, PUT, DELETE) to the target api.
 
         :param target_uri: target uri (string)
@@ -73,50 +1844,303 @@ class VPLEXRest(object):
         :returns: server response object (dict)
         :raises: VolumeBackendAPIException
         """
-        message, status_code = None, None
-        url = ("%(self.base_uri)s%(target_uri)s" %
-               {'self.base_uri': self.base_uri,
-                'target_uri': target_uri})
-        try:
-            if method == 'GET':
-                response = requests.get(url, data=params,
-                        auth=HTTPBasicAuth(self.user, self.passwd))
-            elif message == 'POST':
-                response = requests.post(url, data=params,
-                         auth=HTTPBasicAuth(self.user, self.passwd))
-            elif message == 'PUT':
-                response = requests.put(url, data=params,
-                        auth=HTTPBasicAuth(self.user, self.passwd))
-            elif message == 'DELETE':
-                response = requests.delete(url, data=params,
-                       auth=HTTPBasicAuth(self.user, self.passwd))
+        status_code, message, __ = self._request(
+            method, target_uri, params=params, request_object=request_object)
+        return status_code, message
+
+    def _request(self, method, target_uri, params=None, request_object=None,
+                 resource_type=None, retry=True):
+        """Sends a request and also returns the response headers.
+
+        Transient failures are retried according to the retry policy.
+        A non-idempotent command whose outcome is unknown, e.g. after a
+        read timeout, is only sent again once a probe has shown that it
+        did not take effect.
+        :param target_uri: target uri, or an absolute job url
+        :param method: The method (GET, POST, PUT, or DELETE)
+        :param params: Additional URL parameters
+        :param request_object: request payload (dict)
+        :param resource_type: the CLI command, used to classify retries
+        :param retry: False to send the request only once
+        :returns: tuple -- status code, message, headers
+        :raises: VolumeBackendAPIException
+        """
+        attempt = 0
+        tried = set()
+        while True:
+            attempt += 1
+            self.check_cancelled()
+            if target_uri.startswith('https://'):
+                # a job url belongs to the server that accepted the job
+                endpoint = self._get_endpoint(
+                    target_uri.split('/vplex', 1)[0] + '/vplex')
+                url = target_uri
+                if not endpoint.breaker.allow_request():
+                    exception_message = (
+                        _("The circuit breaker for %(uri)s is open.")
+                        % {'uri': endpoint.base_uri})
+                    raise exception.VolumeBackendAPIException(
+                        data=exception_message)
             else:
-                pass
-            status_code = response.status_code
+                endpoint = self._select_endpoint(method, exclude=tried)
+                url = ("%(base_uri)s%(target_uri)s" %
+                       {'base_uri': endpoint.base_uri,
+                        'target_uri': target_uri})
+            tried.add(endpoint.base_uri)
+            message, status_code, headers = None, None, {}
+            failure, error = None, None
             try:
-                message = response.json()
-            except ValueError:
-                LOG.debug("No response received from API. Status code "
-                          "received is: %(status_code)s",
-                          {'status_code': status_code})
-                message = None
-            LOG.debug("%(method)s request to %(url)s has returned with "
-                      "a status code of: %(status_code)s.",
-                      {'method': method, 'url': url,
-                       'status_code': status_code})
-        except requests.Timeout:
+                status_code, message, headers = self._send_request(
+                    endpoint, method, url, params, request_object,
+                    resource_type=resource_type)
+                if status_code in RETRY_SAFE_STATUS_CODES:
+                    failure = RETRY_SAFE
+                elif status_code in RETRY_AMBIGUOUS_STATUS_CODES:
+                    failure = RETRY_AMBIGUOUS
+            except requests.exceptions.ConnectTimeout as e:
+                # the request never reached the server
+                failure, error = RETRY_SAFE, e
+            except (requests.Timeout, requests.ConnectionError) as e:
+                failure, error = RETRY_AMBIGUOUS, e
+            except exception.VolumeBackendAPIException:
+                # deadline spent or no request slot in time
+                raise
+            except Exception as e:
+                exception_message = (_("The %(method)s request to URL "
+                                       "%(url)s failed with exception %(e)s")
+                                     % {'method': method, 'url': url,
+                                        'e': six.text_type(e)})
+                LOG.exception(exception_message)
+                raise exception.VolumeBackendAPIException(
+                    data=exception_message)
+            if (failure is None or not retry or
+                    attempt > self.retry_policy.retries):
+                break
+            untried = [other for other in self.endpoints
+                       if other.base_uri not in tried and
+                       other.breaker.available()]
+            if untried and not target_uri.startswith('https://') and (
+                    failure == RETRY_SAFE or
+                    self._is_idempotent(method, resource_type)):
+                LOG.warning("The %(method)s request to URL %(url)s failed "
+                            "(%(reason)s), failing over to %(next)s.",
+                            {'method': method, 'url': url,
+                             'reason': error or status_code,
+                             'next': untried[0].base_uri})
+                continue
+            delay = self.retry_policy.get_delay(attempt)
+            deadline = self.get_deadline()
+            if deadline is not None and deadline.remaining() <= delay:
+                LOG.warning("No time left in the deadline to retry the "
+                            "%(method)s request to URL %(url)s.",
+                            {'method': method, 'url': url})
+                break
+            LOG.warning("The %(method)s request to URL %(url)s failed on "
+                        "attempt %(attempt)s (%(reason)s), retrying in "
+                        "%(delay).1f seconds.",
+                        {'method': method, 'url': url, 'attempt': attempt,
+                         'reason': error or status_code, 'delay': delay})
+            time.sleep(delay)
+            if (failure == RETRY_AMBIGUOUS and
+                    not self._is_idempotent(method, resource_type)):
+                applied = self._probe_command(resource_type, request_object)
+                if applied:
+                    LOG.info("The %(method)s request to URL %(url)s took "
+                             "effect before it failed, not resending.",
+                             {'method': method, 'url': url})
+                    return STATUS_200, None, {}
+                if applied is None:
+                    LOG.error("Unable to tell whether the %(method)s "
+                              "request to URL %(url)s took effect, not "
+                              "resending it.", {'method': method, 'url': url})
+                    break
+
+        if isinstance(error, requests.Timeout):
             LOG.error("The %(method)s request to URL %(url)s timed-out, "
                       "but may have been successful. Please check the array.",
                       {'method': method, 'url': url})
-        except Exception as e:
+        elif error is not None:
             exception_message = (_("The %(method)s request to URL %(url)s "
                                    "failed with exception %(e)s")
                                  % {'method': method, 'url': url,
-                                    'e': six.text_type(e)})
-            LOG.exception(exception_message)
+                                    'e': six.text_type(error)})
+            LOG.error(exception_message)
             raise exception.VolumeBackendAPIException(data=exception_message)
+        return status_code, message, headers
 
-        return status_code, message
+    def _send_request(self, endpoint, method, url, params, request_object,
+                      resource_type=None):
+        """Send one HTTP request over the pooled session.
+
+        The latency and outcome are recorded against the endpoint and in
+        the request metrics.
+        :param endpoint: the VPLEXEndpoint
+        :param method: The method (GET, POST, PUT, or DELETE)
+        :param url: the full url
+        :param params: Additional URL parameters
+        :param request_object: request payload (dict)
+        :param resource_type: the CLI command, used to label metrics
+        :returns: tuple -- status code, message, headers
+        """
+        # sent as bytes so the metrics count what goes on the wire
+        data = (json.dumps(request_object, sort_keys=True).encode('utf-8')
+                if request_object else None)
+        label = (resource_type or 'job').strip()
+        lane = READ_LANE if method == GET else WRITE_LANE
+        deadline = self.get_deadline()
+        sent = False
+        try:
+            session = self._get_session(endpoint)
+            wait_timeout = deadline.get_timeout() if deadline else None
+            with self._get_limiter(endpoint.base_uri).limit(lane,
+                                                            wait_timeout):
+                timeout = (deadline.get_timeout(self.request_timeout)
+                           if deadline else self.request_timeout)
+                self.metrics.request_started()
+                start = time.time()
+                sent = True
+                try:
+                    response = session.request(
+                        method=method, url=url, params=params,
+                        timeout=timeout, data=data)
+                except Exception as e:
+                    latency = time.time() - start
+                    endpoint.record(latency, True)
+                    self.metrics.request_finished(
+                        label, method, latency,
+                        'timeout' if isinstance(e, requests.Timeout)
+                        else 'error', len(data or b''))
+                    raise
+                latency = time.time() - start
+                endpoint.record(latency, response.status_code >= 500)
+                self.metrics.request_finished(
+                    label, method, latency, response.status_code,
+                    len(data or b''), len(response.content or b''))
+        finally:
+            if not sent:
+                # a half-open trial claimed for this request was not used
+                endpoint.breaker.release_trial()
+        status_code = response.status_code
+        try:
+            message = response.json()
+        except ValueError:
+            LOG.debug("No response received from API. Status code "
+                      "received is: %(status_code)s",
+                      {'status_code': status_code})
+            message = None
+        LOG.debug("%(method)s request to %(url)s has returned with "
+                  "a status code of: %(status_code)s.",
+                  {'method': method, 'url': url,
+                   'status_code': status_code})
+        return status_code, message, response.headers
+
+    @staticmethod
+    def _is_idempotent(method, resource_type):
+        """Check if a command can be resent without side effects.
+
+        :param method: the http method
+        :param resource_type: the CLI command
+        :returns: boolean
+        """
+        if method == GET:
+            return True
+        return (resource_type is not None and
+                resource_type.strip() in IDEMPOTENT_COMMANDS)
+
+    @staticmethod
+    def _get_cli_option(args, flags):
+        """Get the value of a CLI option from a command's args.
+
+        :param args: the args for body
+        :param flags: the option spellings, e.g. ('-n', '--name')
+        :returns: the option value or None
+        """
+        tokens = six.text_type((args or {}).get('args', '')).split()
+        for index, token in enumerate(tokens[:-1]):
+            if token in flags:
+                return tokens[index + 1].rstrip(',')
+        return None
+
+    def _probe_command(self, resource_type, args):
+        """Check whether a command already took effect on the array.
+
+        A multi-target command, e.g. "-d sv1,sv2", is probed target by
+        target and only counts as applied or not applied when every
+        target agrees.
+        :param resource_type: the CLI command
+        :param args: the args for body
+        :returns: True if it took effect, False if it did not, None if
+                  that cannot be determined or it took effect on only
+                  some of its targets
+        """
+        probe = COMMAND_PROBES.get((resource_type or '').strip())
+        if probe is None:
+            return None
+        path, flags, should_exist = probe
+        name = self._get_cli_option(args, flags)
+        if name is None:
+            return None
+        applied = set()
+        for target in name.split(','):
+            exists = self._probe_path(path % target)
+            if exists is None:
+                return None
+            applied.add(exists == should_exist)
+        if len(applied) != 1:
+            LOG.warning("The %(command)s command took effect on only some "
+                        "of %(targets)s.",
+                        {'command': resource_type, 'targets': name})
+            return None
+        return applied.pop()
+
+    def _probe_path(self, path):
+        """Check whether an object exists at a context path.
+
+        :param path: the ll context path, may contain wildcards
+        :returns: True, False, or None if that cannot be determined
+        """
+        try:
+            status_code, message, __ = self._request(
+                GET, self._build_uri('ll'), request_object={'args': path},
+                resource_type='ll', retry=False)
+        except exception.VolumeBackendAPIException:
+            return None
+        if status_code in [STATUS_200, STATUS_201, STATUS_202, STATUS_204]:
+            # a wildcard path that matches nothing lists no context
+            return bool(self._get_ll_contexts(message))
+        if self._is_not_found(status_code, message):
+            return False
+        return None
+
+    @staticmethod
+    def _get_ll_contexts(message):
+        """Get the contexts an ll response listed.
+
+        :param message: the server response
+        :returns: list -- the listed contexts
+        """
+        try:
+            return message['response']['context'] or []
+        except (KeyError, TypeError):
+            return []
+
+    @staticmethod
+    def _is_not_found(status_code, message):
+        """Check if a response reports that the object does not exist.
+
+        :param status_code: the status code
+        :param message: the server response
+        :returns: boolean
+        """
+        if status_code in NOT_FOUND_STATUS_CODES:
+            return True
+        try:
+            exception_data = message['response']['exception']
+        except (KeyError, TypeError):
+            return False
+        exception_data = six.text_type(exception_data or '').lower()
+        return any(marker in exception_data
+                   for marker in NOT_FOUND_MESSAGES)
 
     def check_status_code_and_message_success(self, operation, status_code,
                                               message):
@@ -139,7 +2163,7 @@ class VPLEXRest(object):
 
         if message:
             exception_data = message['response']['exception']
-            if exception_data is None or exception_data == 'null':
+            if exception_data is not None and exception_data != 'null':
                 exception_message = (
                     _('Error %(operation)s. The exception is %(exc)s '
                       'and the message us %(message)s.')
@@ -154,28 +2178,247 @@ class VPLEXRest(object):
 
         :param resource_type: the resource type
         :param args: the args for body
+        :returns: VPLEXJob if the command was accepted to run
+                  asynchronously, otherwise None
         """
         target_uri = self._build_uri(resource_type)
-        status_code, message = self.request(POST, target_uri,
-                                            request_object=args)
+        namespaces = self._get_cache_namespaces(resource_type)
         operation = 'Create %(res)s resource' % {'res': resource_type}
-        self.check_status_code_and_message_success(
-            operation, status_code, message)
+        try:
+            status_code, message, headers = self._request(
+                POST, target_uri, request_object=args,
+                resource_type=resource_type)
+            self.check_status_code_and_message_success(
+                operation, status_code, message)
+        except Exception:
+            # the command may have changed the array even if it failed
+            self.inventory.apply(resource_type, args, succeeded=False)
+            raise
+        finally:
+            self.cache.invalidate(namespaces)
+        if status_code != STATUS_202:
+            self.inventory.apply(resource_type, args)
+            return None
+        job = self.jobs.track(operation, headers.get('Location'), message)
+        job.add_done_callback(
+            lambda finished: self._finish_job(resource_type, args,
+                                              namespaces, finished))
+        return job
+
+    def _finish_job(self, resource_type, args, namespaces, job):
+        """Account for the changes of a finished job.
+
+        :param resource_type: the resource type
+        :param args: the args for body
+        :param namespaces: the cache namespaces the command changes
+        :param job: the finished VPLEXJob
+        """
+        self.cache.invalidate(namespaces)
+        self.inventory.apply(resource_type, args,
+                             succeeded=job.status == JOB_SUCCEEDED)
+
+    def wait_for_job(self, job, timeout=None):
+        """Wait for an asynchronous command to finish.
 
-    def get_resource(self, resource_type, args):
+        :param job: the VPLEXJob, None for a synchronous command
+        :param timeout: seconds to wait
+        :returns: the final server response
+        :raises: VolumeBackendAPIException
+        """
+        if job is None:
+            return None
+        deadline = self.get_deadline()
+        if deadline is not None:
+            timeout = deadline.get_timeout(timeout)
+        if getattr(self._local, 'cancel', ()):
+            return job.wait(timeout, cancelled=self.check_cancelled)
+        return job.wait(timeout)
+
+    @staticmethod
+    def _get_cache_namespaces(resource_type):
+        """Get the namespaces a mutating command invalidates.
+
+        :param resource_type: the resource type e.g. extent+create
+        :returns: tuple -- namespaces, or None for all of them
+        """
+        resource_type = resource_type.strip()
+        if resource_type in CACHE_NAMESPACES:
+            return CACHE_NAMESPACES[resource_type]
+        prefix = resource_type.rsplit('+', 1)[0]
+        while prefix:
+            if prefix in CACHE_NAMESPACES:
+                return CACHE_NAMESPACES[prefix]
+            if '+' not in prefix:
+                break
+            prefix = prefix.rsplit('+', 1)[0]
+        return None
+
+    @staticmethod
+    def _get_cache_key(resource_type, args):
+        """Build the cache key and context path segments of a read.
+
+        :param resource_type: the resource type e.g. ll
+        :param args: the args for body
+        :returns: tuple -- (key, set of path segments)
+        """
+        key = (resource_type, json.dumps(args, sort_keys=True))
+        segments = set()
+        for value in (args or {}).values():
+            for token in six.text_type(value).split():
+                if token.startswith('/'):
+                    segments.update(filter(None, token.split('/')))
+        return key, segments
+
+    def get_cache_stats(self):
+        """Get the read cache hit and miss counters.
+
+        :returns: dict -- cache and request coalescing counters
+        """
+        stats = self.cache.get_stats()
+        stats.update(self.inflight.get_stats())
+        return stats
+
+    def get_resource(self, resource_type, args, use_cache=True,
+                     missing_ok=False):
         """get a provisioning resource.
 
+        Responses are served from the read cache while fresh, and
+        identical requests already in flight are joined rather than sent
+        again.
         :param resource_type: the resource type
         :param args: the args for body
+        :param use_cache: False to always query the management server
+        :param missing_ok: True to return None, uncached, when the server
+                           reports that the object does not exist
+        :returns: server response object (dict)
+        :raises: VolumeBackendAPIException
+        """
+        cache_key, segments = self._get_cache_key(resource_type, args)
+        if use_cache:
+            found, message = self.cache.get(cache_key)
+            if found:
+                return message
+            generation = self.cache.generation
+            # a read started before a write must not be joined after it
+            message = self.inflight.do((cache_key, generation, missing_ok),
+                                       self._get_resource,
+                                       resource_type, args, missing_ok)
+            if message is not None:
+                self.cache.put(cache_key, resource_type, message, segments,
+                               generation=generation)
+            return message
+        return self._get_resource(resource_type, args, missing_ok)
+
+    def _get_resource(self, resource_type, args, missing_ok=False):
+        """Send a get request for a provisioning resource.
+
+        :param resource_type: the resource type
+        :param args: the args for body
+        :param missing_ok: True to return None when the server reports
+                           that the object does not exist
+        :returns: server response object (dict)
         """
         target_uri = self._build_uri(resource_type)
-        status_code, message = self.request(GET, target_uri,
-                                            request_object=args)
+        status_code, message, __ = self._request(
+            GET, target_uri, request_object=args,
+            resource_type=resource_type)
+        if missing_ok and self._is_not_found(status_code, message):
+            return None
         operation = 'Create %(res)s resource' % {'res': resource_type}
         self.check_status_code_and_message_success(
             operation, status_code, message)
         return message
 
+    def is_storage_volume_visible(self, cluster, storage_volume):
+        """Check whether a cluster already sees a storage volume.
+
+        :param cluster: cluster name
+        :param storage_volume: the storage volume VPD83 id
+        :returns: bool -- False only if the cluster reports that the
+                  storage volume does not exist
+        :raises: VolumeBackendAPIException
+        """
+        # the inventory can be behind, so only trust a hit
+        if self.inventory.find_by_vpd(storage_volume, cluster) is not None:
+            return True
+        message = self.get_resource(
+            'll', {'args': '/clusters/%(cluster)s/storage-elements/'
+                           'storage-volumes/%(volume)s'
+                           % {'cluster': cluster,
+                              'volume': storage_volume}},
+            missing_ok=True)
+        return message is not None
+
+    def get_object(self, object_type, cluster, name):
+        """Look up the attributes of one object on a cluster.
+
+        The inventory answers once it has listed the object type on the
+        cluster; until then the object is read through the cache.
+        :param object_type: the inventory object type e.g. storage-views
+        :param cluster: cluster name
+        :param name: the object name
+        :returns: dict -- the object attributes, or None if it does not
+                  exist
+        :raises: VolumeBackendAPIException
+        """
+        if self.inventory.is_loaded(object_type, cluster):
+            entry = self.inventory.get(object_type, name, cluster)
+            return entry['attributes'] if entry is not None else None
+        message = self.get_resource(
+            'll', {'args': '/clusters/%(cluster)s/%(context)s/%(name)s'
+                           % {'cluster': cluster,
+                              'context': INVENTORY_CONTEXTS[object_type],
+                              'name': name}},
+            missing_ok=True)
+        if message is None:
+            return None
+        objects = VPLEXInventory._parse_objects(message)
+        if not objects:
+            return {'name': name}
+        attributes = objects[0]
+        for attribute in INVENTORY_MEMBER_ATTRIBUTES:
+            if attribute in attributes:
+                attributes[attribute] = VPLEXInventory._normalize_members(
+                    attributes[attribute])
+        return attributes
+
+    def rediscover_array(self, cluster, hard, storage_volumes=()):
+        """Rediscover an array only when it is needed.
+
+        Given the storage volumes a caller expects, the array is not
+        rediscovered when all of them are visible; a storage volume the
+        cluster does not see forces a rediscovery, as an earlier one
+        that did not find it is of no use. Without expected storage
+        volumes, a rediscovery completed within the freshness window is
+        reused. Concurrent rediscoveries of the same array and cluster
+        share one call.
+        :param cluster: cluster name
+        :param hard: the array to rediscover
+        :param storage_volumes: the storage volume ids expected
+        :raises: VolumeBackendAPIException
+        """
+        key = (cluster, hard)
+        if storage_volumes:
+            if all(self.is_storage_volume_visible(cluster, storage_volume)
+                   for storage_volume in storage_volumes):
+                return
+        else:
+            last_time = self._rediscoveries.get(key)
+            if (last_time is not None and
+                    time.time() - last_time < self.rediscovery_ttl):
+                LOG.debug('Reusing the rediscovery of array %(hard)s on '
+                          '%(cluster)s from %(age).1fs ago.',
+                          {'hard': hard, 'cluster': cluster,
+                           'age': time.time() - last_time})
+                return
+        self.inflight.do(('re-discovery',) + key,
+                         self._rediscover_array, cluster, hard)
+
+    def _rediscover_array(self, cluster, hard):
+        start_time = time.time()
+        self.wait_for_job(self.re_discovery_arrays(cluster, hard))
+        self._rediscoveries[(cluster, hard)] = start_time
+
     def re_discovery_arrays(self, cluster, hard):
         """ array re-discover
 
@@ -184,7 +2427,7 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args" : "-a " + hard + " --cluster " +
                             cluster + " --force"})
-        self.create_resource('re-disvovery+arrays', new_arrays_data)
+        return self.create_resource('re-disvovery+arrays', new_arrays_data)
 
     def claim_storage_volume(self, name, storage_volumes):
         """  claim storage-volume
@@ -194,7 +2437,28 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "-n " + name + " -d " +
                             storage_volumes + "  --thin-rebuild -f"})
-        self.create_resource('storage-volume+claim', new_arrays_data)
+        return self.create_resource('storage-volume+claim', new_arrays_data)
+
+    def claim_storage_volumes(self, names, storage_volumes):
+        """claim several storage-volumes in one call
+
+        :param names: list of the names of storage-volumes
+        :param storage_volumes: list of storage-volume ids, in the same
+                                order as names
+        """
+        new_arrays_data = ({"args": "-n " + ",".join(names) + " -d " +
+                            ",".join(storage_volumes) +
+                            "  --thin-rebuild -f"})
+        return self.create_resource('storage-volume+claim', new_arrays_data)
+
+    def is_storage_volume_claimed(self, name):
+        """Check whether a storage-volume was claimed under a name
+
+        :param name: the name given to the storage-volume by the claim
+        :returns: True, False, or None if that cannot be determined
+        """
+        return self._probe_command('storage-volume+claim',
+                                   {"args": "-n " + name})
 
     def create_extent(self, storage_volumes):
         """create extent
@@ -203,7 +2467,24 @@ class VPLEXRest(object):
         :return:
         """
         new_arrays_data = ({"args": "-d " + storage_volumes})
-        self.create_resource('extent+create', new_arrays_data)
+        return self.create_resource('extent+create', new_arrays_data)
+
+    def create_extents(self, storage_volumes):
+        """create an extent on each of several storage-volumes
+
+        :param storage_volumes: list of storage-volume names
+        """
+        new_arrays_data = ({"args": "-d " + ",".join(storage_volumes)})
+        return self.create_resource('extent+create', new_arrays_data)
+
+    def is_extent_created(self, storage_volume):
+        """Check whether the extent of a storage-volume exists
+
+        :param storage_volume: the claimed storage-volume name
+        :returns: True, False, or None if that cannot be determined
+        """
+        return self._probe_command('extent+create',
+                                   {"args": "-d " + storage_volume})
 
     def create_local_device(self, name, extent, geometry):
         """create local device
@@ -214,7 +2495,7 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "-n " + name + " -e " +
                             extent + "-g" + geometry + " -f"})
-        self.create_resource('local-device+create', new_arrays_data)
+        return self.create_resource('local-device+create', new_arrays_data)
 
     def create_virtual_volume(self, device):
         """create virtual volume
@@ -223,7 +2504,7 @@ class VPLEXRest(object):
         :return:
         """
         new_arrays_data = ({"args": "--device " + device})
-        self.create_resource('virtual-volume+create', new_arrays_data)
+        return self.create_resource('virtual-volume+create', new_arrays_data)
 
     def attach_mirror_device(self, device, mirror_device):
         """attach mirror device
@@ -233,7 +2514,7 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "-d " + device + " -m " +
                             mirror_device + " -f"})
-        self.create_resource('device+attach-mirror', new_arrays_data)
+        return self.create_resource('device+attach-mirror', new_arrays_data)
 
     def create_consistency_group(self, name, cluster):
         """create consistency-group
@@ -243,7 +2524,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--name " + name + " --cluster " +
                             cluster + " -f"})
-        self.create_resource('consistency-group+create', new_arrays_data)
+        return self.create_resource(
+            'consistency-group+create', new_arrays_data)
 
     def set_consistency_group_visibility(self, attributes, value):
         """set consistency-group visibility
@@ -253,7 +2535,7 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "-a " + attributes + " -v " +
                             value + " -f"})
-        self.create_resource('set', new_arrays_data)
+        return self.create_resource('set', new_arrays_data)
 
     def set_detachrule_to_consistency_group(self, cluster, delay,
                                             consistency_groups):
@@ -266,7 +2548,7 @@ class VPLEXRest(object):
         new_arrays_data = ({"args": "--cluster " + cluster + " --delay " +
                             delay + "--consistency-groups" +
                                     consistency_groups + " -f"})
-        self.create_resource('consistency-group+set-detach-rule+winner',
+        return self.create_resource('consistency-group+set-detach-rule+winner',
                              new_arrays_data)
 
     def add_virtualvolumes_to_consistency_group(self, volumes, consistency_group):
@@ -278,7 +2560,7 @@ class VPLEXRest(object):
         new_arrays_data = ({"args": "--virtual-volumes " + volumes +
                             " --consistency-group " + consistency_group +
                                     " -f"})
-        self.create_resource('consistency-group+add-virtual-volumes',
+        return self.create_resource('consistency-group+add-virtual-volumes',
                              new_arrays_data)
 
     def create_export_storage_view(self, cluster, name, ports):
@@ -291,7 +2573,8 @@ class VPLEXRest(object):
         new_arrays_data = ({"args": "--cluster " + cluster +
                             " --name " + name +
                             " --ports " + ports + " -f"})
-        self.create_resource('export+storage-view+create', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+create', new_arrays_data)
 
     def register_export_initiator_port(self, cluster, initiator_port, ports):
         """register export initiator-port
@@ -310,7 +2593,8 @@ class VPLEXRest(object):
         new_arrays_data = ({"args": "--cluster " + cluster +
                             " --initiator-port " + initiator_port +
                             " --ports " + port_str + " -f"})
-        self.create_resource('export+initiator-port+register', new_arrays_data)
+        return self.create_resource(
+            'export+initiator-port+register', new_arrays_data)
 
     def addinitiatorport_to_export_storage_view(self, view, initiator_port):
         """addinitiatorport to export storage-view
@@ -321,7 +2605,8 @@ class VPLEXRest(object):
         new_arrays_data = ({"args": "--view " + view +
                             " --initiator-ports " + initiator_port +
                             " -f"})
-        self.create_resource('export+storage-view+addinitiatorport', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+addinitiatorport', new_arrays_data)
 
     def addport_to_export_storage_view(self, view, ports):
         """ addport to export storage-view
@@ -331,7 +2616,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--view " + view +
                             " --ports " + ports})
-        self.create_resource('export+storage-view+addport', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+addport', new_arrays_data)
 
     def addvirtualvolume_to_export_storage_view(self, view, virtual_volumes):
         """export storage-view addvirtualvolume
@@ -341,7 +2627,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--view " + view +
                             " --virtual-volumes " + virtual_volumes})
-        self.create_resource('export+storage-view+addvirtualvolume', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+addvirtualvolume', new_arrays_data)
 
     def removeinitiatorport_export_storage_view(self, view, initiator_ports):
         """removeinitiatorport_export_storage_view
@@ -351,7 +2638,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--view " + view +
                             " --initiator-ports " + initiator_ports})
-        self.create_resource('export+storage-view+removeinitiatorport', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+removeinitiatorport', new_arrays_data)
 
     def removeport_export_storage_view(self, view, ports):
         """removeport_export_storage_view
@@ -361,7 +2649,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--view " + view +
                             " --ports " + ports})
-        self.create_resource('export+storage-view+removeport', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+removeport', new_arrays_data)
 
     def removevirtualvolume_export_storage_view(self, virtual_volumes, view):
         """removevirtualvolume_export_storage_view
@@ -371,7 +2660,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--virtual-volumes " + virtual_volumes +
                             " --view " + view})
-        self.create_resource('export+storage-view+removevirtualvolume', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+removevirtualvolume', new_arrays_data)
 
     def destroy_export_storage_view(self, view):
         """destroy_export_storage_view
@@ -379,7 +2669,8 @@ class VPLEXRest(object):
         :param view:
         """
         new_arrays_data = ({"args": " --view " + view})
-        self.create_resource('export+storage-view+destroy', new_arrays_data)
+        return self.create_resource(
+            'export+storage-view+destroy', new_arrays_data)
 
     def unregister_export_initiator_port(self, initiator_port):
         """unregister_export_initiator_port
@@ -387,7 +2678,8 @@ class VPLEXRest(object):
         :param initiator_port:
         """
         new_arrays_data = ({"args": " --initiator-port " + initiator_port})
-        self.create_resource('export+initiator-port+unregister', new_arrays_data)
+        return self.create_resource(
+            'export+initiator-port+unregister', new_arrays_data)
 
     def consistency_group_remove_virtual_volumes(self, consistency_group,
                                                  virtual_volumes):
@@ -398,7 +2690,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--consistency-group " + consistency_group +
                             " --virtual-volumes " + virtual_volumes})
-        self.create_resource('consistency-group+remove-virtual-volumes', new_arrays_data)
+        return self.create_resource(
+            'consistency-group+remove-virtual-volumes', new_arrays_data)
 
     def destroy_virtual_volume(self, virtual_volumes):
         """virtual-volume destroy
@@ -406,7 +2699,7 @@ class VPLEXRest(object):
         :param virtual_volumes:
         """
         new_arrays_data = ({"args": " --virtual-volumes " + virtual_volumes})
-        self.create_resource('virtual-volume+destroy', new_arrays_data)
+        return self.create_resource('virtual-volume+destroy', new_arrays_data)
 
     def detach_mirror_device(self, device, mirror_device):
         """device detach-mirror
@@ -416,7 +2709,7 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": "--device " + device +
                             " -m " + mirror_device})
-        self.create_resource('device+detach-mirror', new_arrays_data)
+        return self.create_resource('device+detach-mirror', new_arrays_data)
 
     def destroy_distributed_devices(self, distributed_devices):
         """destroy_distributed_devices
@@ -425,7 +2718,7 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": " --distributed-devices " +
                                     distributed_devices + " -f"})
-        self.create_resource('ds+dd+destroy', new_arrays_data)
+        return self.create_resource('ds+dd+destroy', new_arrays_data)
 
     def destroy_local_device(self, device):
         """destroy local-device
@@ -433,7 +2726,33 @@ class VPLEXRest(object):
         :param device:
         """
         new_arrays_data = ({"args": " -d " + device + " -f"})
-        self.create_resource('local-device+destroy', new_arrays_data)
+        return self.create_resource('local-device+destroy', new_arrays_data)
+
+    def get_extent_devices(self, cluster, extent):
+        """Get the devices built on an extent.
+
+        :param cluster: cluster name
+        :param extent: the extent name
+        :returns: list -- the device names, empty when the extent is gone
+        :raises: VolumeBackendAPIException
+        """
+        message = self.get_resource(
+            'll', {'args': '/clusters/%(cluster)s/storage-elements/'
+                           'extents/%(extent)s'
+                           % {'cluster': cluster, 'extent': extent}},
+            use_cache=False, missing_ok=True)
+        if message is None:
+            return []
+        contexts = (message.get('response') or {}).get('context') or []
+        for context in contexts:
+            for attribute in context.get('attributes') or []:
+                if attribute.get('name') != 'used-by':
+                    continue
+                value = attribute.get('value') or []
+                if isinstance(value, six.string_types):
+                    value = value.strip('[]').split(',')
+                return [name.strip() for name in value if name.strip()]
+        return []
 
     def destroy_extent(self, extent):
         """destroy extent
@@ -441,7 +2760,7 @@ class VPLEXRest(object):
         :param extent:
         """
         new_arrays_data = ({"args": " -s " + extent+" -f"})
-        self.create_resource('extent+destroy ', new_arrays_data)
+        return self.create_resource('extent+destroy ', new_arrays_data)
 
     def unclaim_storage_volume(self, storage_volume):
         """unclaim storage-volume
@@ -449,7 +2768,7 @@ class VPLEXRest(object):
         :param storage_volume:
         """
         new_arrays_data = ({"args": " -d " + storage_volume})
-        self.create_resource('storage-volume+unclaim', new_arrays_data)
+        return self.create_resource('storage-volume+unclaim', new_arrays_data)
 
     def forget_storage_volume(self, hard):
         """forget storage-volume
@@ -457,7 +2776,7 @@ class VPLEXRest(object):
         :param hard:
         """
         new_arrays_data = ({"args": " -d " + hard})
-        self.create_resource('storage-volume+forget', new_arrays_data)
+        return self.create_resource('storage-volume+forget', new_arrays_data)
 
     def destroy_consistency_group(self, consistency_groups):
         """destroy consistency-group
@@ -466,7 +2785,8 @@ class VPLEXRest(object):
         """
         new_arrays_data = ({"args": " --consistency-groups " +
                                     consistency_groups + " --force"})
-        self.create_resource('consistency-group+destroy', new_arrays_data)
+        return self.create_resource(
+            'consistency-group+destroy', new_arrays_data)
 
     def get_details_from_storage(self, cluster):
         """ get_details_from_storage
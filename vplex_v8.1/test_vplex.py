@@ -16,7 +16,10 @@
 import ast
 from copy import deepcopy
 import datetime
+import os
+import shutil
 import tempfile
+import threading
 import time
 from xml.dom import minidom
 
@@ -35,6 +38,7 @@ from cinder import test
 from cinder.tests.unit import fake_group
 from cinder.tests.unit import fake_snapshot
 from cinder.tests.unit import fake_volume
+from cinder.volume.drivers.dell_emc.vplex import adapter
 from cinder.volume.drivers.dell_emc.vplex import common
 from cinder.volume.drivers.dell_emc.vplex import fc
 from cinder.volume.drivers.dell_emc.vplex import iscsi
@@ -6648,3 +6652,1528 @@ class VMAXCommonReplicationTest(test.TestCase):
             self.data.array, self.data.test_vol_grp_name,
             [self.data.device_id], self.extra_specs)
         mock_rm.assert_called_once()
+
+
+class VPLEXRestSessionTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXRestSessionTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.array_info = {'emc': [
+            {'vplex': {'MgmtServerIp': '10.0.0.%d' % index,
+                       'MgmtServerPort': '443', 'Username': 'user',
+                       'Password': 'pass',
+                       'Cluster': 'cluster-%d' % index}}
+            for index in (1, 2)]}
+        mock.patch.object(self.rest.inventory, 'start').start()
+        mock.patch.object(rest.requests, 'Session',
+                          side_effect=lambda: mock.Mock()).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_one_session_per_endpoint_is_reused(self):
+        self.rest.set_rest_credentials(self.array_info)
+        first, second = self.rest.endpoints
+        session = self.rest._get_session(first)
+        self.assertIs(session, self.rest._get_session(first))
+        self.assertIsNot(session, self.rest._get_session(second))
+        self.assertEqual(2, rest.requests.Session.call_count)
+        self.assertEqual(('user', 'pass'),
+                         (session.auth.username, session.auth.password))
+
+    def test_changed_credentials_replace_the_session(self):
+        self.rest.set_rest_credentials(self.array_info)
+        endpoint = self.rest.endpoints[0]
+        session = self.rest._get_session(endpoint)
+        endpoint.passwd = 'changed'
+        self.assertIsNot(session, self.rest._get_session(endpoint))
+        session.close.assert_called_once_with()
+
+    def test_dropped_management_server_is_closed(self):
+        self.rest.set_rest_credentials(self.array_info)
+        sessions = [self.rest._get_session(endpoint)
+                    for endpoint in self.rest.endpoints]
+        self.array_info['emc'].pop()
+        self.rest.set_rest_credentials(self.array_info)
+        self.assertFalse(sessions[0].close.called)
+        sessions[1].close.assert_called_once_with()
+        self.rest.close_sessions()
+        sessions[0].close.assert_called_once_with()
+
+
+class VPLEXResponseCacheTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXResponseCacheTest, self).setUp()
+        self.cache = rest.VPLEXResponseCache(max_size=2, default_ttl=10)
+        self.message = {'response': {'context': ['dev1']}}
+
+    def test_get_returns_a_copy(self):
+        self.cache.put('key', 'll', self.message, set(['devices']))
+        found, message = self.cache.get('key')
+        self.assertTrue(found)
+        message['response']['context'].append('dev2')
+        self.assertEqual(self.message, self.cache.get('key')[1])
+
+    @mock.patch.object(time, 'time', return_value=100)
+    def test_entry_expires_after_ttl(self, mock_time):
+        self.cache.put('key', 'll', self.message, set())
+        mock_time.return_value = 110
+        self.assertEqual((False, None), self.cache.get('key'))
+
+    def test_zero_ttl_disables_caching(self):
+        cache = rest.VPLEXResponseCache(default_ttl=10, ttls={'ll': 0})
+        cache.put('key', 'll', self.message, set())
+        self.assertFalse(cache.get('key')[0])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put('a', 'll', self.message, set())
+        self.cache.put('b', 'll', self.message, set())
+        self.cache.get('a')
+        self.cache.put('c', 'll', self.message, set())
+        self.assertTrue(self.cache.get('a')[0])
+        self.assertFalse(self.cache.get('b')[0])
+        self.assertEqual(1, self.cache.get_stats()['evictions'])
+
+    def test_invalidate_drops_only_touched_namespaces(self):
+        self.cache.put('devices', 'll', self.message, set(['devices']))
+        self.cache.put('views', 'll', self.message, set(['storage-views']))
+        self.cache.invalidate(('devices',))
+        self.assertFalse(self.cache.get('devices')[0])
+        self.assertTrue(self.cache.get('views')[0])
+
+    def test_put_of_read_that_raced_a_write_is_dropped(self):
+        generation = self.cache.generation
+        self.cache.invalidate(('devices',))
+        self.cache.put('key', 'll', self.message, set(['devices']),
+                       generation=generation)
+        self.assertFalse(self.cache.get('key')[0])
+
+    def test_write_invalidates_the_namespaces_it_changes(self):
+        vplex_rest = rest.VPLEXRest()
+        vplex_rest.cache.put('extents', 'll', self.message,
+                             set(['extents']))
+        vplex_rest.cache.put('views', 'll', self.message,
+                             set(['storage-views']))
+        with mock.patch.object(vplex_rest, '_request',
+                               return_value=(200, None, {})):
+            vplex_rest.create_resource('extent+create', {'args': '-d sv1'})
+        self.assertFalse(vplex_rest.cache.get('extents')[0])
+        self.assertTrue(vplex_rest.cache.get('views')[0])
+
+
+class VPLEXRestStatusTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXRestStatusTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.listed = {'response': {'exception': None,
+                                    'context': [{'attributes': []}]}}
+        self.empty = {'response': {'exception': None, 'context': []}}
+        self.missing = {'response': {
+            'exception': 'll: /clusters/cluster-1/devices/dev1 not found',
+            'context': None}}
+
+    def test_null_exception_is_success(self):
+        for exception_data in (None, 'null'):
+            self.rest.check_status_code_and_message_success(
+                'Create', 200, {'response': {'exception': exception_data}})
+
+    def test_exception_or_error_status_raises(self):
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.rest.check_status_code_and_message_success,
+                          'Create', 200, self.missing)
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.rest.check_status_code_and_message_success,
+                          'Create', 500, None)
+
+    def test_retry_delay_is_capped(self):
+        policy = rest.VPLEXRetryPolicy(retries=5, interval=1,
+                                       max_interval=4)
+        for attempt in range(1, 6):
+            self.assertLessEqual(policy.get_delay(attempt),
+                                 min(4, 2 ** (attempt - 1)))
+
+    def _probe(self, resource_type, args, response):
+        with mock.patch.object(self.rest, '_request',
+                               return_value=response):
+            return self.rest._probe_command(resource_type, args)
+
+    def test_probe_create_that_took_effect(self):
+        self.assertTrue(self._probe('local-device+create',
+                                    {'args': '-n dev1 -e ext1'},
+                                    (200, self.listed, {})))
+
+    def test_probe_create_that_did_not_run(self):
+        args = {'args': '-n dev1 -e ext1'}
+        self.assertFalse(self._probe('local-device+create', args,
+                                     (200, self.empty, {})))
+        self.assertFalse(self._probe('local-device+create', args,
+                                     (404, None, {})))
+        self.assertFalse(self._probe('local-device+create', args,
+                                     (400, self.missing, {})))
+
+    def test_probe_destroy(self):
+        args = {'args': '-d dev1 --force'}
+        self.assertTrue(self._probe('local-device+destroy', args,
+                                    (200, self.empty, {})))
+        self.assertFalse(self._probe('local-device+destroy', args,
+                                     (200, self.listed, {})))
+
+    def test_probe_that_cannot_tell(self):
+        args = {'args': '-n dev1 -e ext1'}
+        self.assertIsNone(self._probe('local-device+create', args,
+                                      (500, None, {})))
+        self.assertIsNone(self._probe('local-device+create', args,
+                                      (None, None, {})))
+        self.assertIsNone(self._probe('unknown+create', args,
+                                      (200, self.listed, {})))
+
+    def test_get_object_raises_unless_not_found(self):
+        with mock.patch.object(self.rest, '_request',
+                               return_value=(400, self.missing, {})):
+            self.assertIsNone(self.rest.get_object(
+                'devices', 'cluster-1', 'dev1'))
+        with mock.patch.object(self.rest, '_request',
+                               return_value=(500, None, {})):
+            self.assertRaises(exception.VolumeBackendAPIException,
+                              self.rest.get_object, 'devices', 'cluster-1',
+                              'dev1')
+
+    def test_probe_multi_target_command_per_target(self):
+        args = {'args': '-d sv1,sv2'}
+        with mock.patch.object(self.rest, '_request', side_effect=[
+                (200, self.listed, {}), (200, self.listed, {})]) as request:
+            self.assertTrue(self.rest._probe_command('extent+create', args))
+        self.assertEqual(
+            ['/clusters/*/storage-elements/extents/extent_sv1_1',
+             '/clusters/*/storage-elements/extents/extent_sv2_1'],
+            [call[1]['request_object']['args']
+             for call in request.call_args_list])
+        with mock.patch.object(self.rest, '_request', side_effect=[
+                (200, self.empty, {}), (200, self.empty, {})]):
+            self.assertFalse(self.rest._probe_command('extent+create', args))
+        # applied to only some targets: neither resend nor report success
+        with mock.patch.object(self.rest, '_request', side_effect=[
+                (200, self.listed, {}), (200, self.empty, {})]):
+            self.assertIsNone(self.rest._probe_command('extent+create',
+                                                       args))
+
+
+class VPLEXEndpointLimiterTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXEndpointLimiterTest, self).setUp()
+        self.limiter = rest.VPLEXEndpointLimiter(max_concurrent=1)
+
+    def test_slot_is_handed_to_a_queued_caller(self):
+        acquired = []
+        self.limiter.acquire(rest.READ_LANE)
+        waiter = threading.Thread(target=lambda: acquired.append(
+            self.limiter.acquire(rest.WRITE_LANE, timeout=5)))
+        waiter.start()
+        time.sleep(0.1)
+        self.assertEqual([], acquired)
+        self.assertEqual(
+            1, self.limiter.get_stats()[rest.WRITE_LANE]['queue_depth'])
+        self.limiter.release()
+        waiter.join()
+        self.assertEqual([None], acquired)
+        self.assertEqual(1, self.limiter.get_stats()['in_flight'])
+        self.limiter.release()
+        self.assertEqual(0, self.limiter.get_stats()['in_flight'])
+
+    def test_wait_for_a_slot_times_out(self):
+        with self.limiter.limit(rest.READ_LANE):
+            self.assertRaises(exception.VolumeBackendAPIException,
+                              self.limiter.acquire, rest.READ_LANE, 0.01)
+            self.assertEqual(
+                0, self.limiter.get_stats()[rest.READ_LANE]['queue_depth'])
+        self.assertEqual(0, self.limiter.get_stats()['in_flight'])
+
+    def test_freed_slots_alternate_between_lanes(self):
+        order = []
+        self.limiter.acquire(rest.READ_LANE)
+
+        def _wait(lane, name):
+            self.limiter.acquire(lane, timeout=5)
+            order.append(name)
+            self.limiter.release()
+
+        waiters = []
+        for lane, name in ((rest.READ_LANE, 'read-1'),
+                           (rest.READ_LANE, 'read-2'),
+                           (rest.WRITE_LANE, 'write-1')):
+            waiter = threading.Thread(target=_wait, args=(lane, name))
+            waiter.start()
+            waiters.append(waiter)
+            time.sleep(0.05)
+        self.limiter.release()
+        for waiter in waiters:
+            waiter.join()
+        self.assertEqual(['read-1', 'write-1', 'read-2'], order)
+
+    def test_rate_limit_paces_requests(self):
+        now = [100.0]
+
+        def _sleep(delay):
+            now[0] += delay
+
+        with mock.patch.object(time, 'time', side_effect=lambda: now[0]), \
+                mock.patch.object(time, 'sleep',
+                                  side_effect=_sleep) as mock_sleep:
+            limiter = rest.VPLEXEndpointLimiter(max_concurrent=8, rate=2)
+            for __ in range(2):
+                limiter.acquire(rest.READ_LANE)
+            mock_sleep.assert_not_called()
+            self.assertRaises(exception.VolumeBackendAPIException,
+                              limiter.acquire, rest.READ_LANE, 0.1)
+            limiter.acquire(rest.READ_LANE)
+            mock_sleep.assert_called_once_with(0.5)
+
+
+class VPLEXEndpointSelectionTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXEndpointSelectionTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        array_info = {'emc': [
+            {'vplex': {'MgmtServerIp': '10.0.0.%d' % index,
+                       'MgmtServerPort': '443', 'Username': 'user',
+                       'Password': 'pass',
+                       'Cluster': 'cluster-%d' % index}}
+            for index in (1, 2)]}
+        with mock.patch.object(self.rest.inventory, 'start'):
+            self.rest.set_rest_credentials(array_info)
+        self.first, self.second = self.rest.endpoints
+
+    def test_healthiest_endpoint_is_chosen(self):
+        self.first.record(2.0, False)
+        self.second.record(0.1, False)
+        self.assertIs(self.second, self.rest._select_endpoint(rest.POST))
+        self.assertIs(self.second, self.rest._select_endpoint(rest.GET))
+        # errors outweigh a lower latency
+        for __ in range(5):
+            self.second.record(0.1, True)
+        self.assertIs(self.first, self.rest._select_endpoint(rest.POST))
+
+    def _trip(self, endpoint):
+        for __ in range(endpoint.breaker.failure_threshold):
+            endpoint.breaker.record_failure()
+
+    def test_open_breaker_is_skipped(self):
+        self._trip(self.first)
+        self.assertIs(self.second, self.rest._select_endpoint(rest.POST))
+        self._trip(self.second)
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.rest._select_endpoint, rest.POST)
+
+    def test_connection_error_fails_over(self):
+        self.second.record(0.5, False)
+        self.first.record(0.1, False)
+        urls = []
+
+        def _send(endpoint, method, url, *args, **kwargs):
+            urls.append(url)
+            if endpoint is self.first:
+                raise requests.ConnectionError('connection refused')
+            return 200, {'response': {'exception': None}}, {}
+
+        with mock.patch.object(self.rest, '_send_request',
+                               side_effect=_send), \
+                mock.patch.object(rest.time, 'sleep') as mock_sleep:
+            status_code, __, __ = self.rest._request(
+                rest.GET, '/ll', resource_type='ll')
+        self.assertEqual(200, status_code)
+        self.assertEqual(['https://10.0.0.1:443/vplex/ll',
+                          'https://10.0.0.2:443/vplex/ll'], urls)
+        self.assertFalse(mock_sleep.called)
+
+
+class VPLEXCircuitBreakerTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXCircuitBreakerTest, self).setUp()
+        self.breaker = rest.VPLEXCircuitBreaker(failure_threshold=2,
+                                                cooldown=30)
+
+    def _open(self):
+        for __ in range(2):
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(rest.BREAKER_CLOSED, self.breaker.state)
+        self.breaker.record_failure()
+        self.assertEqual(rest.BREAKER_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.available())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_half_open_lets_one_trial_through(self):
+        self._open()
+        self.breaker.opened -= 30
+        self.assertTrue(self.breaker.available())
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(rest.BREAKER_HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.available())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_successful_trial_closes(self):
+        self._open()
+        self.breaker.opened -= 30
+        self.breaker.allow_request()
+        self.breaker.record_success()
+        self.assertEqual(rest.BREAKER_CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_failed_trial_opens_again(self):
+        self._open()
+        self.breaker.opened -= 30
+        self.breaker.allow_request()
+        self.breaker.record_failure()
+        self.assertEqual(rest.BREAKER_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.available())
+
+
+class VPLEXDeadlineTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXDeadlineTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.rest.base_uri = 'https://10.0.0.1:443/vplex'
+        self.endpoint = self.rest._get_endpoint(self.rest.base_uri)
+
+    def test_spent_deadline_raises(self):
+        deadline = rest.VPLEXDeadline(0, 'Create volume')
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          deadline.get_timeout, 10)
+
+    def test_timeout_is_bounded_by_the_budget(self):
+        deadline = rest.VPLEXDeadline(5)
+        self.assertLessEqual(deadline.get_timeout(60), 5)
+        self.assertEqual(1, deadline.get_timeout(1))
+
+    def test_sooner_deadline_is_kept(self):
+        outer = rest.VPLEXDeadline(1)
+        with self.rest.deadline(outer):
+            with self.rest.deadline(rest.VPLEXDeadline(60)):
+                self.assertIs(outer, self.rest.get_deadline())
+        self.assertIsNone(self.rest.get_deadline())
+
+    def test_unsent_request_releases_the_half_open_trial(self):
+        breaker = self.endpoint.breaker
+        for __ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        breaker.opened -= breaker.cooldown
+        with self.rest.deadline(rest.VPLEXDeadline(0)):
+            self.assertRaises(exception.VolumeBackendAPIException,
+                              self.rest.request, rest.GET, '/ll')
+        self.assertEqual(rest.BREAKER_HALF_OPEN, breaker.state)
+        self.assertTrue(breaker.available())
+
+
+class VPLEXRestMetricsTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXRestMetricsTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.rest.base_uri = 'https://10.0.0.1:443/vplex'
+        self.session = mock.Mock()
+        self.session.request.return_value = mock.Mock(
+            status_code=200, content=b'{"response": {}}',
+            json=mock.Mock(return_value={'response': {
+                'exception': None, 'context': []}}))
+
+    def test_histogram_buckets_and_counters(self):
+        metrics = rest.VPLEXRestMetrics(buckets=(0.1, 1))
+        for latency in (0.05, 0.5, 5):
+            metrics.request_started()
+            metrics.request_finished('ll', rest.GET, latency, 200, 10, 20)
+        snapshot = metrics.snapshot()
+        histogram = snapshot['latency']['ll GET']
+        self.assertEqual({'0.1': 1, '1': 1, '+Inf': 1},
+                         histogram['buckets'])
+        self.assertEqual(3, histogram['count'])
+        self.assertEqual({200: 3}, snapshot['status_codes'])
+        self.assertEqual(30, snapshot['bytes_sent'])
+        self.assertEqual(60, snapshot['bytes_received'])
+        self.assertEqual(0, snapshot['in_flight'])
+
+    def test_probe_is_labelled_and_counted_in_bytes(self):
+        with mock.patch.object(self.rest, '_get_session',
+                               return_value=self.session):
+            self.rest._probe_command('local-device+create',
+                                     {'args': '-n dev1 -e ext1'})
+        data = self.session.request.call_args[1]['data']
+        self.assertIsInstance(data, six.binary_type)
+        snapshot = self.rest.get_metrics()
+        self.assertEqual(['ll GET'], list(snapshot['latency']))
+        self.assertEqual(len(data), snapshot['bytes_sent'])
+        self.assertEqual(len(b'{"response": {}}'),
+                         snapshot['bytes_received'])
+
+
+class VPLEXJobTrackerTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXJobTrackerTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.tracker = rest.VPLEXJobTracker(
+            self.rest, min_interval=1, max_interval=4, timeout=60)
+        self.success = {'response': {'exception': None}}
+        with mock.patch.object(rest.loopingcall, 'DynamicLoopingCall'):
+            self.job = self.tracker.track('Create extent', '/jobs/1')
+
+    def _poll(self, *responses):
+        with mock.patch.object(self.rest, 'request',
+                               side_effect=list(responses)):
+            for __ in responses:
+                try:
+                    self.tracker._poll()
+                except rest.loopingcall.LoopingCallDone:
+                    break
+
+    def test_job_without_location_is_done_at_once(self):
+        job = self.tracker.track('Create extent', None, self.success)
+        self.assertEqual(rest.JOB_SUCCEEDED, job.status)
+        self.assertEqual(self.success, job.wait(0))
+
+    def test_finished_job_succeeds(self):
+        self._poll((202, None), (200, self.success))
+        self.assertEqual(rest.JOB_SUCCEEDED, self.job.status)
+        self.assertEqual([], self.tracker.get_outstanding())
+
+    def test_job_reporting_an_exception_fails(self):
+        self._poll((200, {'response': {'exception': 'no space'}}))
+        self.assertEqual(rest.JOB_FAILED, self.job.status)
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.job.wait, 0)
+
+    def test_timed_out_or_failed_poll_is_retried(self):
+        self._poll((None, None), (503, None),
+                   exception.VolumeBackendAPIException(data='down'),
+                   (200, self.success))
+        self.assertEqual(rest.JOB_SUCCEEDED, self.job.status)
+
+    def test_job_fails_once_the_timeout_is_reached(self):
+        self._poll((None, None))
+        self.assertFalse(self.job.done)
+        self.job.submitted -= 61
+        self._poll((None, None))
+        self.assertEqual(rest.JOB_FAILED, self.job.status)
+
+    def test_interval_backs_off_while_nothing_changes(self):
+        with mock.patch.object(self.rest, 'request',
+                               return_value=(202, None)):
+            intervals = [self.tracker._poll() for __ in range(4)]
+        self.assertEqual([2, 4, 4, 4], intervals)
+
+    def test_done_callback_runs_on_completion(self):
+        finished = []
+        self.job.add_done_callback(finished.append)
+        self._poll((200, self.success))
+        self.assertEqual([self.job], finished)
+
+
+class VPLEXSingleFlightTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXSingleFlightTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.args = {'args': '/clusters/cluster-1/devices/dev1'}
+
+    def test_followers_share_the_leader_result(self):
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def _get(resource_type, args, missing_ok=False):
+            started.set()
+            release.wait()
+            return {'response': {'context': ['dev1']}}
+
+        with mock.patch.object(self.rest, '_get_resource',
+                               side_effect=_get) as mock_get:
+            leader = threading.Thread(target=lambda: results.append(
+                self.rest.get_resource('ll', self.args)))
+            leader.start()
+            started.wait()
+            follower = threading.Thread(target=lambda: results.append(
+                self.rest.get_resource('ll', self.args)))
+            follower.start()
+            time.sleep(0.1)
+            release.set()
+            leader.join()
+            follower.join()
+        self.assertEqual(1, mock_get.call_count)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(1, self.rest.inflight.get_stats()['coalesced'])
+
+    def test_read_after_write_does_not_join_earlier_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        stale = {'response': {'context': ['stale']}}
+        fresh = {'response': {'context': ['fresh']}}
+        results = {}
+        responses = [stale, fresh]
+
+        def _get(resource_type, args, missing_ok=False):
+            response = responses.pop(0)
+            if response is stale:
+                started.set()
+                release.wait()
+            return response
+
+        with mock.patch.object(self.rest, '_get_resource',
+                               side_effect=_get) as mock_get:
+            leader = threading.Thread(target=lambda: results.setdefault(
+                'leader', self.rest.get_resource('ll', self.args)))
+            leader.start()
+            started.wait()
+            # a write lands while the first read is in flight
+            self.rest.cache.invalidate()
+            follower = threading.Thread(target=lambda: results.setdefault(
+                'follower', self.rest.get_resource('ll', self.args)))
+            follower.start()
+            follower.join(1)
+            release.set()
+            leader.join()
+            follower.join()
+            self.assertEqual(2, mock_get.call_count)
+            self.assertEqual(fresh, results['follower'])
+            self.assertEqual(stale, results['leader'])
+            # the cached copy is the post-write read
+            self.assertEqual(fresh, self.rest.get_resource('ll', self.args))
+            self.assertEqual(2, mock_get.call_count)
+
+
+class VPLEXWorkflowTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXWorkflowTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journal_path = os.path.join(directory, 'journal.sqlite')
+        self.rest = mock.MagicMock()
+        self.rest.propagate_context.side_effect = lambda func: func
+        self.calls = []
+
+    def _step(self, name, error=None, delay=0):
+        def _run(*args):
+            time.sleep(delay)
+            self.calls.append(name)
+            if error is not None:
+                raise error
+            return name
+        return _run
+
+    def test_steps_run_after_their_requirements(self):
+        workflow = adapter.VPLEXWorkflow('create', self.rest)
+        claim = workflow.add_step('claim', self._step('claim', delay=0.02))
+        extent = workflow.add_step('extent', self._step('extent'),
+                                   requires=[claim])
+        other = workflow.add_step('other-claim', self._step('other-claim'))
+        workflow.add_step('mirror', self._step('mirror'),
+                          requires=[extent, other])
+        results = workflow.run()
+        self.assertEqual('mirror', self.calls[-1])
+        self.assertLess(self.calls.index('claim'),
+                        self.calls.index('extent'))
+        self.assertEqual('extent', results['extent'])
+        self.assertEqual(set([adapter.STEP_SUCCESS]), set(
+            state for state, __ in workflow.get_timings().values()))
+
+    def test_max_workers_bounds_concurrency(self):
+        running = []
+        peak = []
+
+        def _run():
+            running.append(1)
+            peak.append(len(running))
+            time.sleep(0.02)
+            running.pop()
+
+        workflow = adapter.VPLEXWorkflow('create', self.rest, max_workers=2)
+        for index in range(5):
+            workflow.add_step('leg-%d' % index, _run)
+        workflow.run()
+        self.assertEqual(2, max(peak))
+
+    def test_fail_fast_starts_no_further_steps(self):
+        error = exception.VolumeBackendAPIException(data='claim failed')
+        workflow = adapter.VPLEXWorkflow('create', self.rest)
+        claim = workflow.add_step('claim', self._step('claim', error))
+        workflow.add_step('extent', self._step('extent'), requires=[claim])
+        rescan = workflow.add_step('rescan', self._step('rescan', delay=0.05))
+        workflow.add_step('other-claim', self._step('other-claim'),
+                          requires=[rescan])
+        raised = self.assertRaises(exception.VolumeBackendAPIException,
+                                   workflow.run)
+        self.assertIs(error, raised)
+        self.assertEqual(['claim', 'rescan'], self.calls)
+        self.assertEqual(adapter.STEP_SKIPPED,
+                         workflow.get_timings()['other-claim'][0])
+
+    def test_without_fail_fast_all_failures_are_reported(self):
+        workflow = adapter.VPLEXWorkflow('delete', self.rest,
+                                         fail_fast=False)
+        for leg in range(2):
+            extent = workflow.add_step(
+                'destroy-extent-%d' % leg, self._step(
+                    'destroy-extent-%d' % leg,
+                    exception.VolumeBackendAPIException(
+                        data='extent %d busy' % leg)))
+            workflow.add_step('unclaim-%d' % leg,
+                              self._step('unclaim-%d' % leg),
+                              requires=[extent])
+        workflow.add_step('forget', self._step('forget'))
+        raised = self.assertRaises(exception.VolumeBackendAPIException,
+                                   workflow.run)
+        self.assertIn('destroy-extent-0', six.text_type(raised))
+        self.assertIn('extent 1 busy', six.text_type(raised))
+        self.assertIn('forget', self.calls)
+        self.assertNotIn('unclaim-0', self.calls)
+
+    def test_accepted_job_is_waited_on(self):
+        job = rest.VPLEXJob('Create extent', '/jobs/1')
+        self.rest.wait_for_job.return_value = {'response': {}}
+        workflow = adapter.VPLEXWorkflow('create', self.rest)
+        workflow.add_step('extent', lambda: job)
+        self.assertEqual({'response': {}}, workflow.run()['extent'])
+        self.rest.wait_for_job.assert_called_once_with(job)
+
+    def test_journaled_steps_are_not_run_again(self):
+        journal = mock.Mock()
+        journal.get_steps.return_value = ['claim']
+        workflow = adapter.VPLEXWorkflow(
+            'create', self.rest, journal=journal,
+            journal_key=('vol1', adapter.JOURNAL_CREATE))
+        claim = workflow.add_step('claim', self._step('claim'))
+        workflow.add_step('extent', self._step('extent'), requires=[claim])
+        workflow.run()
+        self.assertEqual(['extent'], self.calls)
+        self.assertEqual(adapter.STEP_RESUMED,
+                         workflow.get_timings()['claim'][0])
+        journal.record.assert_called_once_with(
+            'vol1', adapter.JOURNAL_CREATE, 'extent')
+
+    def test_rollback_undoes_dependants_first(self):
+        workflow = adapter.VPLEXWorkflow('create', self.rest)
+        claim = workflow.add_step('claim', self._step('claim'))
+        extent = workflow.add_step('extent', self._step('extent'),
+                                   requires=[claim])
+        workflow.add_step('device', self._step('device'), requires=[extent])
+        rollback = workflow.get_rollback(
+            'rollback', {'claim': (self._step('unclaim'), ()),
+                         'extent': (self._step('destroy-extent'), ())},
+            ['claim', 'extent'])
+        rollback.run()
+        self.assertEqual(['destroy-extent', 'unclaim'], self.calls)
+        self.assertFalse(rollback.fail_fast)
+
+    def test_invalid_graph_raises(self):
+        workflow = adapter.VPLEXWorkflow('create', self.rest)
+        workflow.add_step('claim', self._step('claim'), requires=['rescan'])
+        self.assertRaises(ValueError, workflow.run)
+        self.assertRaises(ValueError, workflow.add_step, 'claim',
+                          self._step('claim'))
+        cycle = adapter.VPLEXWorkflow('create', self.rest)
+        cycle.add_step('a', self._step('a'), requires=['b'])
+        cycle.add_step('b', self._step('b'), requires=['a'])
+        self.assertRaises(ValueError, cycle.run)
+
+    def test_leg_device_destroy_waits_for_the_distributed_device(self):
+        vplex_rest = mock.Mock()
+        configuration = mock.Mock()
+        configuration.safe_get.side_effect = {
+            'vplex_create_batch_window': 0,
+            'vplex_journal_path': self.journal_path}.get
+        vplex_adapter = adapter.VPLEXAdapter(configuration, vplex_rest)
+        vplex_rest.get_extent_devices.return_value = ['dev1_20170601']
+        vplex_rest.destroy_local_device.side_effect = (
+            lambda name: vplex_rest.wait_for_job.assert_called_once_with(
+                vplex_rest.destroy_distributed_devices.return_value))
+        vplex_adapter._destroy_leg_device('dev1', 'cluster-1', 'ext1')
+        vplex_rest.get_extent_devices.assert_called_once_with('cluster-1',
+                                                              'ext1')
+        vplex_rest.destroy_local_device.assert_called_once_with(
+            'dev1_20170601')
+
+    def test_legs_are_created_concurrently(self):
+        configuration = mock.Mock()
+        configuration.safe_get.side_effect = {
+            'vplex_create_batch_window': 0,
+            'vplex_journal_path': self.journal_path}.get
+        vplex_rest = rest.VPLEXRest()
+        vplex_adapter = adapter.VPLEXAdapter(configuration, vplex_rest)
+        events = []
+
+        def _claim(lun, storage_volume):
+            events.append(('start', lun))
+            time.sleep(0.02)
+            events.append(('end', lun))
+
+        extra_specs = {
+            'array-info': {'cluster_name': ['cluster-1', 'cluster-2'],
+                           'hards': ['hard1', 'hard2'],
+                           'storage_volumes': ['sv1', 'sv2']},
+            'volume_info': {'lun': ['lun1', 'lun2'],
+                            'device': ['dev1', 'dev2'],
+                            'extent': ['ext1', 'ext2'],
+                            'volume_name': 'vol1_vol', 'geometry': 'raid-0',
+                            'count': 2}}
+        with mock.patch.multiple(
+                vplex_rest, rediscover_array=mock.DEFAULT,
+                claim_storage_volume=mock.Mock(side_effect=_claim),
+                create_extent=mock.DEFAULT,
+                create_local_device=mock.DEFAULT,
+                create_virtual_volume=mock.DEFAULT,
+                attach_mirror_device=mock.DEFAULT) as commands:
+            vplex_adapter._create_volume({'id': 'vol1'}, extra_specs)
+        self.assertEqual(set(['start']), set(event for event, __
+                                             in events[:2]))
+        commands['attach_mirror_device'].assert_called_once_with(
+            'dev1', 'dev2')
+
+    def test_failure_cancels_a_leg_waiting_on_its_job(self):
+        vplex_rest = rest.VPLEXRest()
+        job = rest.VPLEXJob('Claim storage volume', '/jobs/1')
+        error = exception.VolumeBackendAPIException(data='extent failed')
+        workflow = adapter.VPLEXWorkflow('create', vplex_rest)
+        workflow.add_step('extent-0', self._step('extent-0', error,
+                                                 delay=0.01))
+        claim = workflow.add_step('claim-1', lambda: job)
+        workflow.add_step('extent-1', self._step('extent-1'),
+                          requires=[claim])
+        with mock.patch.object(rest, 'JOB_POLL_MIN_INTERVAL', 0.01):
+            raised = self.assertRaises(exception.VolumeBackendAPIException,
+                                       workflow.run)
+        self.assertIs(error, raised)
+        self.assertEqual(['extent-0'], self.calls)
+        timings = workflow.get_timings()
+        self.assertEqual(adapter.STEP_CANCELLED, timings['claim-1'][0])
+        self.assertEqual(adapter.STEP_SKIPPED, timings['extent-1'][0])
+
+    def test_cancelled_work_sends_no_command(self):
+        vplex_rest = rest.VPLEXRest()
+        cancel = threading.Event()
+        cancel.set()
+        with mock.patch.object(vplex_rest, '_send_request') as send:
+            with vplex_rest.cancellation(cancel):
+                self.assertRaises(exception.VolumeBackendAPIException,
+                                  vplex_rest.create_extent, 'lun1')
+        self.assertFalse(send.called)
+        # outside the block the work goes on
+        vplex_rest.check_cancelled()
+
+
+class VPLEXCreateBatchTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXCreateBatchTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journal_path = os.path.join(directory, 'journal.sqlite')
+        self.rest = mock.Mock()
+        self.rest.deadline.return_value = mock.MagicMock()
+        self.configuration = mock.Mock()
+        self.configuration.safe_get.side_effect = {
+            'vplex_journal_path': self.journal_path}.get
+        self.adapter = adapter.VPLEXAdapter(self.configuration, self.rest)
+
+    def test_merging_is_off_by_default(self):
+        self.assertIsNone(self.adapter.create_batcher)
+
+    def test_expired_request_fails_alone(self):
+        expired = rest.VPLEXDeadline(0, 'Create volume')
+        live = rest.VPLEXDeadline(60, 'Create volume')
+        volume_1 = {'id': 'vol1'}
+        volume_2 = {'id': 'vol2'}
+        with mock.patch.object(self.adapter, '_create_volume') as create:
+            results = self.adapter._create_volume_batch(
+                [(volume_1, {}, expired), (volume_2, {}, live)])
+        create.assert_called_once_with(volume_2, {})
+        self.assertIsInstance(results[0],
+                              exception.VolumeBackendAPIException)
+        self.assertIsNone(results[1])
+        # the shared work runs within the caller's deadline, not the
+        # leader's
+        self.rest.deadline.assert_called_once_with(live, replace=True)
+
+    def test_each_volume_keeps_its_deadline(self):
+        deadline_1 = rest.VPLEXDeadline(30, 'Create volume')
+        deadline_2 = rest.VPLEXDeadline(60, 'Create volume')
+        volume_1 = {'id': 'vol1'}
+        volume_2 = {'id': 'vol2'}
+        with mock.patch.object(self.adapter, 'create_volumes',
+                               return_value={'vol1': None,
+                                             'vol2': None}) as create:
+            self.adapter._create_volume_batch(
+                [(volume_1, {}, deadline_1), (volume_2, {}, deadline_2)])
+        create.assert_called_once_with(
+            [(volume_1, {}), (volume_2, {})],
+            {'vol1': deadline_1, 'vol2': deadline_2})
+        self.rest.deadline.assert_called_once_with(deadline_2, replace=True)
+
+    def test_grouped_fallback_skips_applied_targets(self):
+        self.rest.claim_storage_volumes.__name__ = 'claim_storage_volumes'
+        self.rest.claim_storage_volume.__name__ = 'claim_storage_volume'
+        self.rest.claim_storage_volumes.side_effect = (
+            exception.VolumeBackendAPIException(data='sv2 in use'))
+        self.rest.is_storage_volume_claimed.side_effect = (
+            lambda name: name == 'lun1')
+        journaled = {'vol1': set(), 'vol2': set()}
+        with mock.patch.object(self.adapter.journal, 'record'):
+            failed, done = self.adapter._run_grouped(
+                [('vol1', 'claim-0', ('lun1', 'sv1')),
+                 ('vol2', 'claim-0', ('lun2', 'sv2'))],
+                {}, journaled, self.rest.claim_storage_volumes,
+                self.rest.claim_storage_volume,
+                self.rest.is_storage_volume_claimed, {})
+        self.rest.claim_storage_volumes.assert_called_once_with(
+            ['lun1', 'lun2'], ['sv1', 'sv2'])
+        self.rest.claim_storage_volume.assert_called_once_with('lun2', 'sv2')
+        self.assertEqual([('vol1', 'claim-0'), ('vol2', 'claim-0')], done)
+        self.assertEqual({}, failed)
+        # the volumes' state is left to the caller
+        self.assertEqual({'vol1': set(), 'vol2': set()}, journaled)
+
+    def test_failed_command_is_charged_to_its_volumes(self):
+        error = exception.VolumeBackendAPIException(data='array busy')
+        self.rest.rediscover_array.side_effect = error
+        failures = {'vol3': error}
+        journaled = {'vol1': set(), 'vol2': set(['rediscover-0']),
+                     'vol3': set()}
+        run = self.adapter._collect(failures, journaled,
+                                    self.adapter._run_for_volumes)
+        run([('vol1', 'rediscover-0'), ('vol2', 'rediscover-0'),
+             ('vol3', 'rediscover-0')], failures, journaled,
+            self.rest.rediscover_array, 'cluster-1', 'array-1')
+        self.assertEqual({'vol1': error, 'vol3': error}, failures)
+
+
+class VPLEXViewBatchTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXViewBatchTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.options = {
+            'vplex_journal_path': os.path.join(directory, 'journal.sqlite')}
+        self.configuration = mock.Mock()
+        self.configuration.safe_get.side_effect = self.options.get
+        self.rest = mock.Mock()
+
+    def _adapter(self, window):
+        self.options['vplex_attach_batch_window'] = window
+        self.options['vplex_detach_batch_window'] = window
+        return adapter.VPLEXAdapter(self.configuration, self.rest)
+
+    @staticmethod
+    def _run_together(func, calls):
+        threads = [threading.Thread(target=func, args=args)
+                   for args in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_attach_is_sent_at_once_by_default(self):
+        vplex_adapter = self._adapter(None)
+        vplex_adapter._add_volume_to_view('cluster-1', 'view1', 'vol1_vol')
+        add_volume = self.rest.addvirtualvolume_to_export_storage_view
+        add_volume.assert_called_once_with('view1', 'vol1_vol')
+        self.assertEqual({}, vplex_adapter._attach_batchers)
+
+    def test_attaches_are_merged_per_cluster_view(self):
+        vplex_adapter = self._adapter(0.02)
+        self._run_together(vplex_adapter._add_volume_to_view, [
+            ('cluster-1', 'view1', 'vol1_vol'),
+            ('cluster-1', 'view1', 'vol2_vol'),
+            ('cluster-2', 'view1', 'vol1_vol')])
+        calls = sorted(
+            (args[0], sorted(args[1].split(','))) for args, __ in
+            self.rest.addvirtualvolume_to_export_storage_view.call_args_list)
+        self.assertEqual([('view1', ['vol1_vol']),
+                          ('view1', ['vol1_vol', 'vol2_vol'])], calls)
+        # an idle view keeps no batcher
+        self.assertEqual({}, vplex_adapter._attach_batchers)
+
+    def test_detaches_are_merged_per_cluster_view(self):
+        vplex_adapter = self._adapter(0.02)
+        self._run_together(vplex_adapter._remove_volume_from_view, [
+            ('cluster-1', 'view1', 'vol1_vol'),
+            ('cluster-1', 'view1', 'vol2_vol')])
+        remove = self.rest.removevirtualvolume_export_storage_view
+        self.assertEqual(1, remove.call_count)
+        virtual_volumes, view = remove.call_args[0]
+        self.assertEqual('view1', view)
+        self.assertEqual(['vol1_vol', 'vol2_vol'],
+                         sorted(virtual_volumes.split(',')))
+        self.assertEqual({}, vplex_adapter._detach_batchers)
+
+    def test_failed_merge_falls_back_per_volume(self):
+        vplex_adapter = self._adapter(None)
+        error = exception.VolumeBackendAPIException(data='vol2 busy')
+
+        def _remove(view, virtual_volumes):
+            if ',' in virtual_volumes or virtual_volumes == 'vol2_vol':
+                raise error
+
+        command = mock.Mock(side_effect=_remove,
+                            __name__='removevirtualvolume')
+        results = vplex_adapter._run_view_batch(
+            command, 'view1', ['vol1_vol', 'vol2_vol', 'vol1_vol'])
+        self.assertEqual([None, error, None], results)
+        command.assert_has_calls([mock.call('view1', 'vol1_vol,vol2_vol'),
+                                  mock.call('view1', 'vol1_vol'),
+                                  mock.call('view1', 'vol2_vol')])
+
+
+class VPLEXRediscoveryTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXRediscoveryTest, self).setUp()
+        self.rest = rest.VPLEXRest()
+        self.listed = {'response': {'exception': None,
+                                    'context': [{'attributes': []}]}}
+        self.missing = {'response': {
+            'exception': 'll: storage-volumes/VPD83T3:6000 not found',
+            'context': None}}
+        mock.patch.object(self.rest, 're_discovery_arrays').start()
+        mock.patch.object(self.rest, 'wait_for_job').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _rediscover(self, response, storage_volumes=('VPD83T3:6000',)):
+        with mock.patch.object(self.rest, '_request',
+                               return_value=response):
+            self.rest.rediscover_array('cluster-1', 'array-1',
+                                       storage_volumes)
+
+    def test_visible_storage_volume_needs_no_rediscovery(self):
+        self._rediscover((200, self.listed, {}))
+        self.assertFalse(self.rest.re_discovery_arrays.called)
+
+    def test_missing_storage_volume_is_rediscovered_again(self):
+        self._rediscover((400, self.missing, {}))
+        self.rest.re_discovery_arrays.assert_called_once_with(
+            'cluster-1', 'array-1')
+        # a finished rediscovery did not find it, so it is of no use
+        self._rediscover((404, None, {}))
+        self.assertEqual(2, self.rest.re_discovery_arrays.call_count)
+
+    def test_running_rediscovery_is_joined(self):
+        self.rest.re_discovery_arrays.side_effect = (
+            lambda cluster, hard: time.sleep(0.05))
+        threads = [threading.Thread(target=self.rest.rediscover_array,
+                                    args=('cluster-1', 'array-1',
+                                          ('VPD83T3:6000',)))
+                   for __ in range(2)]
+        with mock.patch.object(self.rest, '_request',
+                               return_value=(404, None, {})):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.rest.re_discovery_arrays.assert_called_once_with(
+            'cluster-1', 'array-1')
+
+    def test_inventory_hit_must_be_on_the_cluster(self):
+        listing = {'response': {'exception': None, 'context': [
+            {'attributes': [{'name': 'name', 'value': 'sv1'},
+                            {'name': 'vpd-id',
+                             'value': 'VPD83T3:6000'}]}]}}
+        with mock.patch.object(self.rest, 'get_resource',
+                               return_value=listing):
+            self.rest.inventory.refresh('cluster-2', 'storage-volumes')
+        self.assertTrue(self.rest.is_storage_volume_visible(
+            'cluster-2', 'VPD83T3:6000'))
+        with mock.patch.object(self.rest, '_request',
+                               return_value=(404, None, {})):
+            self.assertFalse(self.rest.is_storage_volume_visible(
+                'cluster-1', 'VPD83T3:6000'))
+        self.assertEqual('cluster-2', self.rest.inventory.find_by_vpd(
+            '6000')['cluster'])
+
+    def test_failed_visibility_check_raises(self):
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self._rediscover, (500, None, {}))
+        self.assertFalse(self.rest.re_discovery_arrays.called)
+
+    def test_recent_rediscovery_is_reused(self):
+        self.rest.rediscover_array('cluster-1', 'array-1')
+        self.rest.rediscover_array('cluster-1', 'array-1')
+        self.rest.re_discovery_arrays.assert_called_once_with(
+            'cluster-1', 'array-1')
+        self.rest.rediscovery_ttl = 0
+        self.rest.rediscover_array('cluster-1', 'array-1')
+        self.assertEqual(2, self.rest.re_discovery_arrays.call_count)
+
+
+class VPLEXStepJournalTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXStepJournalTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'journal.sqlite')
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, self.path)
+        self.journal = adapter.VPLEXStepJournal(self.path)
+
+    def test_steps_survive_a_restart(self):
+        self.journal.record('vol1', adapter.JOURNAL_CREATE, 'claim-0')
+        self.journal.record('vol1', adapter.JOURNAL_CREATE, 'extent-0')
+        self.journal.record('vol1', adapter.JOURNAL_DELETE, 'unclaim-0')
+        journal = adapter.VPLEXStepJournal(self.path)
+        self.assertEqual(['claim-0', 'extent-0'], journal.get_steps(
+            'vol1', adapter.JOURNAL_CREATE))
+        self.assertEqual([], journal.get_steps('vol2',
+                                               adapter.JOURNAL_CREATE))
+
+    def test_forget(self):
+        self.journal.record('vol1', adapter.JOURNAL_CREATE, 'claim-0')
+        self.journal.record('vol1', adapter.JOURNAL_DELETE, 'unclaim-0')
+        self.journal.queue_reap('vol1', [{'device': 'dev1'}])
+        self.journal.forget('vol1', adapter.JOURNAL_CREATE)
+        self.assertEqual([], self.journal.get_steps(
+            'vol1', adapter.JOURNAL_CREATE))
+        self.assertEqual(['unclaim-0'], self.journal.get_steps(
+            'vol1', adapter.JOURNAL_DELETE))
+        self.journal.forget('vol1')
+        self.assertEqual([], self.journal.get_steps(
+            'vol1', adapter.JOURNAL_DELETE))
+        self.assertEqual([], self.journal.get_reap_queue())
+
+    def test_reap_queue_order(self):
+        self.journal.queue_reap('vol1', [{'device': 'dev1'}])
+        self.journal.queue_reap('vol2', [{'device': 'dev2'}])
+        self.assertEqual([('vol1', [{'device': 'dev1'}])],
+                         self.journal.get_reap_queue(limit=1))
+        self.journal.requeue_reap('vol1')
+        self.assertEqual(['vol2', 'vol1'], [
+            volume_id for volume_id, __ in self.journal.get_reap_queue()])
+
+    def test_database_calls_run_in_a_native_thread(self):
+        with mock.patch.object(adapter.tpool, 'execute',
+                               wraps=adapter.tpool.execute) as execute:
+            self.journal.record('vol1', adapter.JOURNAL_CREATE, 'claim-0')
+            self.journal.get_steps('vol1', adapter.JOURNAL_CREATE)
+        self.assertEqual(2, execute.call_count)
+
+
+class VPLEXInventoryTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXInventoryTest, self).setUp()
+        self.rest = mock.Mock()
+        self.inventory = rest.VPLEXInventory(self.rest)
+        self.inventory.clusters = ['cluster-1']
+
+    @staticmethod
+    def _listing(*objects):
+        return {'response': {'exception': None, 'context': [
+            {'attributes': [{'name': name, 'value': value}
+                            for name, value in attributes]}
+            for attributes in objects]}}
+
+    def test_apply_create_and_destroy(self):
+        self.inventory.apply('export+storage-view+create',
+                             {'args': '--cluster cluster-1 --name view1 '
+                                      '--ports P1,P2'})
+        view = self.inventory.get('storage-views', 'view1', 'cluster-1')
+        self.assertEqual(['P1', 'P2'], view['attributes']['ports'])
+        self.inventory.apply('export+storage-view+destroy',
+                             {'args': '--view view1'})
+        self.assertIsNone(self.inventory.get('storage-views', 'view1'))
+
+    def test_apply_add_member(self):
+        self.inventory.apply('export+storage-view+create',
+                             {'args': '--cluster cluster-1 --name view1 '
+                                      '--ports P1'})
+        self.inventory.apply('export+storage-view+addvirtualvolume',
+                             {'args': '--view view1 '
+                                      '--virtual-volumes vol1_vol,vol2_vol'})
+        self.assertEqual(['view1'], [
+            entry['name'] for entry in self.inventory.find_by_member(
+                'storage-views', 'virtual-volumes', 'vol2_vol',
+                'cluster-1')])
+
+    def test_refresh_replaces_the_listing(self):
+        self.inventory.apply('export+storage-view+create',
+                             {'args': '--cluster cluster-1 --name gone '
+                                      '--ports P1'})
+        self.rest.get_resource.return_value = self._listing(
+            [('name', 'view1'),
+             ('virtual-volumes', '(0,vol1_vol,VPD83T3:6000,1G),'
+                                 '(1,vol2_vol,VPD83T3:6001,1G)')])
+        self.assertFalse(self.inventory.is_loaded('storage-views',
+                                                  'cluster-1'))
+        self.inventory.refresh('cluster-1', 'storage-views')
+        self.assertTrue(self.inventory.is_loaded('storage-views',
+                                                 'cluster-1'))
+        self.assertIsNone(self.inventory.get('storage-views', 'gone'))
+        view = self.inventory.get('storage-views', 'view1', 'cluster-1')
+        self.assertEqual(['vol1_vol', 'vol2_vol'],
+                         view['attributes']['virtual-volumes'])
+
+    def test_refresh_applies_the_commands_run_while_listing(self):
+        def _list(resource_type, args, use_cache=True):
+            # the listing was read before the view was created
+            self.inventory.apply('export+storage-view+create',
+                                 {'args': '--cluster cluster-1 '
+                                          '--name view2 --ports P1'})
+            return self._listing([('name', 'view1')])
+
+        self.rest.get_resource.side_effect = _list
+        self.inventory.refresh('cluster-1', 'storage-views')
+        self.assertTrue(self.inventory.is_loaded('storage-views',
+                                                 'cluster-1'))
+        self.assertIsNotNone(self.inventory.get('storage-views', 'view1'))
+        self.assertIsNotNone(self.inventory.get('storage-views', 'view2'))
+
+
+class VPLEXStorageViewTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXStorageViewTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        configuration = mock.Mock()
+        configuration.safe_get.side_effect = {
+            'vplex_attach_batch_window': 0,
+            'vplex_journal_path': os.path.join(directory,
+                                               'journal.sqlite')}.get
+        self.rest = mock.MagicMock()
+        self.rest.propagate_context.side_effect = lambda func: func
+        self.adapter = adapter.VPLEXAdapter(configuration, self.rest)
+        self.objects = {}
+        self.rest.get_object.side_effect = (
+            lambda object_type, cluster, name:
+                self.objects.get((object_type, name)))
+        self.extra_specs = {
+            'array-info': {'cluster_name': ['cluster-1']},
+            'array_info': {'port_group': ['P1,P2']},
+            'volume_info': {'sv_name': ['view1'],
+                            'initiator_port': ['host1_port'],
+                            'port': ['0x10000000c9000001'],
+                            'virtual_volume': 'vol1_vol', 'count': 1}}
+
+    def _called(self):
+        return set(name for name in (
+            'create_export_storage_view', 'register_export_initiator_port',
+            'addinitiatorport_to_export_storage_view',
+            'addport_to_export_storage_view',
+            'addvirtualvolume_to_export_storage_view')
+            if getattr(self.rest, name).called)
+
+    def test_existing_view_only_gets_the_volume(self):
+        self.objects[('storage-views', 'view1')] = {
+            'name': 'view1', 'initiators': ['host1_port'],
+            'ports': ['P1', 'P2'], 'virtual-volumes': ['vol2_vol']}
+        self.adapter.check_and_create_storage_view({}, self.extra_specs)
+        self.assertEqual(set(['addvirtualvolume_to_export_storage_view']),
+                         self._called())
+        add_volume = self.rest.addvirtualvolume_to_export_storage_view
+        add_volume.assert_called_once_with('view1', 'vol1_vol')
+        # the initiator in the view needs no lookup of its own
+        self.rest.get_object.assert_called_once_with(
+            'storage-views', 'cluster-1', 'view1')
+
+    def test_missing_initiator_and_port_are_added(self):
+        self.objects[('storage-views', 'view1')] = {
+            'name': 'view1', 'initiators': [], 'ports': ['P1'],
+            'virtual-volumes': []}
+        self.adapter.check_and_create_storage_view({}, self.extra_specs)
+        self.assertEqual(set(['register_export_initiator_port',
+                              'addinitiatorport_to_export_storage_view',
+                              'addport_to_export_storage_view',
+                              'addvirtualvolume_to_export_storage_view']),
+                         self._called())
+        self.rest.addport_to_export_storage_view.assert_called_once_with(
+            'view1', 'P2')
+
+    def test_new_view_is_created_with_its_ports(self):
+        self.objects[('initiator-ports', 'host1_port')] = {
+            'name': 'host1_port'}
+        self.adapter.check_and_create_storage_view({}, self.extra_specs)
+        self.assertEqual(set(['create_export_storage_view',
+                              'addinitiatorport_to_export_storage_view',
+                              'addvirtualvolume_to_export_storage_view']),
+                         self._called())
+        self.rest.create_export_storage_view.assert_called_once_with(
+            'cluster-1', 'view1', 'P1,P2')
+
+
+class VPLEXHostViewsTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXHostViewsTest, self).setUp()
+        self.host_views = adapter.VPLEXHostViews(grace_period=0.02)
+        self.teardown = mock.Mock()
+
+    def test_acquire_and_release(self):
+        self.host_views.acquire('cluster-1', 'view1', 'vol1_vol')
+        self.host_views.acquire('cluster-1', 'view1', 'vol2_vol')
+        self.host_views.acquire('cluster-2', 'view1', 'vol1_vol')
+        self.assertEqual(1, self.host_views.release('cluster-1', 'view1',
+                                                    'vol1_vol'))
+        self.assertEqual({('cluster-1', 'view1'): 1,
+                          ('cluster-2', 'view1'): 1},
+                         self.host_views.get_stats()['volumes'])
+        self.assertEqual(0, self.host_views.release('cluster-1', 'view1',
+                                                    'vol2_vol'))
+
+    def test_unused_view_is_torn_down_after_the_grace_period(self):
+        self.host_views.schedule_teardown('cluster-1', 'view1',
+                                          self.teardown)
+        self.assertEqual(1, self.host_views.get_stats()['pending_teardowns'])
+        self.assertFalse(self.teardown.called)
+        time.sleep(0.05)
+        self.teardown.assert_called_once_with()
+        self.assertEqual({'volumes': {}, 'pending_teardowns': 0},
+                         self.host_views.get_stats())
+
+    def test_attach_cancels_a_pending_teardown(self):
+        self.host_views.schedule_teardown('cluster-1', 'view1',
+                                          self.teardown)
+        self.host_views.acquire('cluster-1', 'view1', 'vol1_vol')
+        self.assertEqual(0, self.host_views.get_stats()['pending_teardowns'])
+        time.sleep(0.05)
+        self.assertFalse(self.teardown.called)
+
+    def test_view_still_holding_volumes_is_kept(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        configuration = mock.Mock()
+        configuration.safe_get.side_effect = {
+            'vplex_journal_path': os.path.join(directory,
+                                               'journal.sqlite')}.get
+        vplex_rest = mock.Mock()
+        vplex_adapter = adapter.VPLEXAdapter(configuration, vplex_rest)
+        # volumes attached before a restart are not counted
+        vplex_rest.get_object.return_value = {
+            'name': 'view1', 'virtual-volumes': ['vol2_vol']}
+        with mock.patch.object(vplex_adapter.host_views,
+                               'schedule_teardown') as schedule:
+            vplex_adapter._release_host_view('cluster-1', 'view1', 'P1',
+                                             'host1_port', 'vol1_vol')
+            self.assertFalse(schedule.called)
+            vplex_rest.get_object.return_value = {
+                'name': 'view1', 'virtual-volumes': []}
+            vplex_adapter._release_host_view('cluster-1', 'view1', 'P1',
+                                             'host1_port', 'vol1_vol')
+        self.assertEqual(('cluster-1', 'view1'),
+                         schedule.call_args[0][:2])
+
+
+class VPLEXDeleteVolumeTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXDeleteVolumeTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journal_path = os.path.join(directory, 'journal.sqlite')
+        configuration = mock.Mock()
+        configuration.safe_get.side_effect = {
+            'vplex_journal_path': self.journal_path}.get
+        vplex_rest = mock.MagicMock()
+        vplex_rest.propagate_context.side_effect = lambda func: func
+        self.adapter = adapter.VPLEXAdapter(configuration, vplex_rest)
+        self.extra_specs = {'volume_info': {
+            'volume_name': 'vol1_vol', 'cg_name': 'cg1',
+            'device': ['dev1'], 'extent': ['ext1'], 'count': 1}}
+        mock.patch.object(self.adapter.journal, 'get_steps',
+                          return_value=['claim-0']).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_workflow_failure_keeps_its_message(self):
+        error = exception.VolumeBackendAPIException(
+            data='Workflow rollback failed at steps unclaim-0')
+        with mock.patch.object(self.adapter, '_rollback_create',
+                               side_effect=error):
+            raised = self.assertRaises(exception.VolumeBackendAPIException,
+                                       self.adapter.delete_volume,
+                                       {'id': 'vol1'}, self.extra_specs)
+        self.assertIs(error, raised)
+
+    def test_other_failure_is_described(self):
+        with mock.patch.object(self.adapter, '_rollback_create',
+                               side_effect=KeyError('array-info')):
+            raised = self.assertRaises(exception.VolumeBackendAPIException,
+                                       self.adapter.delete_volume,
+                                       {'id': 'vol1'}, self.extra_specs)
+        self.assertIn('vol1_vol', six.text_type(raised))
+        self.assertIn('array-info', six.text_type(raised))
+
+    def test_legs_destroy_the_local_devices_the_array_reports(self):
+        self.extra_specs['array-info'] = {
+            'cluster_name': ['cluster-1', 'cluster-2'],
+            'hards': ['hard1', 'hard2']}
+        self.extra_specs['volume_info'].update({
+            'device': ['dev1', 'dev2'], 'extent': ['ext1', 'ext2'],
+            'lun': ['lun1', 'lun2'], 'count': 2})
+        vplex_rest = self.adapter.rest
+        vplex_rest.get_extent_devices.side_effect = (
+            lambda cluster, extent: ['%s_local' % extent])
+        with mock.patch.object(self.adapter.journal, 'get_steps',
+                               return_value=[]):
+            self.adapter.delete_volume({'id': 'vol1'}, self.extra_specs)
+        self.assertEqual(
+            set(['ext1_local', 'ext2_local']),
+            set(args[0] for args, __ in
+                vplex_rest.destroy_local_device.call_args_list))
+        vplex_rest.get_extent_devices.assert_any_call('cluster-2', 'ext2')
+
+
+class VPLEXDeleteReaperTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXDeleteReaperTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, 'journal.sqlite')
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, self.path)
+        self.journal = adapter.VPLEXStepJournal(self.path, 'vplex-a')
+        self.rest = mock.Mock(base_uri='https://vplex/vplex')
+        self.reaped = []
+
+    def _reap(self, volume_id, legs):
+        if volume_id == 'vol2':
+            raise exception.VolumeBackendAPIException(data='device busy')
+        self.reaped.append(volume_id)
+        self.journal.forget(volume_id)
+
+    def test_each_backend_reaps_its_own_queue(self):
+        other = adapter.VPLEXStepJournal(self.path, 'vplex-b')
+        self.journal.queue_reap('vol1', [{'device': 'dev1'}])
+        other.queue_reap('vol2', [{'device': 'dev2'}])
+        self.assertEqual(['vol1'], [volume_id for volume_id, __
+                                    in self.journal.get_reap_queue()])
+        self.assertEqual(['vol2'], [volume_id for volume_id, __
+                                    in other.get_reap_queue()])
+
+    def test_failed_reap_goes_to_the_back(self):
+        for volume_id in ('vol1', 'vol2', 'vol3'):
+            self.journal.queue_reap(volume_id, [])
+        reaper = adapter.VPLEXDeleteReaper(self.rest, self.journal,
+                                           self._reap, batch_size=2)
+        reaper._reap_batch()
+        self.assertEqual(['vol1'], self.reaped)
+        self.assertEqual(['vol3', 'vol2'], [
+            volume_id for volume_id, __ in self.journal.get_reap_queue()])
+        self.assertEqual({'queued': 2, 'reaped': 1, 'failed': 1},
+                         reaper.get_stats())
+
+    def test_failed_requeue_does_not_stop_the_batch(self):
+        for volume_id in ('vol2', 'vol3'):
+            self.journal.queue_reap(volume_id, [])
+        reaper = adapter.VPLEXDeleteReaper(self.rest, self.journal,
+                                           self._reap)
+        with mock.patch.object(self.journal, 'requeue_reap',
+                               side_effect=IOError('disk full')):
+            reaper._reap_batch()
+        self.assertEqual(['vol3'], self.reaped)
+
+    def test_nothing_is_reaped_before_the_array_is_known(self):
+        self.journal.queue_reap('vol1', [])
+        self.rest.base_uri = None
+        adapter.VPLEXDeleteReaper(self.rest, self.journal,
+                                  self._reap)._reap_batch()
+        self.assertEqual([], self.reaped)
+
+
+class VPLEXStatsCollectorTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXStatsCollectorTest, self).setUp()
+        self.stats = {'total_capacity_gb': 100, 'free_capacity_gb': 40}
+        self.collect = mock.Mock(return_value=self.stats)
+        self.collector = adapter.VPLEXStatsCollector(
+            self.collect, interval=60, jitter=15, refresh_threshold=100)
+
+    def test_snapshot(self):
+        self.assertEqual((None, None), self.collector.get_snapshot())
+        self.collector.refresh(['cluster-1', 'cluster-2'])
+        self.collect.assert_called_once_with(['cluster-1', 'cluster-2'])
+        stats, age = self.collector.get_snapshot()
+        self.assertEqual(self.stats, stats)
+        self.assertIsNot(self.stats, stats)
+        self.assertLess(age, 1)
+
+    def test_failed_refresh_keeps_the_snapshot(self):
+        self.collector.refresh(['cluster-1'])
+        self.collect.side_effect = exception.VolumeBackendAPIException(
+            data='ll timed out')
+        delay = self.collector._refresh_periodic()
+        self.assertTrue(60 <= delay <= 75)
+        self.assertEqual(self.stats, self.collector.get_snapshot()[0])
+
+    @mock.patch.object(adapter.greenthread, 'spawn_n')
+    def test_large_change_refreshes_early(self, mock_spawn):
+        self.collector._refresher = mock.Mock()
+        self.collector.record_change(60)
+        self.assertFalse(mock_spawn.called)
+        self.collector.record_change(40)
+        mock_spawn.assert_called_once_with(self.collector._refresh_early)
+        # one early refresh at a time
+        self.collector.record_change(200)
+        self.assertEqual(1, mock_spawn.call_count)
+        self.collector._refresh_early()
+        self.collector.record_change(100)
+        self.assertEqual(2, mock_spawn.call_count)
+
+    @mock.patch.object(adapter.greenthread, 'spawn_n')
+    def test_no_early_refresh_before_start(self, mock_spawn):
+        self.collector.record_change(1000)
+        self.assertFalse(mock_spawn.called)
+
+
+class VPLEXStorageDetailsTest(test.TestCase):
+    def setUp(self):
+        super(VPLEXStorageDetailsTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        configuration = mock.Mock()
+        configuration.safe_get.side_effect = {
+            'vplex_cluster_stats_timeout': 1,
+            'vplex_journal_path': os.path.join(directory,
+                                               'journal.sqlite')}.get
+        vplex_rest = mock.Mock()
+        vplex_rest.propagate_context.side_effect = lambda func: func
+        self.adapter = adapter.VPLEXAdapter(configuration, vplex_rest)
+        self.capacities = {
+            'cluster-1': {'total_capacity_gb': 100,
+                          'provisioned_capacity_gb': 0,
+                          'free_capacity_gb': 40},
+            'cluster-2': {'total_capacity_gb': 80,
+                          'provisioned_capacity_gb': 0,
+                          'free_capacity_gb': 20}}
+        self.delays = {}
+        self.errors = {}
+        self.finished = []
+        mock.patch.object(self.adapter, '_get_cluster_capacity',
+                          side_effect=self._capacity).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _capacity(self, cluster):
+        time.sleep(self.delays.get(cluster, 0))
+        self.finished.append(cluster)
+        if cluster in self.errors:
+            raise self.errors[cluster]
+        return self.capacities[cluster]
+
+    def test_clusters_are_listed_concurrently(self):
+        self.delays = {'cluster-1': 0.05, 'cluster-2': 0.05}
+        start_time = time.time()
+        stats = self.adapter.get_details_from_storage(['cluster-1',
+                                                       'cluster-2'])
+        self.assertLess(time.time() - start_time, 0.09)
+        self.assertEqual(80, stats['total_capacity_gb'])
+        self.assertEqual(25.0, stats['reserved_percentage'])
+        self.assertFalse(stats['partial'])
+        self.assertEqual([], stats['missing_clusters'])
+
+    def test_failed_cluster_is_left_out(self):
+        self.errors['cluster-2'] = exception.VolumeBackendAPIException(
+            data='ll failed')
+        stats = self.adapter.get_details_from_storage(['cluster-1',
+                                                       'cluster-2'])
+        self.assertEqual(100, stats['total_capacity_gb'])
+        self.assertTrue(stats['partial'])
+        self.assertEqual(['cluster-2'], stats['missing_clusters'])
+
+    def test_slow_cluster_times_out_and_is_killed(self):
+        self.adapter.cluster_stats_timeout = 0.05
+        self.delays['cluster-2'] = 0.1
+        stats = self.adapter.get_details_from_storage(['cluster-1',
+                                                       'cluster-2'])
+        self.assertEqual(['cluster-2'], stats['missing_clusters'])
+        time.sleep(0.1)
+        self.assertEqual(['cluster-1'], self.finished)
+
+    def test_no_cluster_raises(self):
+        self.errors['cluster-1'] = exception.VolumeBackendAPIException(
+            data='ll failed')
+        self.assertRaises(exception.VolumeBackendAPIException,
+                          self.adapter.get_details_from_storage,
+                          ['cluster-1'])